@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class DjforgeRedisMultitokensConfig(AppConfig):
+    name = 'djforge_redis_multitokens'
+
+    def ready(self):
+        # processes that change users without authenticating requests, like the admin,
+        # Celery workers or management commands, may never import tokens_auth
+        from .signals import connect_user_cache_invalidation
+        connect_user_cache_invalidation()
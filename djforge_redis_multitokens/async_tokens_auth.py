@@ -0,0 +1,437 @@
+"""
+asyncio counterparts of ``MultiToken`` and ``CachedTokenAuthentication``.
+
+Redis is accessed with ``redis.asyncio`` (redis-py >= 4.2), hashing runs in the
+loop's default executor and the ORM is called through ``sync_to_async``.
+"""
+import asyncio
+import hashlib
+import hmac
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router
+from redis import asyncio as aioredis
+from redis.exceptions import ResponseError
+from rest_framework import exceptions
+from rest_framework.authentication import get_authorization_header
+
+from .crypto import verify_token
+from .metrics import get_metrics_callback, now
+from .scripts import ADD_TO_TOKEN_SET, RESET_TTL, TOUCH_DEVICE
+from .settings import djforge_redis_multitokens_settings as drt_settings
+from .storage import ShardedRedisStorage
+from .tokens_auth import (
+    CachedTokenAuthentication,
+    FAILED_AUTH_THROTTLE,
+    LazyUser,
+    LOCAL_USERS_CACHE,
+    MultiToken,
+    RECENTLY_SEEN_TOKENS,
+    RECENTLY_WRITTEN_TOKENS,
+    REDIS_USER_CACHE,
+    REJECTED_TOKENS_CACHE,
+    SET_INDEX,
+    TOKENS_STORAGE,
+    TTL_REFRESHER,
+    USER_CACHE_KEY_PREFIX,
+    VERIFIED_TOKENS_CACHE,
+    _split_v1_value,
+)
+from .utils import DEVICES_KEY_PREFIX, make_last_seen_field, parse_token, WRONG_HASH
+
+
+# connections of redis.asyncio are bound to the loop that opened them
+_async_clients = weakref.WeakKeyDictionary()
+# Lua source -> AsyncScript, which can run on the client of any loop
+_async_scripts = {}
+
+# options of synchronous connection pools bound to redis-py's synchronous implementation,
+# the async connections make their own
+_SYNC_ONLY_CONNECTION_KWARGS = ('parser_class', 'redis_connect_func', 'retry')
+
+
+def get_async_redis_client():
+    """
+    Return the asyncio client of the running loop, connected to ``ASYNC_REDIS_URL``
+    or to the same server as the tokens cache, with the same connection options.
+
+    Sharded storage and Redis Cluster aren't supported: a single client would miss the
+    users of the other shards or nodes.
+    """
+    if isinstance(TOKENS_STORAGE, ShardedRedisStorage):
+        raise ImproperlyConfigured('The async API doesn\'t support ShardedRedisStorage.')
+    if TOKENS_STORAGE.cluster:
+        raise ImproperlyConfigured('The async API doesn\'t support Redis Cluster.')
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None:
+        if drt_settings.ASYNC_REDIS_URL:
+            client = aioredis.Redis.from_url(drt_settings.ASYNC_REDIS_URL)
+        else:
+            client = _make_async_client(TOKENS_STORAGE.client)
+
+        _async_clients[loop] = client
+
+    return client
+
+
+def _make_async_client(sync_client):
+    if sync_client is None:
+        raise ImproperlyConfigured(
+            'The tokens storage doesn\'t expose a redis-py client, set ASYNC_REDIS_URL to use the async API.'
+        )
+
+    pool = sync_client.connection_pool
+    connection_class = getattr(aioredis, pool.connection_class.__name__, None)
+    if connection_class is None:
+        raise ImproperlyConfigured(
+            'redis.asyncio has no counterpart of %s, set ASYNC_REDIS_URL to use the async API.' % pool.connection_class.__name__
+        )
+
+    kwargs = dict((k, v) for k, v in pool.connection_kwargs.items() if k not in _SYNC_ONLY_CONNECTION_KWARGS)
+    try:
+        # connections don't connect until they're used, this only checks the options
+        connection_class(**kwargs)
+    except TypeError as e:
+        raise ImproperlyConfigured(
+            'redis.asyncio doesn\'t support the connection options of the tokens storage (%s), set ASYNC_REDIS_URL '
+            'to use the async API.' % e
+        )
+
+    return aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+        connection_class=connection_class, max_connections=pool.max_connections, **kwargs
+    ))
+
+
+async def _arun_script(client, source, keys=(), args=()):
+    script = _async_scripts.get(source)
+    if script is None:
+        script = _async_scripts[source] = client.register_script(source)
+
+    return await script(keys=keys, args=args, client=client)
+
+
+class AsyncMultiToken(MultiToken):
+
+    @classmethod
+    async def acreate_token(cls, user, device=None):
+        loop = asyncio.get_running_loop()
+        full_token, key_name, value = await loop.run_in_executor(None, cls._generate_token, user.pk)
+        token_key = TOKENS_STORAGE.token_key(key_name)
+        client = get_async_redis_client()
+        timeout = cls._get_user_provided_ttl()
+
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            created, evicted_hashes = await cls._aadd_to_token_set(client, user.pk, token_key)
+        else:
+            created, evicted_hashes = await cls._aadd_to_token_list(client, user.pk, token_key, timeout)
+
+        await client.set(TOKENS_STORAGE.make_key(token_key), TOKENS_STORAGE.encode(value), ex=timeout)
+        RECENTLY_WRITTEN_TOKENS.set(token_key, True)
+
+        if device is not None:
+            await cls._aadd_device(client, user.pk, token_key, device, timeout)
+
+        if evicted_hashes:
+            await client.delete(*[TOKENS_STORAGE.make_key(h) for h in evicted_hashes])
+            for h in evicted_hashes:
+                VERIFIED_TOKENS_CACHE.delete(h)
+                RECENTLY_WRITTEN_TOKENS.set(h, True)
+
+        return cls(full_token, user), created
+
+    @classmethod
+    async def aget_user_from_token(cls, full_token):
+        return await cls._aget_user(await cls.aget_user_pk_from_token(full_token))
+
+    @classmethod
+    async def aget_lazy_user_from_token(cls, full_token):
+        user_pk = await cls.aget_user_pk_from_token(full_token)
+
+        snapshot = await cls._aget_cached_user_snapshot(user_pk) if drt_settings.USER_CACHE else None
+        if snapshot is None:
+            return await cls._aget_user(user_pk)
+
+        return LazyUser(user_pk, snapshot['is_active'])
+
+    @classmethod
+    async def aget_user_pk_from_token(cls, full_token):
+        rejected_key = hashlib.sha256(full_token.encode()).digest()
+        if REJECTED_TOKENS_CACHE.get(rejected_key):
+            raise get_user_model().DoesNotExist
+
+        user_pk = await cls._aget_verified_user_pk(full_token)
+        if user_pk is None:
+            REJECTED_TOKENS_CACHE.set(rejected_key, True)
+            raise get_user_model().DoesNotExist
+
+        return get_user_model()._meta.pk.to_python(user_pk)
+
+    @classmethod
+    async def aexpire_token(cls, full_token):
+        token, key_name, hash = parse_token(full_token.key)
+        token_key = TOKENS_STORAGE.token_key(key_name)
+        client = get_async_redis_client()
+        hash_key = TOKENS_STORAGE.make_key(token_key)
+        user_pk = await client.get(hash_key)
+
+        if user_pk is not None:
+            user_pk = TOKENS_STORAGE.decode(user_pk)
+            if hash is None:
+                user_pk = _split_v1_value(user_pk)[1]
+            user_key = TOKENS_STORAGE.make_key(user_pk)
+
+            if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+                await cls._arun_on_token_set(user_pk, lambda: client.zrem(user_key, token_key))
+            else:
+                tokens = await cls._aget_token_list(client, user_pk)
+                if token_key in tokens:
+                    tokens.remove(token_key)
+                    await client.set(
+                        user_key, TOKENS_STORAGE.encode(tokens), ex=cls._get_user_provided_ttl()
+                    )
+
+            await client.hdel(
+                TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user_pk)), hash_key, make_last_seen_field(hash_key),
+            )
+
+        await client.delete(hash_key)
+        VERIFIED_TOKENS_CACHE.delete(token_key)
+        RECENTLY_WRITTEN_TOKENS.set(token_key, True)
+
+    @classmethod
+    async def aexpire_all_tokens(cls, user):
+        client = get_async_redis_client()
+        hashed_tokens = await cls._aget_user_hashes(client, user.pk)
+
+        keys = [user.pk] + hashed_tokens + [DEVICES_KEY_PREFIX + str(user.pk)]
+        redis_keys = [TOKENS_STORAGE.make_key(key) for key in keys]
+        try:
+            await client.unlink(*redis_keys)
+        except ResponseError:
+            await client.delete(*redis_keys)
+        for h in hashed_tokens:
+            VERIFIED_TOKENS_CACHE.delete(h)
+
+    @classmethod
+    async def areset_tokens_ttl(cls, user_pk):
+        client = get_async_redis_client()
+        timeout = cls._get_user_provided_ttl()
+        hashed_tokens = await cls._aget_user_hashes(client, user_pk)
+
+        keys = cls._get_reset_ttl_keys(user_pk, hashed_tokens)
+        args = cls._get_reset_ttl_script_args(timeout, cls._get_ttl_refresh_threshold(timeout))
+        await _arun_script(client, RESET_TTL, keys, args)
+
+    @classmethod
+    async def _aadd_device(cls, client, user_pk, token_key, device, timeout):
+        key = TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user_pk))
+
+        pipe = client.pipeline(transaction=False)
+        pipe.hset(key, TOKENS_STORAGE.make_key(token_key), cls._encode_device(device))
+        if timeout is not None:
+            pipe.expire(key, timeout)
+        await pipe.execute()
+
+    @classmethod
+    async def _atouch_device(cls, user_pk, full_token):
+        token_key = TOKENS_STORAGE.token_key(parse_token(full_token)[1])
+        if RECENTLY_SEEN_TOKENS.get(token_key):
+            return
+        RECENTLY_SEEN_TOKENS.set(token_key, True)
+
+        keys = [TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user_pk))]
+        token_redis_key = TOKENS_STORAGE.make_key(token_key)
+        args = [token_redis_key, make_last_seen_field(token_redis_key), int(time.time())]
+        await _arun_script(get_async_redis_client(), TOUCH_DEVICE, keys, args)
+
+    @classmethod
+    async def _aget_verified_user_pk(cls, full_token):
+        token, key_name, hash = parse_token(full_token)
+        if key_name == WRONG_HASH:
+            return None
+
+        token_key = TOKENS_STORAGE.token_key(key_name)
+        value = await get_async_redis_client().get(TOKENS_STORAGE.make_key(token_key))
+        if value is None:
+            return None
+
+        value = TOKENS_STORAGE.decode(value)
+        if hash is None:
+            hash, user_pk = _split_v1_value(value)
+        else:
+            user_pk = value
+
+        if not await cls._averify_token(token, hash, token_key):
+            return None
+        return user_pk
+
+    @classmethod
+    async def _averify_token(cls, token, hash, token_key):
+        cached_token = VERIFIED_TOKENS_CACHE.get(token_key)
+        if cached_token is not None and hmac.compare_digest(cached_token, token):
+            return True
+
+        # pbkdf2 takes milliseconds of CPU, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, verify_token, token, hash):
+            VERIFIED_TOKENS_CACHE.set(token_key, token)
+            return True
+
+        return False
+
+    @classmethod
+    async def _aget_user(cls, user_pk):
+        if drt_settings.USER_CACHE:
+            snapshot = await cls._aget_cached_user_snapshot(user_pk)
+            if snapshot is not None:
+                user_model = get_user_model()
+                return user_model.from_db(router.db_for_read(user_model), list(snapshot), list(snapshot.values()))
+
+        return await sync_to_async(cls._get_user)(user_pk)
+
+    @classmethod
+    async def _aget_cached_user_snapshot(cls, user_pk):
+        if drt_settings.USER_CACHE != REDIS_USER_CACHE:
+            return LOCAL_USERS_CACHE.get(str(user_pk))
+
+        snapshot = await get_async_redis_client().get(TOKENS_STORAGE.make_key(USER_CACHE_KEY_PREFIX + str(user_pk)))
+        return TOKENS_STORAGE.decode(snapshot) if snapshot is not None else None
+
+    @classmethod
+    async def _aget_user_hashes(cls, client, user_pk):
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            user_key = TOKENS_STORAGE.make_key(user_pk)
+            hashes = await cls._arun_on_token_set(user_pk, lambda: client.zrange(user_key, 0, -1))
+            return [TOKENS_STORAGE.parse_index_member(h) for h in hashes]
+
+        return await cls._aget_token_list(client, user_pk)
+
+    @classmethod
+    async def _aget_token_list(cls, client, user_pk):
+        tokens = await client.get(TOKENS_STORAGE.make_key(user_pk))
+        return TOKENS_STORAGE.decode(tokens) if tokens is not None else []
+
+    @classmethod
+    async def _aadd_to_token_list(cls, client, user_pk, hash, timeout):
+        tokens = await cls._aget_token_list(client, user_pk)
+        tokens.append(hash)
+        created = len(tokens) == 1
+
+        evicted_hashes = []
+        max_tokens = drt_settings.MAX_TOKENS_PER_USER
+        if max_tokens and len(tokens) > max_tokens:
+            evicted_hashes = tokens[:-max_tokens]
+            tokens = tokens[-max_tokens:]
+
+        await client.set(TOKENS_STORAGE.make_key(user_pk), TOKENS_STORAGE.encode(tokens), ex=timeout)
+
+        return created, evicted_hashes
+
+    @classmethod
+    async def _aadd_to_token_set(cls, client, user_pk, hash):
+        keys = [TOKENS_STORAGE.make_key(user_pk)]
+        args = [hash, time.time()] + cls._get_add_to_token_set_script_args()
+
+        count, evicted_hashes = await cls._arun_on_token_set(
+            user_pk, lambda: _arun_script(client, ADD_TO_TOKEN_SET, keys, args)
+        )
+        return count == 1, [TOKENS_STORAGE.parse_index_member(h) for h in evicted_hashes]
+
+    @classmethod
+    async def _arun_on_token_set(cls, user_pk, operation):
+        try:
+            return await operation()
+        except ResponseError as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+
+        # the user's index is still a pickled list written before switching to sets
+        await sync_to_async(cls.migrate_user_index)(user_pk)
+        return await operation()
+
+
+class AsyncCachedTokenAuthentication(CachedTokenAuthentication):
+    """
+    ``CachedTokenAuthentication`` with ``aauthenticate`` for async views and middleware.
+    DRF itself keeps calling the synchronous ``authenticate``.
+
+    Failed authentications are throttled like in ``CachedTokenAuthentication``, the counters
+    are read and written from a thread through ``sync_to_async``.
+    """
+
+    async def aauthenticate(self, request):
+        auth = get_authorization_header(request).split()
+
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header. Token string should not contain invalid characters.')
+
+        client_ident = FAILED_AUTH_THROTTLE.get_ident(request) if FAILED_AUTH_THROTTLE.enabled else None
+        return await self.aauthenticate_credentials(token, client_ident)
+
+    async def aauthenticate_credentials(self, key, client_ident=None):
+        callback = get_metrics_callback()
+        if callback is None:
+            return await self._aauthenticate_credentials(key, client_ident)
+
+        outcome = {}
+        started = now()
+        try:
+            return await self._aauthenticate_credentials(key, client_ident, outcome)
+        finally:
+            callback('authenticate.time', now() - started, {'outcome': outcome.get('outcome', 'error')})
+
+    async def _aauthenticate_credentials(self, key, client_ident, outcome=None):
+        if outcome is None:
+            outcome = {}
+
+        throttle_counters = None
+        if FAILED_AUTH_THROTTLE.enabled:
+            throttle_counters = FAILED_AUTH_THROTTLE.get_counters(client_ident, key)
+            try:
+                await sync_to_async(FAILED_AUTH_THROTTLE.check)(throttle_counters)
+            except exceptions.Throttled:
+                outcome['outcome'] = 'throttled'
+                raise
+
+        try:
+            if drt_settings.LAZY_USER:
+                user = await AsyncMultiToken.aget_lazy_user_from_token(key)
+            else:
+                user = await AsyncMultiToken.aget_user_from_token(key)
+
+            if drt_settings.RESET_TOKEN_TTL_ON_USER_LOG_IN:
+                if drt_settings.BACKGROUND_TTL_REFRESH:
+                    TTL_REFRESHER.add(user.pk)
+                else:
+                    await AsyncMultiToken.areset_tokens_ttl(user.pk)
+
+            if drt_settings.DEVICE_LAST_SEEN_INTERVAL:
+                await AsyncMultiToken._atouch_device(user.pk, key)
+
+        except get_user_model().DoesNotExist:
+            outcome['outcome'] = 'invalid_token'
+            if throttle_counters:
+                await sync_to_async(FAILED_AUTH_THROTTLE.record_failure)(throttle_counters)
+            raise exceptions.AuthenticationFailed('Invalid token.')
+
+        if not user.is_active:
+            outcome['outcome'] = 'inactive_user'
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+
+        outcome['outcome'] = 'success'
+        return (user, AsyncMultiToken(key, user))
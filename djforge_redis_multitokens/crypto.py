@@ -1,21 +1,94 @@
+import base64
 import binascii
+import hashlib
+import hmac
 import os
 
+from django.conf import settings
 from passlib.hash import pbkdf2_sha256
 
-from .utils import make_full_token
+from .metrics import get_metrics_callback, now
+from .settings import djforge_redis_multitokens_settings as drt_settings
+from .utils import make_full_token, make_v1_token
+
+
+PBKDF2_SHA256 = 'pbkdf2_sha256'
+HMAC_SHA256 = 'hmac_sha256'
+HMAC_SHA256_PREFIX = '$hmac-sha256$'
+
+# length of the user tag that starts the id of v1 tokens
+USER_TAG_LENGTH = 8
 
 
 def generate_new_hashed_token():
     token =  binascii.hexlify(os.urandom(20)).decode()
-    hash = pbkdf2_sha256.hash(token)
+    hash = hash_token(token)
     full_token = make_full_token(token, hash)
 
     return token, hash, full_token
 
 
+def generate_new_v1_token(user_pk):
+    token_id = make_user_tag(user_pk) + _urlsafe_random(12)
+    secret = _urlsafe_random(24)
+    hash = hash_token(secret)
+    full_token = make_v1_token(token_id, secret)
+
+    return secret, token_id, hash, full_token
+
+
+def make_user_tag(user_pk):
+    """
+    Return a short tag derived from ``user_pk``. The ids of v1 tokens start with the
+    tag of their user, so the token alone tells which user's keys it belongs with.
+    """
+    digest = hmac.new(_get_secret().encode(), ('user:%s' % user_pk).encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:USER_TAG_LENGTH]
+
+
+def hash_token(token, scheme=None):
+    scheme = scheme or drt_settings.TOKEN_HASHING_SCHEME
+
+    if scheme == HMAC_SHA256:
+        return HMAC_SHA256_PREFIX + _hmac_sha256(token)
+    elif scheme == PBKDF2_SHA256:
+        return pbkdf2_sha256.hash(token)
+
+    raise ValueError('Unknown token hashing scheme: %s' % scheme)
+
+
 def verify_token(token, hash):
+    callback = get_metrics_callback()
+    if callback is None:
+        return _verify_token(token, hash)
+
+    started = now()
+    valid = _verify_token(token, hash)
+    scheme = HMAC_SHA256 if hash.startswith(HMAC_SHA256_PREFIX) else PBKDF2_SHA256
+    callback('verify_token.time', now() - started, {'scheme': scheme, 'valid': valid})
+
+    return valid
+
+
+def _verify_token(token, hash):
+    # the scheme is detected from the stored hash so tokens hashed
+    # with a previous TOKEN_HASHING_SCHEME keep working
+    if hash.startswith(HMAC_SHA256_PREFIX):
+        return hmac.compare_digest(hash[len(HMAC_SHA256_PREFIX):], _hmac_sha256(token))
+
     try:
         return pbkdf2_sha256.verify(token, hash)
     except ValueError:
         return False
+
+
+def _hmac_sha256(token):
+    return hmac.new(_get_secret().encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+def _get_secret():
+    return drt_settings.TOKEN_HASHING_SECRET or settings.SECRET_KEY
+
+
+def _urlsafe_random(length):
+    return base64.urlsafe_b64encode(os.urandom(length)).rstrip(b'=').decode()
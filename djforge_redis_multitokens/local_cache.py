@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class LocalTTLCache:
+    """
+    Bounded in-process cache with per-entry TTL and LRU eviction.
+
+    A ``max_size`` of 0 disables the cache: nothing is stored and every lookup misses.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        if not self.max_size:
+            return default
+
+        with self._lock:
+            try:
+                value, expires_at = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            if expires_at is not None and expires_at <= _now():
+                return default
+
+            # re-insert to mark the entry as most recently used
+            self._entries[key] = (value, expires_at)
+            return value
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+
+        expires_at = _now() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,110 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from djforge_redis_multitokens.settings import djforge_redis_multitokens_settings as drt_settings
+from djforge_redis_multitokens.storage import CompactRedisStorage, DjangoCacheStorage, RedisStorage
+from djforge_redis_multitokens.tokens_auth import SET_INDEX, TOKENS_STORAGE
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the tokens of all users from the pickled format of the Django cache, or of a RedisStorage, '
+        'to the CompactRedisStorage set in the STORAGE setting.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source-url',
+            help='URL of the RedisStorage to migrate from. Defaults to the cache named by REDIS_DB_NAME.',
+        )
+        parser.add_argument('--source-prefix', default='', help='KEY_PREFIX of the RedisStorage to migrate from.')
+        parser.add_argument('--keep-source', action='store_true', help="Don't delete the migrated keys.")
+
+    def handle(self, *args, **options):
+        if not isinstance(TOKENS_STORAGE, CompactRedisStorage):
+            raise CommandError('The STORAGE setting must use CompactRedisStorage.')
+
+        if options['source_url']:
+            source = RedisStorage(options['source_url'], key_prefix=options['source_prefix'])
+        else:
+            source = DjangoCacheStorage(drt_settings.REDIS_DB_NAME)
+
+        users = tokens = 0
+        user_pks = get_user_model().objects.values_list('pk', flat=True).order_by('pk')
+
+        for user_pk in user_pks.iterator():
+            migrated = self.migrate_user(source, user_pk, options['keep_source'])
+            if migrated:
+                users += 1
+                tokens += migrated
+
+        self.stdout.write('Migrated %d tokens of %d users.' % (tokens, users))
+
+    def migrate_user(self, source, user_pk, keep_source):
+        hashes = self.get_source_hashes(source, user_pk)
+        if not hashes:
+            return 0
+
+        index_ttl = source.ttl(user_pk)
+        pks = source.get_many(hashes)
+        ttls = dict((h, source.ttl(h)) for h in pks)
+
+        # ttl() is 0 for keys that expired since get_many()
+        migrated = [h for h in hashes if h in pks and ttls[h] != 0]
+        token_keys = [TOKENS_STORAGE.token_key(h) for h in migrated]
+
+        if token_keys:
+            self.write_user(user_pk, token_keys, [pks[h] for h in migrated], [ttls[h] for h in migrated], index_ttl)
+
+            # the source is only deleted once the new keys are known to be there
+            if len(TOKENS_STORAGE.get_many(token_keys)) != len(token_keys):
+                raise CommandError('The tokens of user %s were not written, their source keys are kept.' % user_pk)
+
+        if not keep_source:
+            source_keys = list(hashes)
+            # the index was already written over when both storages share it
+            if not self.shares_index(source, user_pk) or not token_keys:
+                source_keys.append(user_pk)
+            source.delete_many(source_keys)
+
+        return len(token_keys)
+
+    def write_user(self, user_pk, token_keys, user_pks, ttls, index_ttl):
+        client = TOKENS_STORAGE.get_client(user_pk)
+        key = TOKENS_STORAGE.make_key(user_pk)
+        # all of the user's keys are written or none is, MULTI can't span slots of a cluster
+        pipe = client.pipeline(transaction=not TOKENS_STORAGE.cluster)
+
+        for token_key, token_user_pk, ttl in zip(token_keys, user_pks, ttls):
+            pipe.set(TOKENS_STORAGE.make_key(token_key), TOKENS_STORAGE.encode(str(token_user_pk)), ex=ttl)
+
+        pipe.delete(key)
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            # keep the creation order, older than any token created from now on
+            pipe.zadd(key, dict((token_key, i) for i, token_key in enumerate(token_keys)))
+        else:
+            pipe.set(key, TOKENS_STORAGE.encode(token_keys))
+        if index_ttl:
+            pipe.expire(key, index_ttl)
+
+        pipe.execute()
+
+    def shares_index(self, source, user_pk):
+        """
+        Whether the source stores the user's index under the same Redis key as the new storage.
+        """
+        if source.make_key(user_pk) != TOKENS_STORAGE.make_key(user_pk):
+            return False
+
+        source_client, client = source.client, TOKENS_STORAGE.get_client(user_pk)
+        if source_client is None:
+            # can't tell, keep it
+            return True
+        return source_client.connection_pool.connection_kwargs == client.connection_pool.connection_kwargs
+
+    def get_source_hashes(self, source, user_pk):
+        client = source.client
+        if client is not None and client.type(source.make_key(user_pk)) == b'zset':
+            return [member.decode() for member in client.zrange(source.make_key(user_pk), 0, -1)]
+
+        return source.get(user_pk) or []
@@ -0,0 +1,18 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from djforge_redis_multitokens.tokens_auth import MultiToken
+
+
+class Command(BaseCommand):
+    help = 'Convert the pickled per-user lists of token hashes to Redis sorted sets (USER_TOKENS_INDEX = "set").'
+
+    def handle(self, *args, **options):
+        migrated = 0
+        user_pks = get_user_model().objects.values_list('pk', flat=True).order_by('pk')
+
+        for user_pk in user_pks.iterator():
+            if MultiToken.migrate_user_index(user_pk):
+                migrated += 1
+
+        self.stdout.write('Migrated token index of %d users.' % migrated)
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djforge_redis_multitokens.throttling import COUNTER_PREFIXES
+from djforge_redis_multitokens.tokens_auth import MultiToken, TOKENS_STORAGE, USER_CACHE_KEY_PREFIX
+
+
+class Command(BaseCommand):
+    help = 'Remove the hashes of expired tokens from the per-user token indexes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of keys requested from Redis by each SCAN call.',
+        )
+
+    def handle(self, *args, **options):
+        clients = TOKENS_STORAGE.get_all_clients()
+        if None in clients:
+            raise CommandError('The tokens storage does not expose a redis-py client.')
+
+        prefix = TOKENS_STORAGE.make_key('')
+        users = entries = reclaimed_bytes = 0
+
+        for client in clients:
+            for key in client.scan_iter(match=_escape_pattern(prefix) + '*', count=options['batch_size']):
+                name = _get_key_name(key, prefix)
+                if name is None or not self.is_user_index(client, key, name):
+                    continue
+
+                users += 1
+                for token_key in MultiToken.prune_user_index(name):
+                    entries += 1
+                    reclaimed_bytes += len(token_key) if isinstance(token_key, bytes) else len(token_key.encode())
+
+        self.stdout.write(
+            'Scanned %d user indexes, removed %d dangling hashes (%d bytes).' % (users, entries, reclaimed_bytes)
+        )
+
+    def is_user_index(self, client, key, name):
+        # token hashes start with the name of their scheme, like "$pbkdf2-sha256$",
+        # failed authentication counters are integers rather than pickles
+        if name.startswith(('$', USER_CACHE_KEY_PREFIX) + COUNTER_PREFIXES):
+            return False
+
+        key_type = client.type(key)
+        if key_type == b'zset':
+            return True
+
+        return key_type == b'string' and isinstance(TOKENS_STORAGE.get(name), list)
+
+
+def _get_key_name(key, prefix):
+    """
+    Return the logical name of ``key``, a key read from Redis, or ``None`` for binary keys.
+    """
+    try:
+        name = key.decode()[len(prefix):]
+    except UnicodeDecodeError:
+        # binary token keys of CompactRedisStorage
+        return None
+
+    if name.startswith('{'):
+        # hash tag of the RedisStorage hash_tags option, like "{tag}:42"
+        name = name.split('}:', 1)[-1]
+    return name
+
+
+def _escape_pattern(pattern):
+    for char in '\\*?[]':
+        pattern = pattern.replace(char, '\\' + char)
+    return pattern
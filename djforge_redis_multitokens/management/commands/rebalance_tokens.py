@@ -0,0 +1,105 @@
+import redis
+from django.core.management.base import BaseCommand, CommandError
+from redis.exceptions import ResponseError
+
+from djforge_redis_multitokens.management.commands.prune_tokens import _escape_pattern, _get_key_name
+from djforge_redis_multitokens.storage import ShardedRedisStorage
+from djforge_redis_multitokens.throttling import COUNTER_PREFIXES
+from djforge_redis_multitokens.tokens_auth import _chunks, TOKENS_STORAGE
+
+
+class Command(BaseCommand):
+    help = 'Move keys to the shard they belong on after shards were added to or removed from a ShardedRedisStorage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of keys requested from Redis by each SCAN call and moved together.',
+        )
+        parser.add_argument(
+            '--source-url', action='append', default=[],
+            help='URL of a shard removed from the STORAGE setting, to move its keys. Can be repeated.',
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Count the keys to move without moving them.")
+
+    def handle(self, *args, **options):
+        if not isinstance(TOKENS_STORAGE, ShardedRedisStorage):
+            raise CommandError('The STORAGE setting must use ShardedRedisStorage.')
+
+        clients = [shard.client for name, shard in sorted(TOKENS_STORAGE.shards.items())]
+        clients += [redis.StrictRedis.from_url(url) for url in options['source_url']]
+
+        pattern = _escape_pattern(TOKENS_STORAGE.make_key('')) + '*'
+        moved = 0
+
+        for client in clients:
+            keys = client.scan_iter(match=pattern, count=options['batch_size'])
+            for batch in _chunks(keys, options['batch_size']):
+                misplaced = [
+                    (key, TOKENS_STORAGE.get_shard_of_redis_key(key).client) for key in batch
+                ]
+                misplaced = [(key, target) for key, target in misplaced if target is not client]
+
+                if misplaced and not options['dry_run']:
+                    self.move_keys(client, misplaced)
+                moved += len(misplaced)
+
+        if options['dry_run']:
+            self.stdout.write('%d keys would be moved.' % moved)
+        else:
+            self.stdout.write('Moved %d keys.' % moved)
+
+    def move_keys(self, source, misplaced):
+        pipe = source.pipeline(transaction=False)
+        for key, target in misplaced:
+            pipe.dump(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+
+        for i, (key, target) in enumerate(misplaced):
+            dumped, pttl = results[2 * i], results[2 * i + 1]
+            # expired since it was scanned
+            if dumped is None:
+                continue
+
+            try:
+                target.restore(key, max(pttl, 0), dumped)
+            except ResponseError as e:
+                if 'BUSYKEY' not in str(e):
+                    raise
+                # written on the new shard since the shard was added
+                self.merge_index(source, target, key)
+
+            source.delete(key)
+
+    def merge_index(self, source, target, key):
+        """
+        Add the tokens of a user's index, or the user's devices, on the old shard to the
+        ones on the new shard. Other keys already on the new shard are newer, they are kept.
+        """
+        source_type, target_type = source.type(key), target.type(key)
+
+        if source_type == target_type == b'zset':
+            # scores are creation times, both indexes keep their order
+            target.zadd(key, dict(source.zrange(key, 0, -1, withscores=True)), nx=True)
+
+        elif source_type == target_type == b'hash':
+            # the devices of a user, entries already on the new shard are newer
+            target_entries = target.hgetall(key)
+            missing = dict(
+                (field, entry) for field, entry in source.hgetall(key).items() if field not in target_entries
+            )
+            if missing:
+                target.hset(key, mapping=missing)
+
+        elif source_type == target_type == b'string':
+            name = _get_key_name(key, TOKENS_STORAGE.make_key(''))
+            if name is not None and name.startswith(COUNTER_PREFIXES):
+                # failed authentication counters, the ones on the new shard are current
+                return
+
+            old, new = TOKENS_STORAGE.decode(source.get(key)), TOKENS_STORAGE.decode(target.get(key))
+            if isinstance(old, list) and isinstance(new, list):
+                ttl = target.ttl(key)
+                merged = old + [token_key for token_key in new if token_key not in old]
+                target.set(key, TOKENS_STORAGE.encode(merged), ex=ttl if ttl > 0 else None)
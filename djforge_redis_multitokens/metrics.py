@@ -0,0 +1,150 @@
+"""
+Instrumentation reported to the ``METRICS_CALLBACK`` setting.
+
+The callback is called as ``callback(name, value, tags)``:
+
+- ``verify_token.time``: seconds spent verifying a token against its hash, tagged with
+  the hashing ``scheme`` and whether the token was ``valid``
+- ``user_lookup.time``: seconds spent loading the user, from the user cache or the database
+- ``redis.time`` and ``redis.commands``: seconds spent in Redis and commands sent to it
+  while authenticating a request
+- ``authenticate.time``: seconds spent authenticating a request, tagged with its
+  ``outcome``: ``'success'``, ``'invalid_token'``, ``'inactive_user'``, ``'throttled'`` or ``'error'`` when
+  an unexpected exception, like a Redis connection error, was raised
+
+When ``METRICS_CALLBACK`` is not set, instrumented code only pays for reading the setting.
+Redis commands are counted on the clients of the tokens storage only, see ``measure_client``,
+and an exception raised by the callback is logged instead of failing the request.
+"""
+import logging
+import threading
+import time
+import weakref
+
+from django.utils.module_loading import import_string
+
+from .settings import djforge_redis_multitokens_settings as drt_settings
+
+
+logger = logging.getLogger(__name__)
+
+now = getattr(time, 'perf_counter', time.time)
+
+_local = threading.local()
+
+# (METRICS_CALLBACK setting, resolved callback)
+_resolved_callback = (None, None)
+_clients_lock = threading.Lock()
+# clients of the tokens storage, wrapped once metrics are enabled
+_unmeasured_clients = weakref.WeakSet()
+_measuring_clients = False
+
+
+def get_metrics_callback():
+    """
+    Return the callable set in ``METRICS_CALLBACK``, or ``None`` if metrics are disabled.
+    """
+    global _resolved_callback
+
+    setting = drt_settings.METRICS_CALLBACK
+    if not setting:
+        return None
+
+    if _resolved_callback[0] is not setting:
+        callback = import_string(setting) if isinstance(setting, str) else setting
+        _start_measuring_clients()
+        _resolved_callback = (setting, _logging_errors(callback))
+
+    return _resolved_callback[1]
+
+
+def measure_client(client):
+    """
+    Count the commands sent through ``client``, a redis-py client of the tokens storage,
+    in ``RedisStats``. Only this instance is wrapped, and only once metrics are enabled,
+    so the other clients of the process are neither counted nor slowed down.
+    """
+    with _clients_lock:
+        if _measuring_clients:
+            _wrap_client(client)
+        else:
+            _unmeasured_clients.add(client)
+
+
+class RedisStats:
+    """
+    Counts the commands sent to Redis from the current thread, and the time spent
+    waiting on Redis, while the context is active.
+    """
+
+    def __enter__(self):
+        self.commands = 0
+        self.seconds = 0.0
+        self._outer = getattr(_local, 'redis_stats', None)
+        _local.redis_stats = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.redis_stats = self._outer
+        if self._outer is not None:
+            self._outer.commands += self.commands
+            self._outer.seconds += self.seconds
+
+
+def _logging_errors(callback):
+    def call(name, value, tags):
+        try:
+            callback(name, value, tags)
+        except Exception:
+            logger.exception('METRICS_CALLBACK failed to record %s', name)
+    return call
+
+
+def _start_measuring_clients():
+    global _measuring_clients
+
+    with _clients_lock:
+        for client in list(_unmeasured_clients):
+            _wrap_client(client)
+        _unmeasured_clients.clear()
+        _measuring_clients = True
+
+
+def _measured(method, count_commands):
+    def wrapper(*args, **kwargs):
+        stats = getattr(_local, 'redis_stats', None)
+        if stats is None:
+            return method(*args, **kwargs)
+
+        stats.commands += count_commands()
+        started = now()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.seconds += now() - started
+    return wrapper
+
+
+def _wrap_client(client):
+    # redis-py has no hooks for this, so the methods of the instance are replaced by
+    # wrappers that still look the methods up on the class at each call. Commands queued
+    # on a pipeline don't go through the client's execute_command, they are counted
+    # when the pipeline is executed.
+    if getattr(client, '_drt_measured', False):
+        return
+
+    def execute_command(*args, **kwargs):
+        return type(client).execute_command(client, *args, **kwargs)
+
+    def pipeline(*args, **kwargs):
+        pipe = type(client).pipeline(client, *args, **kwargs)
+
+        def execute(*args, **kwargs):
+            return type(pipe).execute(pipe, *args, **kwargs)
+
+        pipe.execute = _measured(execute, lambda: len(pipe.command_stack))
+        return pipe
+
+    client.execute_command = _measured(execute_command, lambda: 1)
+    client.pipeline = pipeline
+    client._drt_measured = True
@@ -0,0 +1,61 @@
+"""
+Access to the raw redis-py client behind the Django cache that stores tokens.
+
+Commands that the Django cache API can't express (pipelines, Lua scripts) go
+through this client. Keys still have to be built with the cache's ``make_key``
+so they live in the same namespace as the keys written through the cache API.
+"""
+
+
+_registered_scripts = {}
+
+
+def get_redis_client(cache):
+    """
+    Return the redis-py client used by ``cache`` for writes, or ``None`` if the
+    cache backend doesn't expose one or spreads keys over several servers.
+    """
+    # django-redis-cache
+    if hasattr(cache, 'get_client'):
+        if len(getattr(cache, 'clients', ())) > 1:
+            return None
+        return cache.get_client(None, write=True)
+
+    client = getattr(cache, 'client', None)
+    # django-redis
+    if hasattr(client, 'get_client'):
+        return client.get_client(write=True)
+
+    return None
+
+
+def make_redis_key(cache, key):
+    return cache.make_key(key)
+
+
+def encode_value(cache, value):
+    """
+    Serialize ``value`` the way ``cache.set`` would before sending it to Redis.
+    """
+    # django-redis-cache
+    if hasattr(cache, 'prep_value'):
+        return cache.prep_value(value)
+    # django-redis
+    return cache.client.encode(value)
+
+
+def decode_value(cache, value):
+    """
+    Deserialize a value read from Redis the way ``cache.get`` would.
+    """
+    if hasattr(cache, 'get_value'):
+        return cache.get_value(value)
+    return cache.client.decode(value)
+
+
+def run_script(client, source, keys=(), args=()):
+    script = _registered_scripts.get(source)
+    if script is None:
+        script = _registered_scripts[source] = client.register_script(source)
+
+    return script(keys=keys, args=args, client=client)
@@ -0,0 +1,103 @@
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLRefresher:
+    """
+    Collects the pks of users whose tokens were used and refreshes their TTL from a
+    background thread, ``batch_size`` users per call to ``refresh_func``.
+
+    The buffer is flushed every ``interval`` seconds, as soon as it holds ``batch_size``
+    users, and when the process exits. Users added while ``max_pending`` users are
+    already waiting are dropped.
+    """
+
+    def __init__(self, refresh_func, interval, batch_size, max_pending):
+        self.refresh_func = refresh_func
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, user_pk):
+        with self._lock:
+            if user_pk in self._pending:
+                return
+
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+
+            self._pending[user_pk] = None
+            batch_is_full = len(self._pending) >= self.batch_size
+
+        self._ensure_started()
+        if batch_is_full:
+            self._wakeup.set()
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popitem(last=False)[0])
+
+            if not batch:
+                return
+
+            try:
+                self.refresh_func(batch)
+            except Exception:
+                logger.exception('Failed to refresh the TTL of %d users', len(batch))
+                self.failed += len(batch)
+            else:
+                self.flushed += len(batch)
+
+    def stop(self):
+        thread = self._thread
+        self._thread = None
+        self._wakeup.set()
+
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join()
+
+        self.flush()
+
+    def _ensure_started(self):
+        # the thread doesn't survive a fork, start a new one in the child process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+
+            if self._pid is None:
+                atexit.register(self.stop)
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='djforge-ttl-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        thread = self._thread
+        while self._thread is thread:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,154 @@
+# Lua scripts run by MultiToken when the tokens cache exposes a redis-py client.
+
+# Applies the same rules as MultiToken._reset_token_ttl to every key in a single call.
+#   KEYS: keys to refresh, the user key first
+#   ARGV[1]: TIMEOUT in seconds, empty string for None
+#   ARGV[2]: '1' if OVERWRITE_NONE_TTL is set
+#   ARGV[3]: nothing is refreshed while every key has more seconds than this to live,
+#            empty string to always refresh
+# Returns the 1-based positions in KEYS of the keys that don't exist.
+RESET_TTL = """
+local timeout = tonumber(ARGV[1])
+local overwrite_none_ttl = ARGV[2] == '1'
+local refresh_below = tonumber(ARGV[3])
+local missing = {}
+local ttls = {}
+local expiring_soon = refresh_below == nil
+
+for i, key in ipairs(KEYS) do
+    ttls[i] = redis.call('TTL', key)
+    if ttls[i] == -2 then
+        missing[#missing + 1] = i
+    elseif ttls[i] >= 0 and refresh_below ~= nil and ttls[i] <= refresh_below then
+        expiring_soon = true
+    end
+end
+
+-- the user key is reset by every new token, older tokens may expire first
+if timeout ~= nil and not expiring_soon then
+    return missing
+end
+
+for i, key in ipairs(KEYS) do
+    local ttl = ttls[i]
+
+    if ttl == -2 then
+        -- reported above
+    elseif timeout == nil then
+        if ttl >= 0 then
+            redis.call('PERSIST', key)
+        end
+    elseif ttl >= 0 or (ttl == -1 and overwrite_none_ttl) then
+        redis.call('EXPIRE', key, timeout)
+    end
+end
+
+return missing
+"""
+
+# Adds a hash to the user's sorted set and evicts the oldest hashes beyond the cap.
+#   KEYS[1]: the user key
+#   ARGV[1]: hash of the new token
+#   ARGV[2]: score of the new token, its creation time
+#   ARGV[3]: TIMEOUT in seconds, empty string for None
+#   ARGV[4]: MAX_TOKENS_PER_USER, empty string for no cap
+# Returns the number of tokens before the eviction and the evicted hashes.
+ADD_TO_TOKEN_SET = """
+local timeout = tonumber(ARGV[3])
+local max_tokens = tonumber(ARGV[4])
+local evicted = {}
+
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local count = redis.call('ZCARD', KEYS[1])
+
+if max_tokens ~= nil and count > max_tokens then
+    evicted = redis.call('ZRANGE', KEYS[1], 0, count - max_tokens - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, count - max_tokens - 1)
+end
+
+if timeout == nil then
+    redis.call('PERSIST', KEYS[1])
+else
+    redis.call('EXPIRE', KEYS[1], timeout)
+end
+
+return {count, evicted}
+"""
+
+# Counts one more event on each key, keys start expiring when they're created.
+#   KEYS: counters
+#   ARGV[1]: lifetime of new counters in seconds
+# Returns the new values of the counters.
+INCR_WITH_EXPIRY = """
+local counts = {}
+
+for i, key in ipairs(KEYS) do
+    counts[i] = redis.call('INCR', key)
+    if counts[i] == 1 then
+        redis.call('EXPIRE', key, ARGV[1])
+    end
+end
+
+return counts
+"""
+
+# Lists the devices of a user whose token still exists and removes the others.
+#   KEYS[1]: the user's devices hash, whose fields are the keys of the tokens and, for
+#            the devices that were seen, ARGV[1] followed by the key of the token
+#   ARGV[1]: prefix of the last-seen fields
+# Returns the field, entry and last-seen time, empty if never updated, of the live devices.
+LIST_DEVICES = """
+local entries = redis.call('HGETALL', KEYS[1])
+local prefix = ARGV[1]
+local live = {}
+
+for i = 1, #entries, 2 do
+    local field = entries[i]
+    if string.sub(field, 1, #prefix) == prefix then
+        -- read with its device
+    elseif redis.call('EXISTS', field) == 1 then
+        live[#live + 1] = field
+        live[#live + 1] = entries[i + 1]
+        live[#live + 1] = redis.call('HGET', KEYS[1], prefix .. field) or ''
+    else
+        redis.call('HDEL', KEYS[1], field, prefix .. field)
+    end
+end
+
+return live
+"""
+
+# Sets the last-seen time of a device, if the token was created with one. The metadata
+# of the device is left as it was written.
+#   KEYS[1]: the user's devices hash
+#   ARGV[1]: the key of the token
+#   ARGV[2]: the last-seen field of the token
+#   ARGV[3]: the last-seen time
+TOUCH_DEVICE = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+
+# Rewrites a value only if it wasn't changed since it was read.
+#   KEYS[1]: the key
+#   ARGV[1]: the value that was read
+#   ARGV[2]: the new value
+#   ARGV[3]: TIMEOUT in seconds, empty string for None
+# Returns 1 if the value was rewritten, 0 if it changed in the meantime.
+SET_IF_UNCHANGED = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+
+local timeout = tonumber(ARGV[3])
+if timeout == nil then
+    redis.call('SET', KEYS[1], ARGV[2])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', timeout)
+end
+return 1
+"""
@@ -1,28 +1,81 @@
 from django.conf import settings
+from django.core.signals import setting_changed
 
 
 DEFAULT_DJFORGE_REDIS_MULTITOKENS = {
     'DJFORGE_REDIS_MULTITOKENS':
         {
             'REDIS_DB_NAME': 'tokens',
+            'STORAGE': None,
             'RESET_TOKEN_TTL_ON_USER_LOG_IN': True,
             'OVERWRITE_NONE_TTL': True,
+            'VERIFIED_TOKENS_CACHE_SIZE': 0,
+            'VERIFIED_TOKENS_CACHE_TTL': 60,
+            'REJECTED_TOKENS_CACHE_SIZE': 10000,
+            'REJECTED_TOKENS_CACHE_TTL': 10,
+            'TOKEN_HASHING_SCHEME': 'pbkdf2_sha256',
+            'TOKEN_HASHING_SECRET': None,
+            'TOKEN_FORMAT': 'legacy',
+            'USER_TOKENS_INDEX': 'list',
+            'MAX_TOKENS_PER_USER': None,
+            'USER_CACHE': None,
+            'USER_CACHE_TTL': 300,
+            'USER_CACHE_SIZE': 10000,
+            'USER_CACHE_FIELDS': None,
+            'LAZY_USER': False,
+            'TTL_REFRESH_THRESHOLD': None,
+            'TTL_REFRESH_INTERVAL': None,
+            'BACKGROUND_TTL_REFRESH': False,
+            'BACKGROUND_TTL_REFRESH_INTERVAL': 0.5,
+            'BACKGROUND_TTL_REFRESH_BATCH_SIZE': 500,
+            'BACKGROUND_TTL_REFRESH_MAX_PENDING': 10000,
+            'READ_YOUR_WRITES_WINDOW': 5,
+            'BATCH_VERIFY_WORKERS': 4,
+            'DEVICE_LAST_SEEN_INTERVAL': None,
+            'FAILED_AUTH_LIMIT_PER_IP': None,
+            'FAILED_AUTH_LIMIT_PER_TOKEN': None,
+            'FAILED_AUTH_WINDOW': 60,
+            'ASYNC_REDIS_URL': None,
+            'METRICS_CALLBACK': None,
         }
 }
 
 
 class DRFRedisMultipleTokensrSettings:
+    """
+    The library's settings, resolved once into plain attributes so reading them on the
+    request path is a single lookup. They're read-only, ``reload`` resolves them again
+    when ``DJFORGE_REDIS_MULTITOKENS`` changes. Objects built from them once, like the
+    tokens storage and the in-process caches of ``tokens_auth``, aren't rebuilt.
+    """
+
     def __init__(self, defaults):
-        self.defaults = defaults
-        self.overrides = getattr(settings, 'DJFORGE_REDIS_MULTITOKENS', {})
+        self.__dict__['defaults'] = defaults
+        self.reload()
+
+    def reload(self):
+        overrides = getattr(settings, 'DJFORGE_REDIS_MULTITOKENS', {})
+
+        values = dict(self.defaults)
+        values.update(overrides)
+        values['defaults'] = self.defaults
+        values['overrides'] = overrides
+
+        # swapped in one assignment, so other threads never see a half-updated snapshot
+        object.__setattr__(self, '__dict__', values)
 
-    def __getattr__(self, item):
-        try:
-            return self.overrides[item]
-        except KeyError:
-            return self.defaults[item]
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are read-only, change DJFORGE_REDIS_MULTITOKENS instead.')
 
 
 djforge_redis_multitokens_settings = DRFRedisMultipleTokensrSettings(
     DEFAULT_DJFORGE_REDIS_MULTITOKENS['DJFORGE_REDIS_MULTITOKENS']
 )
+
+
+def _reload_settings(setting, **kwargs):
+    if setting == 'DJFORGE_REDIS_MULTITOKENS':
+        djforge_redis_multitokens_settings.reload()
+
+
+setting_changed.connect(_reload_settings)
@@ -0,0 +1,29 @@
+"""
+Receivers that drop users from the user cache when they're saved or deleted.
+
+They're connected by the app's ``ready()`` and don't import ``tokens_auth`` until a user
+is saved with ``USER_CACHE`` set, so processes that never authenticate requests don't
+build the tokens storage.
+"""
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from .settings import djforge_redis_multitokens_settings as drt_settings
+
+
+USER_CACHE_INVALIDATION_UID = 'djforge_redis_multitokens.invalidate_cached_user'
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    if drt_settings.USER_CACHE:
+        from .tokens_auth import MultiToken
+        MultiToken.invalidate_cached_user(instance.pk)
+
+
+def connect_user_cache_invalidation():
+    post_save.connect(
+        invalidate_cached_user, sender=settings.AUTH_USER_MODEL, dispatch_uid=USER_CACHE_INVALIDATION_UID,
+    )
+    post_delete.connect(
+        invalidate_cached_user, sender=settings.AUTH_USER_MODEL, dispatch_uid=USER_CACHE_INVALIDATION_UID,
+    )
@@ -0,0 +1,560 @@
+"""
+Storage backends that hold the tokens of ``MultiToken``.
+
+A backend stores values under logical keys (token keys, user pks) and exposes the
+redis-py client they live in, ``get_client(key)``, so that pipelines and Lua scripts
+can work on the same keys. Raw Redis keys are built with ``make_key``, raw values
+with ``encode`` and ``decode``.
+
+Tokens are stored under ``token_key(hash)`` and the users' indexes hold these token
+keys. ``parse_index_member`` turns a member of a sorted set index back into a token key.
+
+- ``DjangoCacheStorage`` keeps tokens in the Django cache named by ``REDIS_DB_NAME``,
+  as the library always did.
+- ``RedisStorage`` talks to Redis with redis-py directly, through a connection pool
+  shared by the whole process, without Django's cache layers.
+- ``CompactRedisStorage`` is a ``RedisStorage`` that keys tokens by short binary
+  digests and stores user pks without pickle.
+- ``ShardedRedisStorage`` and ``ShardedCompactRedisStorage`` spread users over several
+  Redis servers.
+
+``DjangoCacheStorage`` is used unless the ``STORAGE`` setting is set.
+
+With ``hash_tags``, Redis keys carry the tag of the user they belong to, like
+``tokens:{tag}:42``, so that a user's index and tokens are in the same Redis Cluster slot.
+
+``get_from_replica`` reads a key from a read replica of ``RedisStorage`` when it has any,
+everything else goes to the primary.
+"""
+import bisect
+import hashlib
+import itertools
+import pickle
+
+import redis
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .crypto import make_user_tag, USER_TAG_LENGTH
+from .metrics import measure_client, now
+from .redis_utils import decode_value, encode_value, get_redis_client
+from .settings import djforge_redis_multitokens_settings as drt_settings
+from .utils import DEVICES_KEY_PREFIX, V1_KEY_PREFIX, V1_TOKEN_FORMAT
+
+
+REDIS_STORAGE = 'djforge_redis_multitokens.storage.RedisStorage'
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LATENCY = 'least_latency'
+
+
+class DjangoCacheStorage:
+    """
+    Tokens stored through a Django cache. ``client`` is ``None`` if the cache backend
+    doesn't expose a single redis-py client, then only the cache API is used.
+    """
+
+    cluster = False
+
+    def __init__(self, cache_name):
+        self.cache_name = cache_name
+        self._cache = None
+
+    @property
+    def cache(self):
+        # bound on first use, so importing the library doesn't open the cache backend
+        if self._cache is None:
+            cache = caches[self.cache_name]
+            client = get_redis_client(cache)
+            if client is not None:
+                measure_client(client)
+            self._cache = cache
+        return self._cache
+
+    @property
+    def client(self):
+        return get_redis_client(self.cache)
+
+    def get_client(self, key):
+        return self.client
+
+    def group_keys_by_client(self, keys):
+        keys = list(keys)
+        return [(self.client, keys)] if keys else []
+
+    def get_all_clients(self):
+        return [self.client]
+
+    def token_key(self, hash):
+        return hash
+
+    def parse_index_member(self, member):
+        return member.decode()
+
+    def make_key(self, key):
+        return self.cache.make_key(key)
+
+    def encode(self, value):
+        return encode_value(self.cache, value)
+
+    def decode(self, value):
+        return decode_value(self.cache, value)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def get_from_replica(self, key):
+        return self.cache.get(key)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout=timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def ttl(self, key):
+        return self.cache.ttl(key)
+
+    def expire(self, key, timeout):
+        self.cache.expire(key, timeout)
+
+    def persist(self, key):
+        self.cache.persist(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class RedisStorage:
+    """
+    Tokens stored with redis-py. Keys are prefixed with ``key_prefix`` and values are
+    pickled. ``connection_options`` are passed on to ``redis.ConnectionPool.from_url``,
+    or to ``redis.cluster.RedisCluster.from_url`` with ``cluster``.
+
+    ``get_from_replica`` reads from the servers of ``replica_urls``, picked by
+    ``replica_selection``, see ``ReplicaSet``.
+    """
+
+    def __init__(self, url, key_prefix='', hash_tags=False, cluster=False, replica_urls=None,
+                 replica_selection=ROUND_ROBIN, **connection_options):
+        self.key_prefix = key_prefix
+        self.hash_tags = hash_tags
+        self.cluster = cluster
+        self.replicas = ReplicaSet(replica_urls, replica_selection, **connection_options) if replica_urls else None
+
+        if cluster:
+            if drt_settings.TOKEN_FORMAT != V1_TOKEN_FORMAT:
+                raise ImproperlyConfigured(
+                    'Redis Cluster requires TOKEN_FORMAT "mt1", legacy tokens can\'t be stored in the slot of their user.'
+                )
+            try:
+                from redis.cluster import RedisCluster
+            except ImportError:
+                raise ImproperlyConfigured('Redis Cluster support requires redis-py >= 4.1.')
+            self.client = RedisCluster.from_url(url, **connection_options)
+        else:
+            self.client = redis.StrictRedis(connection_pool=redis.ConnectionPool.from_url(url, **connection_options))
+        measure_client(self.client)
+
+    def get_client(self, key):
+        return self.client
+
+    def group_keys_by_client(self, keys):
+        keys = list(keys)
+        return [(self.client, keys)] if keys else []
+
+    def get_all_clients(self):
+        return [self.client]
+
+    def token_key(self, hash):
+        return hash
+
+    def parse_index_member(self, member):
+        return member.decode()
+
+    def make_key(self, key):
+        key = str(key)
+        if self.hash_tags:
+            tag = get_hash_tag(key)
+            if tag is not None:
+                key = '{%s}:%s' % (tag, key)
+
+        if self.key_prefix:
+            return '%s:%s' % (self.key_prefix, key)
+        return key
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, value):
+        return pickle.loads(value)
+
+    def get(self, key):
+        value = self.client.get(self.make_key(key))
+        return self.decode(value) if value is not None else None
+
+    def get_from_replica(self, key):
+        # a key missing from the replica is read again from the primary, so unknown and
+        # forged tokens cost two reads, REJECTED_TOKENS_CACHE turns their repeats away
+        if self.replicas is None:
+            return self.get(key)
+
+        value = self.replicas.get(self.make_key(key))
+        if value is None:
+            # missing, or written too recently to have reached the replica
+            return self.get(key)
+        return self.decode(value)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        redis_keys = [self.make_key(key) for key in keys]
+        # keys of different users are in different slots of a cluster
+        values = self.client.mget_nonatomic(redis_keys) if self.cluster else self.client.mget(redis_keys)
+        return dict((key, self.decode(value)) for key, value in zip(keys, values) if value is not None)
+
+    def set(self, key, value, timeout):
+        self.client.set(self.make_key(key), self.encode(value), ex=timeout)
+
+    def delete(self, key):
+        self.client.delete(self.make_key(key))
+
+    def delete_many(self, keys):
+        if keys:
+            self.client.delete(*[self.make_key(key) for key in keys])
+
+    def ttl(self, key):
+        # same values as the ttl() of django-redis-cache
+        ttl = self.client.ttl(self.make_key(key))
+        if ttl == -1:
+            return None
+        return max(ttl, 0)
+
+    def expire(self, key, timeout):
+        self.client.expire(self.make_key(key), timeout)
+
+    def persist(self, key):
+        self.client.persist(self.make_key(key))
+
+    def clear(self):
+        if not self.key_prefix:
+            self.client.flushdb()
+            return
+
+        keys = list(self.client.scan_iter(match='%s:*' % self.key_prefix, count=1000))
+        if keys:
+            self.client.delete(*keys)
+
+
+class CompactRedisStorage(RedisStorage):
+    """
+    ``RedisStorage`` with a smaller memory footprint. Tokens are keyed by the first
+    16 bytes of the SHA-256 of their hash instead of the ~90 character hash, and
+    strings, like the user pk stored for each token, are written as plain UTF-8.
+    Other values, like lists of token keys and user cache snapshots, are still pickled.
+
+    With ``hash_tags``, v1 tokens are keyed by their id, which holds the tag of their user.
+    """
+
+    TOKEN_KEY_LENGTH = 16
+
+    def token_key(self, hash):
+        if self.hash_tags and hash.startswith(V1_KEY_PREFIX):
+            return hash.encode()
+        return hashlib.sha256(hash.encode()).digest()[:self.TOKEN_KEY_LENGTH]
+
+    def parse_index_member(self, member):
+        return member
+
+    def make_key(self, key):
+        if not isinstance(key, bytes):
+            return super(CompactRedisStorage, self).make_key(key)
+
+        if self.hash_tags:
+            tag = get_hash_tag(key)
+            if tag is not None:
+                key = b'{' + tag.encode() + b'}:' + key
+
+        if self.key_prefix:
+            return self.key_prefix.encode() + b':' + key
+        return key
+
+    def encode(self, value):
+        if isinstance(value, int):
+            value = str(value)
+        if isinstance(value, str):
+            return value.encode()
+        return super(CompactRedisStorage, self).encode(value)
+
+    def decode(self, value):
+        # pickles start with the PROTO opcode, which is never the first byte of UTF-8 text
+        if value[:1] == pickle.PROTO:
+            return super(CompactRedisStorage, self).decode(value)
+        return value.decode()
+
+
+class ShardedRedisStorage:
+    """
+    Tokens spread over several Redis servers, one ``RedisStorage`` per URL of ``urls``.
+
+    Keys are placed on a consistent hash ring by their hash tag, so a user's index and
+    its v1 tokens are on the same shard, and the shard of a token is found from its id.
+    ``urls`` is a list of URLs or a dict of shard names to URLs. Shards are placed on the
+    ring by name, a list uses the URLs as names. Adding a shard moves about ``1 / shards``
+    of the users, see the ``rebalance_tokens`` command.
+    """
+
+    shard_class = RedisStorage
+    cluster = False
+    # the storage has no single client, use get_client()
+    client = None
+    # points per shard on the hash ring, more points spread users more evenly
+    RING_REPLICAS = 160
+
+    def __init__(self, urls, key_prefix='', **connection_options):
+        if drt_settings.TOKEN_FORMAT != V1_TOKEN_FORMAT:
+            raise ImproperlyConfigured(
+                'ShardedRedisStorage requires TOKEN_FORMAT "mt1", legacy tokens don\'t say which shard they are on.'
+            )
+
+        if connection_options.get('replica_urls'):
+            raise ImproperlyConfigured(
+                'ShardedRedisStorage doesn\'t support REPLICA_URLS, every shard would read from the replicas of one server.'
+            )
+
+        if not isinstance(urls, dict):
+            urls = dict((url, url) for url in urls)
+
+        self.key_prefix = key_prefix
+        self.shards = dict(
+            (name, self.shard_class(url, key_prefix=key_prefix, **dict(connection_options, hash_tags=True)))
+            for name, url in urls.items()
+        )
+        self._ring = sorted(
+            (_ring_position('%s#%d' % (name, i)), name)
+            for name in self.shards
+            for i in range(self.RING_REPLICAS)
+        )
+        self._ring_positions = [position for position, name in self._ring]
+
+    def get_shard(self, key):
+        tag = get_hash_tag(key)
+        if tag is None:
+            # legacy token keys, placed by themselves
+            tag = key.decode('latin-1') if isinstance(key, bytes) else str(key)
+        return self._get_shard_by_tag(tag)
+
+    def get_shard_of_redis_key(self, redis_key):
+        """
+        Return the shard that ``redis_key``, a key read from Redis, belongs on.
+        """
+        if isinstance(redis_key, bytes):
+            redis_key = redis_key.decode('latin-1')
+        if self.key_prefix:
+            redis_key = redis_key[len(self.key_prefix) + 1:]
+
+        if redis_key.startswith('{'):
+            return self._get_shard_by_tag(redis_key[1:redis_key.index('}')])
+        # keys without a tag are placed by themselves
+        return self._get_shard_by_tag(redis_key)
+
+    def get_client(self, key):
+        return self.get_shard(key).client
+
+    def group_keys_by_client(self, keys):
+        return [(shard.client, shard_keys) for shard, shard_keys in self._group_keys(keys)]
+
+    def get_all_clients(self):
+        return [shard.client for shard in self.shards.values()]
+
+    def token_key(self, hash):
+        return self._any_shard.token_key(hash)
+
+    def parse_index_member(self, member):
+        return self._any_shard.parse_index_member(member)
+
+    def make_key(self, key):
+        return self._any_shard.make_key(key)
+
+    def encode(self, value):
+        return self._any_shard.encode(value)
+
+    def decode(self, value):
+        return self._any_shard.decode(value)
+
+    def get(self, key):
+        return self.get_shard(key).get(key)
+
+    def get_from_replica(self, key):
+        return self.get_shard(key).get_from_replica(key)
+
+    def get_many(self, keys):
+        values = {}
+        for shard, shard_keys in self._group_keys(keys):
+            values.update(shard.get_many(shard_keys))
+        return values
+
+    def set(self, key, value, timeout):
+        self.get_shard(key).set(key, value, timeout)
+
+    def delete(self, key):
+        self.get_shard(key).delete(key)
+
+    def delete_many(self, keys):
+        for shard, shard_keys in self._group_keys(keys):
+            shard.delete_many(shard_keys)
+
+    def ttl(self, key):
+        return self.get_shard(key).ttl(key)
+
+    def expire(self, key, timeout):
+        self.get_shard(key).expire(key, timeout)
+
+    def persist(self, key):
+        self.get_shard(key).persist(key)
+
+    def clear(self):
+        for shard in self.shards.values():
+            shard.clear()
+
+    def _get_shard_by_tag(self, tag):
+        i = bisect.bisect(self._ring_positions, _ring_position(tag)) % len(self._ring)
+        return self.shards[self._ring[i][1]]
+
+    @property
+    def _any_shard(self):
+        # keys and values are built the same way by all shards
+        return next(iter(self.shards.values()))
+
+    def _group_keys(self, keys):
+        groups = {}
+        for key in keys:
+            shard = self.get_shard(key)
+            groups.setdefault(id(shard), (shard, []))[1].append(key)
+        return list(groups.values())
+
+
+class ShardedCompactRedisStorage(ShardedRedisStorage):
+    """
+    ``ShardedRedisStorage`` whose shards are ``CompactRedisStorage``.
+    """
+
+    shard_class = CompactRedisStorage
+
+
+class ReplicaSet:
+    """
+    Read replicas of a Redis server, one of which serves each read.
+
+    ``'round_robin'`` takes the replicas in turn. ``'least_latency'`` takes the replica
+    with the lowest moving average of read latency, and every ``PROBE_EVERY`` reads the
+    next one in turn, so that the latency of the others is kept up to date. A replica
+    that fails is treated as very slow, and the read is reported as missing so that it's
+    done on the primary.
+    """
+
+    PROBE_EVERY = 20
+    # weight of the latest read in the moving average
+    LATENCY_WEIGHT = 0.2
+    FAILED_LATENCY = 60.0
+
+    def __init__(self, urls, selection=ROUND_ROBIN, **connection_options):
+        if selection not in (ROUND_ROBIN, LEAST_LATENCY):
+            raise ImproperlyConfigured('Unknown replica selection: %s' % selection)
+
+        self.selection = selection
+        self.clients = [
+            redis.StrictRedis(connection_pool=redis.ConnectionPool.from_url(url, **connection_options))
+            for url in urls
+        ]
+        for client in self.clients:
+            measure_client(client)
+        self.latencies = [0.0] * len(self.clients)
+        self._reads = itertools.count()
+        self._probes = itertools.count()
+
+    def get(self, redis_key):
+        i = self._select()
+        started = now()
+        try:
+            value = self.clients[i].get(redis_key)
+        except redis.RedisError:
+            self.latencies[i] = self.FAILED_LATENCY
+            return None
+
+        latency = now() - started
+        self.latencies[i] += self.LATENCY_WEIGHT * (latency - self.latencies[i])
+        return value
+
+    def _select(self):
+        if self.selection == ROUND_ROBIN:
+            return next(self._reads) % len(self.clients)
+
+        if next(self._reads) % self.PROBE_EVERY == 0:
+            return next(self._probes) % len(self.clients)
+        return min(range(len(self.clients)), key=self.latencies.__getitem__)
+
+
+def get_hash_tag(key):
+    """
+    Return the hash tag of a logical key, or ``None`` for the keys of legacy tokens.
+
+    v1 token keys are tagged with the user tag their id starts with, the devices of a
+    user with the tag of the user, other keys, like user pks, with their own tag. The
+    hashes legacy tokens are stored under don't say which user they belong to, so they
+    can't be put next to the user's index.
+    """
+    if isinstance(key, bytes):
+        if not key.startswith(V1_KEY_PREFIX.encode()):
+            # digests of CompactRedisStorage
+            return None
+        key = key.decode()
+    else:
+        key = str(key)
+
+    if key.startswith(DEVICES_KEY_PREFIX):
+        key = key[len(DEVICES_KEY_PREFIX):]
+    if key.startswith(V1_KEY_PREFIX):
+        return key[len(V1_KEY_PREFIX):len(V1_KEY_PREFIX) + USER_TAG_LENGTH]
+    if not key or key.startswith('$'):
+        return None
+    return make_user_tag(key)
+
+
+def _ring_position(value):
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+
+def get_storage():
+    """
+    Build the storage backend configured by the ``STORAGE`` setting.
+    """
+    storage_settings = drt_settings.STORAGE
+    if not storage_settings:
+        return DjangoCacheStorage(drt_settings.REDIS_DB_NAME)
+
+    storage_class = import_string(storage_settings.get('BACKEND', REDIS_STORAGE))
+    options = dict(storage_settings.get('OPTIONS', {}))
+    # only passed when set, for backends that don't take them
+    if storage_settings.get('HASH_TAGS'):
+        options['hash_tags'] = True
+    if storage_settings.get('CLUSTER'):
+        options['cluster'] = True
+    if storage_settings.get('REPLICA_URLS'):
+        options['replica_urls'] = storage_settings['REPLICA_URLS']
+        options['replica_selection'] = storage_settings.get('REPLICA_SELECTION', ROUND_ROBIN)
+
+    return storage_class(
+        storage_settings['URL'],
+        key_prefix=storage_settings.get('KEY_PREFIX', ''),
+        **options
+    )
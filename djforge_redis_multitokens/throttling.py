@@ -0,0 +1,116 @@
+"""
+Limits on failed authentications, see ``FAILED_AUTH_LIMIT_PER_IP`` and ``FAILED_AUTH_LIMIT_PER_TOKEN``.
+
+Failures are counted in the tokens storage, under keys that expire ``FAILED_AUTH_WINDOW``
+seconds after the first failure. A client or token over its limit is rejected before its
+token is looked up or hashed. Each process also remembers the counters it saw over their
+limit, and rejects their requests without asking Redis until the window ends.
+"""
+import hashlib
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import exceptions
+from rest_framework.throttling import BaseThrottle
+
+from .local_cache import _now, LocalTTLCache
+from .redis_utils import run_script
+from .scripts import INCR_WITH_EXPIRY
+from .settings import djforge_redis_multitokens_settings as drt_settings
+from .utils import parse_token, WRONG_HASH
+
+
+IP_COUNTER_PREFIX = 'failed_auth:ip:'
+TOKEN_COUNTER_PREFIX = 'failed_auth:token:'
+COUNTER_PREFIXES = (IP_COUNTER_PREFIX, TOKEN_COUNTER_PREFIX)
+
+BLOCKED_COUNTERS_CACHE_SIZE = 10000
+
+
+class FailedAuthThrottle:
+
+    def __init__(self, storage):
+        self.storage = storage
+        # counter key -> end of the window, on the clock of LocalTTLCache
+        self._blocked = LocalTTLCache(BLOCKED_COUNTERS_CACHE_SIZE, None)
+
+    @property
+    def enabled(self):
+        return bool(drt_settings.FAILED_AUTH_LIMIT_PER_IP or drt_settings.FAILED_AUTH_LIMIT_PER_TOKEN)
+
+    def get_ident(self, request):
+        # the client's IP, from X-Forwarded-For when REST framework's NUM_PROXIES is set
+        return BaseThrottle().get_ident(request)
+
+    def get_counters(self, ident, full_token):
+        """
+        Return ``(counter key, limit)`` pairs for the client ``ident`` and the token.
+        """
+        counters = []
+        if ident and drt_settings.FAILED_AUTH_LIMIT_PER_IP:
+            counters.append((IP_COUNTER_PREFIX + ident, drt_settings.FAILED_AUTH_LIMIT_PER_IP))
+
+        key_name = parse_token(full_token)[1]
+        if key_name != WRONG_HASH and drt_settings.FAILED_AUTH_LIMIT_PER_TOKEN:
+            # the part of the token that names its key, the hash or the id, stays the same
+            # while the secret is guessed
+            digest = hashlib.sha256(key_name.encode()).hexdigest()[:32]
+            counters.append((TOKEN_COUNTER_PREFIX + digest, drt_settings.FAILED_AUTH_LIMIT_PER_TOKEN))
+
+        return counters
+
+    def check(self, counters):
+        """
+        Raise ``Throttled`` if one of the counters is over its limit.
+        """
+        for key, limit in counters:
+            blocked_until = self._blocked.get(key)
+            if blocked_until is not None and blocked_until > _now():
+                raise exceptions.Throttled(wait=blocked_until - _now())
+
+        counts = self._get_counts([key for key, limit in counters])
+        for key, limit in counters:
+            if counts.get(key, 0) >= limit:
+                self._block(key)
+                raise exceptions.Throttled(wait=drt_settings.FAILED_AUTH_WINDOW)
+
+    def record_failure(self, counters):
+        window = drt_settings.FAILED_AUTH_WINDOW
+        limits = dict(counters)
+
+        for client, keys in self._group_keys_by_client(list(limits)):
+            redis_keys = [self.storage.make_key(key) for key in keys]
+            if self.storage.cluster:
+                # the counters are in different slots
+                counts = [run_script(client, INCR_WITH_EXPIRY, [redis_key], [window])[0] for redis_key in redis_keys]
+            else:
+                counts = run_script(client, INCR_WITH_EXPIRY, redis_keys, [window])
+
+            for key, count in zip(keys, counts):
+                if count >= limits[key]:
+                    self._block(key)
+
+    def _get_counts(self, keys):
+        counts = {}
+        for client, client_keys in self._group_keys_by_client(keys):
+            pipe = client.pipeline(transaction=False)
+            for key in client_keys:
+                pipe.get(self.storage.make_key(key))
+
+            for key, count in zip(client_keys, pipe.execute()):
+                if count is not None:
+                    counts[key] = int(count)
+        return counts
+
+    def _group_keys_by_client(self, keys):
+        groups = self.storage.group_keys_by_client(keys)
+        if any(client is None for client, client_keys in groups):
+            raise ImproperlyConfigured(
+                'FAILED_AUTH_LIMIT_PER_IP and FAILED_AUTH_LIMIT_PER_TOKEN require a storage that exposes a redis-py client.'
+            )
+        return groups
+
+    def _block(self, key):
+        self._blocked.set(key, _now() + drt_settings.FAILED_AUTH_WINDOW)
+
+    def clear(self):
+        self._blocked.clear()
@@ -1,15 +1,133 @@
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import threading
+import time
+
 from django.conf import settings
-from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.contrib.auth import get_user_model
+from django.db import router
+from django.utils.functional import SimpleLazyObject
 from rest_framework import exceptions
 from rest_framework.authentication import TokenAuthentication
+from redis.exceptions import ResponseError
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport, batches are verified on the calling thread
+    ThreadPoolExecutor = None
 
-from .crypto import generate_new_hashed_token, verify_token
+from .crypto import generate_new_hashed_token, generate_new_v1_token, verify_token
+from .local_cache import LocalTTLCache
+from .metrics import get_metrics_callback, now, RedisStats
+from .redis_utils import run_script
+from .refresher import TTLRefresher
+from .scripts import ADD_TO_TOKEN_SET, LIST_DEVICES, RESET_TTL, SET_IF_UNCHANGED, TOUCH_DEVICE
 from .settings import djforge_redis_multitokens_settings as drt_settings
-from .utils import parse_full_token
+from .signals import connect_user_cache_invalidation
+from .storage import get_storage
+from .throttling import FailedAuthThrottle
+from .utils import (
+    DEVICES_KEY_PREFIX,
+    LAST_SEEN_FIELD_PREFIX,
+    make_last_seen_field,
+    parse_token,
+    V1_KEY_PREFIX,
+    V1_TOKEN_FORMAT,
+    WRONG_HASH,
+)
+
+
+# built on first use, so importing the library doesn't open connections to Redis
+TOKENS_STORAGE = SimpleLazyObject(get_storage)
+# the Django cache behind the default storage, None with other STORAGE backends
+TOKENS_CACHE = None if drt_settings.STORAGE else SimpleLazyObject(lambda: TOKENS_STORAGE.cache)
+
+# counts failed authentications when FAILED_AUTH_LIMIT_PER_IP or FAILED_AUTH_LIMIT_PER_TOKEN is set
+FAILED_AUTH_THROTTLE = FailedAuthThrottle(TOKENS_STORAGE)
+
+LIST_INDEX = 'list'
+SET_INDEX = 'set'
+
+LOCAL_USER_CACHE = 'local'
+REDIS_USER_CACHE = 'redis'
+USER_CACHE_KEY_PREFIX = 'user:'
+
+# failure reasons reported by get_users_from_tokens
+INVALID_TOKEN = 'invalid_token'
+UNKNOWN_USER = 'unknown_user'
+
+RECENTLY_REFRESHED_USERS_CACHE_SIZE = 100000
+RECENTLY_WRITTEN_TOKENS_CACHE_SIZE = 100000
+RECENTLY_SEEN_TOKENS_CACHE_SIZE = 100000
+
+# token key -> token pairs that already passed verify_token in this process
+VERIFIED_TOKENS_CACHE = LocalTTLCache(
+    drt_settings.VERIFIED_TOKENS_CACHE_SIZE,
+    drt_settings.VERIFIED_TOKENS_CACHE_TTL,
+)
+
+# digests of tokens rejected by get_user_pk_from_token in this process, turned away
+# without touching Redis while they're cached
+REJECTED_TOKENS_CACHE = LocalTTLCache(
+    drt_settings.REJECTED_TOKENS_CACHE_SIZE,
+    drt_settings.REJECTED_TOKENS_CACHE_TTL,
+)
+
+# pks of users whose tokens were refreshed less than TTL_REFRESH_INTERVAL seconds ago
+RECENTLY_REFRESHED_USERS = LocalTTLCache(
+    RECENTLY_REFRESHED_USERS_CACHE_SIZE if drt_settings.TTL_REFRESH_INTERVAL else 0,
+    drt_settings.TTL_REFRESH_INTERVAL,
+)
+
+# keys of tokens created or expired by this process less than READ_YOUR_WRITES_WINDOW
+# seconds ago, read from the primary rather than from a replica that may lag behind
+RECENTLY_WRITTEN_TOKENS = LocalTTLCache(
+    RECENTLY_WRITTEN_TOKENS_CACHE_SIZE if drt_settings.READ_YOUR_WRITES_WINDOW else 0,
+    drt_settings.READ_YOUR_WRITES_WINDOW,
+)
+
+# keys of tokens whose last-seen time was updated by this process less than
+# DEVICE_LAST_SEEN_INTERVAL seconds ago
+RECENTLY_SEEN_TOKENS = LocalTTLCache(
+    RECENTLY_SEEN_TOKENS_CACHE_SIZE if drt_settings.DEVICE_LAST_SEEN_INTERVAL else 0,
+    drt_settings.DEVICE_LAST_SEEN_INTERVAL,
+)
+
+# user pk -> snapshot of the user's fields, used when USER_CACHE is 'local'
+LOCAL_USERS_CACHE = LocalTTLCache(
+    drt_settings.USER_CACHE_SIZE,
+    drt_settings.USER_CACHE_TTL,
+)
 
 
-TOKENS_CACHE = caches[drt_settings.REDIS_DB_NAME]
+class LazyUser(SimpleLazyObject):
+    """
+    Authenticated user that is only loaded from the database when an attribute
+    other than its pk or ``is_active`` is accessed.
+    """
+
+    def __init__(self, pk, is_active):
+        user_model = get_user_model()
+
+        # set on the proxy itself so reading them doesn't load the user
+        self.__dict__['pk'] = pk
+        self.__dict__[user_model._meta.pk.attname] = pk
+        self.__dict__['is_active'] = is_active
+        self.__dict__['is_authenticated'] = True
+        self.__dict__['is_anonymous'] = False
+
+        super(LazyUser, self).__init__(lambda: user_model.objects.get(pk=pk))
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
 
 
 class MultiToken:
@@ -19,97 +137,894 @@ class MultiToken:
         self.user = user
 
     @classmethod
-    def create_token(cls, user):
-        created = False
-        token, hash, full_token = generate_new_hashed_token()
-        tokens = TOKENS_CACHE.get(user.pk)
+    def create_token(cls, user, device=None):
+        """
+        Create a new token for ``user``. ``device`` is an optional dict of JSON
+        serializable metadata, like a user agent or a label, listed by ``list_tokens``.
+        """
+        full_token, key_name, value = cls._generate_token(user.pk)
+        token_key = TOKENS_STORAGE.token_key(key_name)
 
-        if not tokens:
-            tokens = [hash]
-            created = True
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            created, evicted_hashes = cls._add_to_token_set(user.pk, token_key)
         else:
-            tokens.append(hash)
+            created, evicted_hashes = cls._add_to_token_list(user.pk, token_key)
+
+        cls._set_key_value(token_key, value)
+        RECENTLY_WRITTEN_TOKENS.set(token_key, True)
 
-        cls._set_key_value(str(user.pk), tokens)
-        cls._set_key_value(hash, str(user.pk))
+        if device is not None:
+            cls._add_device(user.pk, token_key, device)
+
+        # tokens over MAX_TOKENS_PER_USER were already removed from the index
+        if evicted_hashes:
+            cls._delete_keys(evicted_hashes)
+            for h in evicted_hashes:
+                VERIFIED_TOKENS_CACHE.delete(h)
 
         return MultiToken(full_token, user), created
 
     @classmethod
-    def get_user_from_token(cls, full_token):
-        token, hash = parse_full_token(full_token)
-        if verify_token(token, hash):
-            user = get_user_model().objects.get(pk=TOKENS_CACHE.get(hash))
-            return user
+    def list_tokens(cls, user):
+        """
+        Return the metadata of the user's live tokens created with a ``device``, oldest
+        first. Each entry has a ``created_at`` and a ``last_seen`` timestamp, and the
+        ``token_id`` that ``expire_token_by_id`` takes.
+        """
+        client = cls._get_devices_client(user.pk)
+        key = TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user.pk))
+
+        if TOKENS_STORAGE.cluster:
+            # scripts can only access the keys they're given, legacy tokens are in other slots
+            fields = client.hgetall(key)
+            token_redis_keys = [
+                field for field in fields if not field.startswith(LAST_SEEN_FIELD_PREFIX.encode())
+            ]
+            pipe = client.pipeline(transaction=False)
+            for token_redis_key in token_redis_keys:
+                pipe.exists(token_redis_key)
+            live = pipe.execute()
+
+            dead_fields = []
+            entries = []
+            for token_redis_key, exists in zip(token_redis_keys, live):
+                last_seen_field = make_last_seen_field(token_redis_key)
+                if exists:
+                    entries.append((token_redis_key, fields[token_redis_key], fields.get(last_seen_field)))
+                else:
+                    dead_fields.extend([token_redis_key, last_seen_field])
+            if dead_fields:
+                client.hdel(key, *dead_fields)
         else:
+            fields = run_script(client, LIST_DEVICES, [key], [LAST_SEEN_FIELD_PREFIX])
+            entries = zip(fields[::3], fields[1::3], fields[2::3])
+
+        devices = []
+        for token_redis_key, entry, last_seen in entries:
+            device = json.loads(entry.decode())
+            if last_seen:
+                device['last_seen'] = int(last_seen)
+            device['token_id'] = _make_token_id(token_redis_key)
+            devices.append(device)
+        return sorted(devices, key=lambda device: device['created_at'])
+
+    @classmethod
+    def expire_token_by_id(cls, user, token_id):
+        """
+        Expire the token of ``user`` listed with ``token_id`` by ``list_tokens``, like
+        ``expire_token`` does with the token itself. Returns whether it was found.
+        """
+        for token_key in cls._get_user_hashes(user.pk):
+            if hmac.compare_digest(_make_token_id(TOKENS_STORAGE.make_key(token_key)), token_id):
+                cls._expire_token_key(user.pk, token_key)
+                return True
+        return False
+
+    @classmethod
+    def get_user_from_token(cls, full_token):
+        return cls._get_user(cls.get_user_pk_from_token(full_token))
+
+    @classmethod
+    def get_lazy_user_from_token(cls, full_token):
+        """
+        Like ``get_user_from_token``, but returns a ``LazyUser`` when the user's
+        ``is_active`` flag is in the user cache, so the database is only queried
+        if an attribute other than the pk or ``is_active`` is accessed.
+        """
+        user_pk = cls.get_user_pk_from_token(full_token)
+
+        snapshot = cls._get_cached_user_snapshot(user_pk) if drt_settings.USER_CACHE else None
+        if snapshot is None:
+            return cls._get_user(user_pk)
+
+        return LazyUser(user_pk, snapshot['is_active'])
+
+    @classmethod
+    def get_users_from_tokens(cls, full_tokens):
+        """
+        Authenticate many tokens at once, with one ``MGET`` per Redis server and one
+        database query. Hashes are verified on ``BATCH_VERIFY_WORKERS`` threads.
+
+        Returns ``(users, failures)``: ``users`` maps each valid token to its user and
+        ``failures`` maps every other token to ``INVALID_TOKEN`` or ``UNKNOWN_USER``.
+        """
+        users, failures = {}, {}
+        # token -> (token key, secret, hash or None for v1 tokens)
+        parsed = {}
+
+        for full_token in full_tokens:
+            if full_token in parsed or full_token in failures:
+                continue
+
+            token, key_name, hash = parse_token(full_token)
+            if key_name == WRONG_HASH or REJECTED_TOKENS_CACHE.get(hashlib.sha256(full_token.encode()).digest()):
+                failures[full_token] = INVALID_TOKEN
+            else:
+                parsed[full_token] = (TOKENS_STORAGE.token_key(key_name), token, hash)
+
+        values = TOKENS_STORAGE.get_many(list(set(token_key for token_key, token, hash in parsed.values())))
+
+        # (token, secret, stored hash, token key, user pk) of the tokens found in Redis
+        candidates = []
+        for full_token, (token_key, token, hash) in parsed.items():
+            value = values.get(token_key)
+            if value is None:
+                failures[full_token] = INVALID_TOKEN
+            elif hash is None:
+                hash, user_pk = _split_v1_value(value)
+                candidates.append((full_token, token, hash, token_key, user_pk))
+            else:
+                candidates.append((full_token, token, hash, token_key, value))
+
+        verified = _map_verify(
+            lambda candidate: cls._verify_token(candidate[1], candidate[2], candidate[3]), candidates,
+        )
+
+        user_pks = {}
+        for (full_token, token, hash, token_key, user_pk), valid in zip(candidates, verified):
+            if valid:
+                user_pks[full_token] = get_user_model()._meta.pk.to_python(user_pk)
+            else:
+                REJECTED_TOKENS_CACHE.set(hashlib.sha256(full_token.encode()).digest(), True)
+                failures[full_token] = INVALID_TOKEN
+
+        loaded_users = cls._get_users(set(user_pks.values()))
+        for full_token, user_pk in user_pks.items():
+            if user_pk in loaded_users:
+                users[full_token] = loaded_users[user_pk]
+            else:
+                failures[full_token] = UNKNOWN_USER
+
+        return users, failures
+
+    @classmethod
+    def get_user_pk_from_token(cls, full_token):
+        rejected_key = hashlib.sha256(full_token.encode()).digest()
+        if REJECTED_TOKENS_CACHE.get(rejected_key):
             raise get_user_model().DoesNotExist
 
+        user_pk = cls._get_verified_user_pk(full_token)
+        if user_pk is None:
+            REJECTED_TOKENS_CACHE.set(rejected_key, True)
+            raise get_user_model().DoesNotExist
+
+        return get_user_model()._meta.pk.to_python(user_pk)
+
     @classmethod
     def expire_token(cls, full_token):
-        token, hash = parse_full_token(full_token.key)
-        user_pk = TOKENS_CACHE.get(hash)
-        tokens = TOKENS_CACHE.get(user_pk)
+        token, key_name, hash = parse_token(full_token.key)
+        token_key = TOKENS_STORAGE.token_key(key_name)
+        user_pk = TOKENS_STORAGE.get(token_key)
+
+        if user_pk is not None and hash is None:
+            user_pk = _split_v1_value(user_pk)[1]
+        cls._expire_token_key(user_pk, token_key)
 
-        if tokens and hash in tokens:
-            tokens.remove(hash)
-            cls._set_key_value(str(user_pk), tokens)
+    @classmethod
+    def _expire_token_key(cls, user_pk, token_key):
+        # user_pk is None when the token is already gone
+        if user_pk is not None:
+            cls._remove_from_index(user_pk, [token_key])
+
+            client = TOKENS_STORAGE.get_client(user_pk)
+            if client is not None:
+                token_redis_key = TOKENS_STORAGE.make_key(token_key)
+                client.hdel(
+                    TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user_pk)),
+                    token_redis_key, make_last_seen_field(token_redis_key),
+                )
 
-        TOKENS_CACHE.delete(hash)
+        TOKENS_STORAGE.delete(token_key)
+        VERIFIED_TOKENS_CACHE.delete(token_key)
+        RECENTLY_WRITTEN_TOKENS.set(token_key, True)
 
     @classmethod
     def expire_all_tokens(cls, user):
-        hashed_tokens = TOKENS_CACHE.get(user.pk)
-        for h in hashed_tokens:
-            TOKENS_CACHE.delete(h)
+        cls.expire_all_tokens_for_users([user.pk])
+
+    @classmethod
+    def expire_all_tokens_for_users(cls, users, chunk_size=1000):
+        """
+        Expire all tokens of many users. ``users`` is a queryset of users or an iterable of user pks.
 
-        TOKENS_CACHE.delete(user.pk)
+        Users are processed ``chunk_size`` at a time, with two Redis round trips per chunk.
+        """
+        if hasattr(users, 'values_list'):
+            users = users.values_list('pk', flat=True).iterator()
+
+        for user_pks in _chunks(users, chunk_size):
+            hashes_by_user = cls._get_many_user_hashes(user_pks)
+            hashed_tokens = list(itertools.chain.from_iterable(hashes_by_user.values()))
+
+            devices_keys = [DEVICES_KEY_PREFIX + str(user_pk) for user_pk in user_pks]
+            cls._delete_keys(user_pks + hashed_tokens + devices_keys)
+            for h in hashed_tokens:
+                VERIFIED_TOKENS_CACHE.delete(h)
 
     @classmethod
     def reset_tokens_ttl(cls, user_pk):
-        cls._reset_token_ttl(user_pk)
+        if drt_settings.TTL_REFRESH_INTERVAL:
+            if RECENTLY_REFRESHED_USERS.get(str(user_pk)):
+                return
+            RECENTLY_REFRESHED_USERS.set(str(user_pk), True)
+
+        timeout = cls._get_user_provided_ttl()
+        refresh_below = cls._get_ttl_refresh_threshold(timeout)
+        hashed_tokens = cls._get_user_hashes(user_pk)
+        client = TOKENS_STORAGE.get_client(user_pk)
+
+        if client is None:
+            # TTL_REFRESH_THRESHOLD isn't checked, that would take a TTL call per key before any refresh
+            cls._reset_token_ttl(user_pk)
+            for h in hashed_tokens:
+                cls._reset_token_ttl(h)
+            return
+
+        # refresh the user key and all of its tokens in one round trip
+        keys = cls._get_reset_ttl_keys(user_pk, hashed_tokens)
+        missing_keys = run_script(client, RESET_TTL, keys, cls._get_reset_ttl_script_args(timeout, refresh_below))
+        cls._prune_missing_keys(user_pk, hashed_tokens, missing_keys)
+
+    @classmethod
+    def reset_tokens_ttl_many(cls, user_pks):
+        """
+        Refresh the tokens of many users with two Redis round trips per server, on a
+        Redis Cluster with one round trip per user.
+        """
+        for client, client_user_pks in TOKENS_STORAGE.group_keys_by_client(user_pks):
+            if client is None:
+                for user_pk in client_user_pks:
+                    cls.reset_tokens_ttl(user_pk)
+            else:
+                cls._reset_tokens_ttl_many(client, client_user_pks)
+
+    @classmethod
+    def prune_user_index(cls, user_pk):
+        """
+        Remove the hashes of tokens that expired on their own from the user's index.
+
+        Returns the removed hashes.
+        """
+        hashed_tokens = cls._get_user_hashes(user_pk)
+        if not hashed_tokens:
+            return []
 
-        hashed_tokens = TOKENS_CACHE.get(user_pk)
-        for h in hashed_tokens:
-            cls._reset_token_ttl(h)
+        live_hashes = TOKENS_STORAGE.get_many(hashed_tokens)
+        dangling_hashes = [h for h in hashed_tokens if h not in live_hashes]
+        if dangling_hashes:
+            cls._remove_from_index(user_pk, dangling_hashes)
+
+        return dangling_hashes
+
+    @classmethod
+    def invalidate_cached_user(cls, user_pk):
+        """
+        Drop the cached snapshot of a user. This happens automatically when the user
+        is saved or deleted, call it after changes that skip signals like ``QuerySet.update``.
+        """
+        if drt_settings.USER_CACHE == REDIS_USER_CACHE:
+            TOKENS_STORAGE.delete(USER_CACHE_KEY_PREFIX + str(user_pk))
+        elif drt_settings.USER_CACHE == LOCAL_USER_CACHE:
+            LOCAL_USERS_CACHE.delete(str(user_pk))
+
+    @classmethod
+    def migrate_user_index(cls, user_pk):
+        """
+        Convert the pickled list of hashes stored for ``user_pk`` to a sorted set.
+
+        Returns ``True`` if the user's index was migrated.
+        """
+        client = cls._get_token_set_client(user_pk)
+        key = TOKENS_STORAGE.make_key(user_pk)
+
+        def migrate(pipe):
+            if pipe.type(key) != b'string':
+                return False
+
+            hashes = TOKENS_STORAGE.get(user_pk) or []
+            ttl = pipe.ttl(key)
+
+            pipe.multi()
+            pipe.delete(key)
+            if hashes:
+                # keep the creation order, older than any token created from now on
+                pipe.zadd(key, dict((h, i) for i, h in enumerate(hashes)))
+                if ttl > 0:
+                    pipe.expire(key, ttl)
+            return True
+
+        return client.transaction(migrate, key, value_from_callable=True)
+
+    @classmethod
+    def _generate_token(cls, user_pk):
+        """
+        Return a new token for the configured ``TOKEN_FORMAT``, the name it's stored
+        under and the value stored for it.
+        """
+        if drt_settings.TOKEN_FORMAT == V1_TOKEN_FORMAT:
+            secret, token_id, hash, full_token = generate_new_v1_token(user_pk)
+            return full_token, V1_KEY_PREFIX + token_id, _make_v1_value(hash, user_pk)
+
+        token, hash, full_token = generate_new_hashed_token()
+        return full_token, hash, str(user_pk)
+
+    @classmethod
+    def _get_user(cls, user_pk):
+        callback = get_metrics_callback()
+        if callback is None:
+            return cls._load_user(user_pk)
+
+        started = now()
+        try:
+            return cls._load_user(user_pk)
+        finally:
+            callback('user_lookup.time', now() - started, {})
+
+    @classmethod
+    def _load_user(cls, user_pk):
+        user_model = get_user_model()
+        if not drt_settings.USER_CACHE:
+            return user_model.objects.get(pk=user_pk)
+
+        snapshot = cls._get_cached_user_snapshot(user_pk)
+        if snapshot is not None:
+            # fields left out of the snapshot, like the password, are deferred
+            return user_model.from_db(router.db_for_read(user_model), list(snapshot), list(snapshot.values()))
+
+        user = user_model.objects.get(pk=user_pk)
+        cls._cache_user_snapshot(user)
+        return user
+
+    @classmethod
+    def _get_users(cls, user_pks):
+        """
+        Return a dict of the users with the given pks that exist, loaded with one query.
+        """
+        user_model = get_user_model()
+        users = {}
+
+        if drt_settings.USER_CACHE == REDIS_USER_CACHE:
+            snapshots = TOKENS_STORAGE.get_many([USER_CACHE_KEY_PREFIX + str(user_pk) for user_pk in user_pks])
+            snapshots = dict((user_pk, snapshots.get(USER_CACHE_KEY_PREFIX + str(user_pk))) for user_pk in user_pks)
+        elif drt_settings.USER_CACHE == LOCAL_USER_CACHE:
+            snapshots = dict((user_pk, LOCAL_USERS_CACHE.get(str(user_pk))) for user_pk in user_pks)
+        else:
+            snapshots = {}
+
+        db = router.db_for_read(user_model)
+        for user_pk, snapshot in snapshots.items():
+            if snapshot is not None:
+                users[user_pk] = user_model.from_db(db, list(snapshot), list(snapshot.values()))
+
+        missing_pks = [user_pk for user_pk in user_pks if user_pk not in users]
+        if missing_pks:
+            for user_pk, user in user_model.objects.in_bulk(missing_pks).items():
+                users[user_pk] = user
+                if drt_settings.USER_CACHE:
+                    cls._cache_user_snapshot(user)
+
+        return users
+
+    @classmethod
+    def _get_cached_user_snapshot(cls, user_pk):
+        if drt_settings.USER_CACHE == REDIS_USER_CACHE:
+            return TOKENS_STORAGE.get(USER_CACHE_KEY_PREFIX + str(user_pk))
+        return LOCAL_USERS_CACHE.get(str(user_pk))
+
+    @classmethod
+    def _cache_user_snapshot(cls, user):
+        field_names = drt_settings.USER_CACHE_FIELDS
+        snapshot = {}
+
+        for field in user._meta.concrete_fields:
+            if field_names is None:
+                cached = field.name != 'password'
+            else:
+                cached = field.primary_key or field.name == 'is_active' or field.name in field_names
+
+            if cached:
+                snapshot[field.attname] = getattr(user, field.attname)
+
+        if drt_settings.USER_CACHE == REDIS_USER_CACHE:
+            TOKENS_STORAGE.set(USER_CACHE_KEY_PREFIX + str(user.pk), snapshot, timeout=drt_settings.USER_CACHE_TTL)
+        else:
+            LOCAL_USERS_CACHE.set(str(user.pk), snapshot)
+
+    @classmethod
+    def _get_user_hashes(cls, user_pk):
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            client = cls._get_token_set_client(user_pk)
+            key = TOKENS_STORAGE.make_key(user_pk)
+            hashes = cls._run_on_token_set(user_pk, lambda: client.zrange(key, 0, -1))
+            return [TOKENS_STORAGE.parse_index_member(h) for h in hashes]
+
+        return TOKENS_STORAGE.get(user_pk) or []
+
+    @classmethod
+    def _remove_from_index(cls, user_pk, hashes):
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            cls._remove_from_token_set(user_pk, hashes)
+        else:
+            cls._remove_from_token_list(user_pk, hashes)
+
+    @classmethod
+    def _get_many_user_hashes(cls, user_pks):
+        if drt_settings.USER_TOKENS_INDEX == SET_INDEX:
+            hashes_by_user = {}
+            for _, client_user_pks in TOKENS_STORAGE.group_keys_by_client(user_pks):
+                client = cls._get_token_set_client(client_user_pks[0])
+                pipe = client.pipeline(transaction=False)
+                for user_pk in client_user_pks:
+                    pipe.zrange(TOKENS_STORAGE.make_key(user_pk), 0, -1)
+
+                for user_pk, hashes in zip(client_user_pks, pipe.execute(raise_on_error=False)):
+                    if isinstance(hashes, ResponseError):
+                        # not migrated to a sorted set yet
+                        hashes_by_user[user_pk] = TOKENS_STORAGE.get(user_pk) or []
+                    else:
+                        hashes_by_user[user_pk] = [TOKENS_STORAGE.parse_index_member(h) for h in hashes]
+            return hashes_by_user
+
+        return dict(
+            (user_pk, hashes or [])
+            for user_pk, hashes in TOKENS_STORAGE.get_many(user_pks).items()
+        )
+
+    @classmethod
+    def _reset_tokens_ttl_many(cls, client, user_pks):
+        timeout = cls._get_user_provided_ttl()
+        args = cls._get_reset_ttl_script_args(timeout, cls._get_ttl_refresh_threshold(timeout))
+
+        hashes_by_user = list(cls._get_many_user_hashes(user_pks).items())
+
+        if TOKENS_STORAGE.cluster:
+            # redis-py can't run scripts in cluster pipelines, each user's keys are in one slot
+            results = [
+                run_script(client, RESET_TTL, cls._get_reset_ttl_keys(user_pk, hashed_tokens), args)
+                for user_pk, hashed_tokens in hashes_by_user
+            ]
+        else:
+            pipe = client.pipeline(transaction=False)
+            for user_pk, hashed_tokens in hashes_by_user:
+                run_script(pipe, RESET_TTL, cls._get_reset_ttl_keys(user_pk, hashed_tokens), args)
+            results = pipe.execute()
+
+        for (user_pk, hashed_tokens), missing_keys in zip(hashes_by_user, results):
+            cls._prune_missing_keys(user_pk, hashed_tokens, missing_keys)
+
+    @classmethod
+    def _delete_keys(cls, keys):
+        for key in keys:
+            RECENTLY_WRITTEN_TOKENS.set(key, True)
+
+        for client, client_keys in TOKENS_STORAGE.group_keys_by_client(keys):
+            if client is None:
+                TOKENS_STORAGE.delete_many(client_keys)
+                continue
+
+            redis_keys = [TOKENS_STORAGE.make_key(key) for key in client_keys]
+            try:
+                # UNLINK frees memory in the background, Redis >= 4.0
+                client.unlink(*redis_keys)
+            except ResponseError:
+                client.delete(*redis_keys)
+
+    @classmethod
+    def _add_to_token_list(cls, user_pk, hash):
+        created = False
+        evicted_hashes = []
+        tokens = TOKENS_STORAGE.get(user_pk)
+
+        if not tokens:
+            tokens = [hash]
+            created = True
+        else:
+            tokens.append(hash)
+
+        # the list is in creation order, the oldest tokens come first
+        max_tokens = drt_settings.MAX_TOKENS_PER_USER
+        if max_tokens and len(tokens) > max_tokens:
+            evicted_hashes = tokens[:-max_tokens]
+            tokens = tokens[-max_tokens:]
+
+        cls._set_key_value(str(user_pk), tokens)
+
+        return created, evicted_hashes
+
+    @classmethod
+    def _remove_from_token_list(cls, user_pk, hashes):
+        client = TOKENS_STORAGE.get_client(user_pk)
+        if client is None:
+            # the cache API can't compare and set, a token created meanwhile may be dropped
+            tokens = TOKENS_STORAGE.get(user_pk)
+            if tokens:
+                remaining_tokens = [h for h in tokens if h not in hashes]
+                if len(remaining_tokens) != len(tokens):
+                    cls._set_key_value(str(user_pk), remaining_tokens)
+            return
+
+        key = TOKENS_STORAGE.make_key(user_pk)
+        timeout = cls._get_user_provided_ttl()
+
+        while True:
+            value = client.get(key)
+            if value is None:
+                return
+
+            tokens = TOKENS_STORAGE.decode(value)
+            remaining_tokens = [h for h in tokens if h not in hashes]
+            if len(remaining_tokens) == len(tokens):
+                return
+
+            # read again if create_token added a token since the list was read
+            args = [value, TOKENS_STORAGE.encode(remaining_tokens), '' if timeout is None else timeout]
+            if run_script(client, SET_IF_UNCHANGED, [key], args):
+                return
+
+    @classmethod
+    def _add_to_token_set(cls, user_pk, hash):
+        client = cls._get_token_set_client(user_pk)
+        key = TOKENS_STORAGE.make_key(user_pk)
+        args = [hash, time.time()] + cls._get_add_to_token_set_script_args()
+
+        count, evicted_hashes = cls._run_on_token_set(
+            user_pk, lambda: run_script(client, ADD_TO_TOKEN_SET, [key], args)
+        )
+        return count == 1, [TOKENS_STORAGE.parse_index_member(h) for h in evicted_hashes]
+
+    @classmethod
+    def _remove_from_token_set(cls, user_pk, hashes):
+        client = cls._get_token_set_client(user_pk)
+        key = TOKENS_STORAGE.make_key(user_pk)
+        cls._run_on_token_set(user_pk, lambda: client.zrem(key, *hashes))
+
+    @classmethod
+    def _run_on_token_set(cls, user_pk, operation):
+        try:
+            return operation()
+        except ResponseError as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+
+        # the user's index is still a pickled list written before switching to sets
+        cls.migrate_user_index(user_pk)
+        return operation()
+
+    @classmethod
+    def _add_device(cls, user_pk, token_key, device):
+        client = cls._get_devices_client(user_pk)
+        key = TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user_pk))
+        timeout = cls._get_user_provided_ttl()
+
+        pipe = client.pipeline(transaction=False)
+        pipe.hset(key, TOKENS_STORAGE.make_key(token_key), cls._encode_device(device))
+        # refreshed with the user's tokens by reset_tokens_ttl
+        if timeout is not None:
+            pipe.expire(key, timeout)
+        pipe.execute()
+
+    @classmethod
+    def _encode_device(cls, device):
+        device = dict(device)
+        device.setdefault('created_at', int(time.time()))
+        device.setdefault('last_seen', device['created_at'])
+        return json.dumps(device, separators=(',', ':'))
+
+    @classmethod
+    def _touch_device(cls, user_pk, full_token):
+        """
+        Update the last-seen time of the token's device, at most once per
+        ``DEVICE_LAST_SEEN_INTERVAL`` seconds per token and process.
+        """
+        token_key = TOKENS_STORAGE.token_key(parse_token(full_token)[1])
+        if RECENTLY_SEEN_TOKENS.get(token_key):
+            return
+        RECENTLY_SEEN_TOKENS.set(token_key, True)
+
+        client = TOKENS_STORAGE.get_client(user_pk)
+        if client is not None:
+            key = TOKENS_STORAGE.make_key(DEVICES_KEY_PREFIX + str(user_pk))
+            token_redis_key = TOKENS_STORAGE.make_key(token_key)
+            run_script(client, TOUCH_DEVICE, [key], [token_redis_key, make_last_seen_field(token_redis_key), int(time.time())])
+
+    @classmethod
+    def _get_devices_client(cls, user_pk):
+        client = TOKENS_STORAGE.get_client(user_pk)
+        if client is None:
+            raise ImproperlyConfigured('Device metadata requires a cache backend that exposes a redis-py client.')
+        return client
+
+    @classmethod
+    def _get_token_set_client(cls, user_pk):
+        client = TOKENS_STORAGE.get_client(user_pk)
+        if client is None:
+            raise ImproperlyConfigured(
+                'USER_TOKENS_INDEX "set" requires a cache backend that exposes a redis-py client.'
+            )
+        return client
+
+    @classmethod
+    def _prune_missing_keys(cls, user_pk, hashed_tokens, missing_keys):
+        if drt_settings.USER_TOKENS_INDEX != SET_INDEX:
+            # rewriting a list on the request path could drop a token that create_token
+            # adds at the same time, lists are left to prune_tokens
+            return
+
+        # RESET_TTL returns the 1-based positions of the keys that don't exist,
+        # the first key is the user's index, then come the hashes and the user's devices
+        dangling_hashes = [hashed_tokens[i - 2] for i in missing_keys if 1 < i <= len(hashed_tokens) + 1]
+        if dangling_hashes:
+            cls._remove_from_index(user_pk, dangling_hashes)
+
+    @classmethod
+    def _get_add_to_token_set_script_args(cls):
+        timeout = cls._get_user_provided_ttl()
+        return [
+            '' if timeout is None else timeout,
+            drt_settings.MAX_TOKENS_PER_USER or '',
+        ]
+
+    @classmethod
+    def _get_reset_ttl_keys(cls, user_pk, hashed_tokens):
+        keys = [user_pk] + hashed_tokens + [DEVICES_KEY_PREFIX + str(user_pk)]
+        return [TOKENS_STORAGE.make_key(key) for key in keys]
+
+    @classmethod
+    def _get_reset_ttl_script_args(cls, timeout, refresh_below):
+        return [
+            '' if timeout is None else timeout,
+            int(drt_settings.OVERWRITE_NONE_TTL),
+            '' if refresh_below is None else refresh_below,
+        ]
+
+    @classmethod
+    def _get_ttl_refresh_threshold(cls, timeout):
+        """
+        Remaining lifetime, in seconds, above which tokens are not refreshed.
+        """
+        if timeout is None or drt_settings.TTL_REFRESH_THRESHOLD is None:
+            return None
+        return int(timeout * drt_settings.TTL_REFRESH_THRESHOLD)
 
     @classmethod
     def _reset_token_ttl(cls, key):
         timeout = cls._get_user_provided_ttl()
-        key_ttl = TOKENS_CACHE.ttl(key)
+        key_ttl = TOKENS_STORAGE.ttl(key)
 
         if key_ttl is None and timeout is not None:
             if drt_settings.OVERWRITE_NONE_TTL:
-                TOKENS_CACHE.expire(key, timeout)
+                TOKENS_STORAGE.expire(key, timeout)
         elif key_ttl is None and timeout is None:
             pass
         elif key_ttl is not None and timeout is None:
-            TOKENS_CACHE.persist(key)
+            TOKENS_STORAGE.persist(key)
         else:
-            TOKENS_CACHE.expire(key, timeout)
+            TOKENS_STORAGE.expire(key, timeout)
+
+    @classmethod
+    def _get_verified_user_pk(cls, full_token):
+        token, key_name, hash = parse_token(full_token)
+        if key_name == WRONG_HASH:
+            return None
+
+        # the token is looked up before it's hashed, so forged tokens cost a GET, not a pbkdf2 run
+        token_key = TOKENS_STORAGE.token_key(key_name)
+        value = cls._get_token_value(token_key)
+        if value is None:
+            return None
+
+        if hash is None:
+            # the hash of v1 tokens is stored alongside the user pk
+            hash, user_pk = _split_v1_value(value)
+        else:
+            user_pk = value
+
+        if not cls._verify_token(token, hash, token_key):
+            return None
+        return user_pk
+
+    @classmethod
+    def _get_token_value(cls, token_key):
+        # replicas may not have the tokens this process just created or expired
+        if RECENTLY_WRITTEN_TOKENS.get(token_key):
+            return TOKENS_STORAGE.get(token_key)
+        return TOKENS_STORAGE.get_from_replica(token_key)
+
+    @classmethod
+    def _verify_token(cls, token, hash, token_key):
+        cached_token = VERIFIED_TOKENS_CACHE.get(token_key)
+        if cached_token is not None and hmac.compare_digest(cached_token, token):
+            return True
+
+        if verify_token(token, hash):
+            VERIFIED_TOKENS_CACHE.set(token_key, token)
+            return True
+
+        return False
 
     @classmethod
     def _set_key_value(cls, key, value):
         timeout = cls._get_user_provided_ttl()
-        TOKENS_CACHE.set(key, value, timeout=timeout)
+        TOKENS_STORAGE.set(key, value, timeout=timeout)
 
     @classmethod
     def _get_user_provided_ttl(cls):
-        return settings.CACHES[drt_settings.REDIS_DB_NAME].get('TIMEOUT', None)
+        global _user_provided_ttl
+
+        timeout = _user_provided_ttl
+        if timeout is not _UNRESOLVED:
+            return timeout
+
+        if drt_settings.STORAGE:
+            timeout = drt_settings.STORAGE.get('TIMEOUT', None)
+        else:
+            timeout = settings.CACHES[drt_settings.REDIS_DB_NAME].get('TIMEOUT', None)
+
+        _user_provided_ttl = timeout
+        return timeout
+
+
+_UNRESOLVED = object()
+# TIMEOUT resolved by the first _get_user_provided_ttl call, until the settings change
+_user_provided_ttl = _UNRESOLVED
+
+
+def _reset_user_provided_ttl(setting, **kwargs):
+    global _user_provided_ttl
+    if setting in ('CACHES', 'DJFORGE_REDIS_MULTITOKENS'):
+        _user_provided_ttl = _UNRESOLVED
+
+
+setting_changed.connect(_reset_user_provided_ttl)
+
+
+# refreshes the TTL of used tokens off the request path when BACKGROUND_TTL_REFRESH is set
+TTL_REFRESHER = TTLRefresher(
+    lambda user_pks: MultiToken.reset_tokens_ttl_many(user_pks),
+    drt_settings.BACKGROUND_TTL_REFRESH_INTERVAL,
+    drt_settings.BACKGROUND_TTL_REFRESH_BATCH_SIZE,
+    drt_settings.BACKGROUND_TTL_REFRESH_MAX_PENDING,
+)
+
+
+# connected by the app's ready() too, without duplicates, here for projects that
+# don't have djforge_redis_multitokens in INSTALLED_APPS
+connect_user_cache_invalidation()
+
+
+def _make_token_id(token_redis_key):
+    # opaque, so listing devices doesn't hand out the hashes tokens are stored under
+    if not isinstance(token_redis_key, bytes):
+        token_redis_key = token_redis_key.encode()
+    return hashlib.sha256(token_redis_key).hexdigest()[:32]
+
+
+def _make_v1_value(hash, user_pk):
+    # hashes never contain spaces, user pks might
+    return '%s %s' % (hash, user_pk)
+
+
+def _split_v1_value(value):
+    return value.split(' ', 1)
+
+
+_verify_pool = None
+_verify_pool_pid = None
+_verify_pool_lock = threading.Lock()
+
+
+def _map_verify(func, candidates):
+    # passlib's pbkdf2 runs in OpenSSL, which releases the GIL
+    if drt_settings.BATCH_VERIFY_WORKERS <= 1 or len(candidates) <= 1 or ThreadPoolExecutor is None:
+        return [func(candidate) for candidate in candidates]
+    return list(_get_verify_pool().map(func, candidates))
+
+
+def _get_verify_pool():
+    global _verify_pool, _verify_pool_pid
+
+    # the pool's threads don't survive a fork, start a new pool in the child process
+    if _verify_pool is not None and _verify_pool_pid == os.getpid():
+        return _verify_pool
+
+    with _verify_pool_lock:
+        if _verify_pool is None or _verify_pool_pid != os.getpid():
+            _verify_pool = ThreadPoolExecutor(max_workers=drt_settings.BATCH_VERIFY_WORKERS)
+            _verify_pool_pid = os.getpid()
+        return _verify_pool
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class CachedTokenAuthentication(TokenAuthentication):
 
+    client_ident = None
+
+    def authenticate(self, request):
+        if FAILED_AUTH_THROTTLE.enabled:
+            self.client_ident = FAILED_AUTH_THROTTLE.get_ident(request)
+        return super(CachedTokenAuthentication, self).authenticate(request)
+
     def authenticate_credentials(self, key):
+        callback = get_metrics_callback()
+        if callback is None:
+            return self._authenticate_credentials(key)
+
+        outcome = {}
+        started = now()
+        with RedisStats() as redis_stats:
+            try:
+                return self._authenticate_credentials(key, outcome)
+            finally:
+                callback('redis.time', redis_stats.seconds, {})
+                callback('redis.commands', redis_stats.commands, {})
+                callback('authenticate.time', now() - started, {'outcome': outcome.get('outcome', 'error')})
+
+    def _authenticate_credentials(self, key, outcome=None):
+        # ``outcome`` is filled in for METRICS_CALLBACK
+        if outcome is None:
+            outcome = {}
+
+        throttle_counters = None
+        if FAILED_AUTH_THROTTLE.enabled:
+            throttle_counters = FAILED_AUTH_THROTTLE.get_counters(self.client_ident, key)
+            try:
+                FAILED_AUTH_THROTTLE.check(throttle_counters)
+            except exceptions.Throttled:
+                outcome['outcome'] = 'throttled'
+                raise
+
         try:
-            user = MultiToken.get_user_from_token(key)
+            if drt_settings.LAZY_USER:
+                user = MultiToken.get_lazy_user_from_token(key)
+            else:
+                user = MultiToken.get_user_from_token(key)
 
             if drt_settings.RESET_TOKEN_TTL_ON_USER_LOG_IN:
-                MultiToken.reset_tokens_ttl(user.pk)
+                if drt_settings.BACKGROUND_TTL_REFRESH:
+                    TTL_REFRESHER.add(user.pk)
+                else:
+                    MultiToken.reset_tokens_ttl(user.pk)
+
+            if drt_settings.DEVICE_LAST_SEEN_INTERVAL:
+                MultiToken._touch_device(user.pk, key)
 
         except get_user_model().DoesNotExist:
+            outcome['outcome'] = 'invalid_token'
+            if throttle_counters:
+                FAILED_AUTH_THROTTLE.record_failure(throttle_counters)
             raise exceptions.AuthenticationFailed('Invalid token.')
 
         if not user.is_active:
+            outcome['outcome'] = 'inactive_user'
             raise exceptions.AuthenticationFailed('User inactive or deleted.')
 
+        outcome['outcome'] = 'success'
         return (user, MultiToken(key, user))
@@ -3,6 +3,16 @@ TOKEN_HASH_SEPARATOR = ':hash:'
 WRONG_TOKEN = 'wrong_token'
 WRONG_HASH = 'wrong_hash'
 
+LEGACY_TOKEN_FORMAT = 'legacy'
+V1_TOKEN_FORMAT = 'mt1'
+V1_TOKEN_PREFIX = V1_TOKEN_FORMAT + '.'
+# v1 tokens are stored under this prefix and their id, like hashes their keys start with '$'
+V1_KEY_PREFIX = '$' + V1_TOKEN_FORMAT + '$'
+# the devices of a user are stored under this prefix and the user's pk
+DEVICES_KEY_PREFIX = 'devices:'
+# the last-seen time of a device is stored next to its metadata, under this prefix and the key of its token
+LAST_SEEN_FIELD_PREFIX = 'last_seen:'
+
 
 def make_full_token(token, hash):
     return token + TOKEN_HASH_SEPARATOR + hash
@@ -17,3 +27,31 @@ def parse_full_token(full_token):
         token_hash = ['wrong_token', 'wrong_hash']
     
     return token_hash
+
+
+def make_v1_token(token_id, secret):
+    return V1_TOKEN_PREFIX + token_id + '.' + secret
+
+
+def parse_token(full_token):
+    """
+    Split a token of any format into ``(secret, key, hash)``.
+
+    ``key`` is the name the token is stored under: its hash for legacy tokens and
+    ``V1_KEY_PREFIX`` + its id for v1 tokens. ``hash`` is ``None`` for v1 tokens,
+    whose hash is stored alongside the user pk.
+    """
+    if full_token.startswith(V1_TOKEN_PREFIX):
+        parts = full_token.split('.')
+        if len(parts) != 3 or not parts[1] or not parts[2]:
+            return WRONG_TOKEN, WRONG_HASH, WRONG_HASH
+        return parts[2], V1_KEY_PREFIX + parts[1], None
+
+    token, hash = parse_full_token(full_token)
+    return token, hash, hash
+
+
+def make_last_seen_field(token_redis_key):
+    if not isinstance(token_redis_key, bytes):
+        token_redis_key = token_redis_key.encode()
+    return LAST_SEEN_FIELD_PREFIX.encode() + token_redis_key
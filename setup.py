@@ -9,13 +9,20 @@ with open('README.rst', 'r') as f:
 setup(
     name='djforge_redis_multitokens',
     version='0.0.4',
-    packages=['djforge_redis_multitokens'],
+    packages=[
+        'djforge_redis_multitokens',
+        'djforge_redis_multitokens.management',
+        'djforge_redis_multitokens.management.commands',
+    ],
     license='MIT',
     author='ToReforge',
     description='Django REST Framework user auth using multiple tokens stored in Redis',
     long_description=readme,
     author_email='it@toreforge.com',
-    install_requires=['passlib', 'djangorestframework', 'django'],
+    install_requires=['passlib', 'djangorestframework', 'django', 'redis'],
+    extras_require={
+        'async': ['redis>=4.2', 'asgiref'],
+    },
     include_package_data=True,
     url='https://github.com/ToReforge/djforge-redis-multitokens',
     classifiers=[
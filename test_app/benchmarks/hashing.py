@@ -0,0 +1,47 @@
+"""
+Measures how many token verifications a single core can do per second
+with each hashing scheme. This is the upper bound on authenticated
+requests per second per core spent on hashing alone.
+
+    python test_app/benchmarks/hashing.py [--seconds 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+import django
+from django.conf import settings
+
+
+def bench_scheme(scheme, seconds):
+    from djforge_redis_multitokens.crypto import hash_token, verify_token
+
+    token = 'a' * 40
+    hash = hash_token(token, scheme)
+
+    calls = 0
+    started = time.time()
+    while time.time() - started < seconds:
+        verify_token(token, hash)
+        calls += 1
+
+    return calls / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3, help='time spent on each scheme')
+    args = parser.parse_args()
+
+    settings.configure(SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'))
+    django.setup()
+
+    from djforge_redis_multitokens.crypto import HMAC_SHA256, PBKDF2_SHA256
+
+    for scheme in (PBKDF2_SHA256, HMAC_SHA256):
+        sys.stdout.write('%-15s %12.1f verifications/s per core\n' % (scheme, bench_scheme(scheme, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+Measures the hot paths of MultiToken against a local Redis server for users
+holding 1, 10 and 100 tokens: latency percentiles, operations per second, and
+Redis round trips and commands per operation.
+
+    python test_app/benchmarks/hot_paths.py [--iterations 200] [--redis localhost:6379]
+                                            [--json results.json] [--check baseline.json]
+
+With ``--check``, the Redis round trips and commands per operation are compared
+to a baseline written by ``--json`` and the script exits with status 1 if any of
+them grew. Unlike timings, these counts don't depend on the machine, so the check
+is stable in CI.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import django
+from django.conf import settings
+
+
+TOKENS_PER_USER = (1, 10, 100)
+
+
+class RedisCounter:
+    """
+    Counts the commands sent to Redis and the round trips that carried them.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def install(self):
+        from redis.connection import Connection
+
+        pack_command = Connection.pack_command
+        send_packed_command = Connection.send_packed_command
+        counter = self
+
+        # pipelines pack all of their commands with pack_command and send them at once
+        def counting_pack_command(connection, *args):
+            counter.commands += 1
+            return pack_command(connection, *args)
+
+        def counting_send_packed_command(connection, *args, **kwargs):
+            counter.round_trips += 1
+            return send_packed_command(connection, *args, **kwargs)
+
+        Connection.pack_command = counting_pack_command
+        Connection.send_packed_command = counting_send_packed_command
+
+    def reset(self):
+        self.commands = 0
+        self.round_trips = 0
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def bench(counter, iterations, operation, setup=None):
+    timings = []
+    commands = round_trips = 0
+
+    for _ in range(iterations):
+        args = setup() if setup is not None else ()
+
+        counter.reset()
+        started = time.time()
+        operation(*args)
+        timings.append(time.time() - started)
+        commands += counter.commands
+        round_trips += counter.round_trips
+
+    timings.sort()
+    return {
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'ops_per_s': iterations / sum(timings),
+        'round_trips': round_trips / float(iterations),
+        'commands': commands / float(iterations),
+    }
+
+
+def run(iterations, counter):
+    from django.contrib.auth import get_user_model
+    from djforge_redis_multitokens.tokens_auth import CachedTokenAuthentication, MultiToken, TOKENS_CACHE
+
+    authentication = CachedTokenAuthentication()
+    results = {}
+
+    for tokens_per_user in TOKENS_PER_USER:
+        TOKENS_CACHE.clear()
+        user = get_user_model().objects.create_user('user-%d' % tokens_per_user)
+        tokens = [MultiToken.create_token(user)[0] for _ in range(tokens_per_user)]
+
+        def create_token():
+            tokens.append(MultiToken.create_token(user)[0])
+
+        def drop_created_tokens():
+            # keep the number of tokens constant, outside of the timed calls
+            while len(tokens) > tokens_per_user:
+                MultiToken.expire_token(tokens.pop())
+            return ()
+
+        def recreate_tokens():
+            for _ in range(tokens_per_user):
+                MultiToken.create_token(user)
+            return (user,)
+
+        operations = [
+            ('create_token', create_token, drop_created_tokens, iterations),
+            ('authenticate_credentials', lambda: authentication.authenticate_credentials(tokens[0].key), None, iterations),
+            ('reset_tokens_ttl', lambda: MultiToken.reset_tokens_ttl(user.pk), None, iterations),
+            # each call needs fresh tokens, which is slow for 100 tokens per user
+            ('expire_all_tokens', MultiToken.expire_all_tokens, recreate_tokens, max(1, iterations // 10)),
+        ]
+
+        for name, operation, setup, operation_iterations in operations:
+            results['%s/%d' % (name, tokens_per_user)] = bench(counter, operation_iterations, operation, setup)
+        drop_created_tokens()
+        user.delete()
+
+    return results
+
+
+def check(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for name, expected in sorted(baseline.items()):
+        actual = results.get(name)
+        if actual is None:
+            continue
+
+        for metric in ('round_trips', 'commands'):
+            if actual[metric] > expected[metric]:
+                regressions.append('%s: %s grew from %.1f to %.1f' % (name, metric, expected[metric], actual[metric]))
+
+    return regressions
+
+
+def configure(redis_location, scheme):
+    settings.configure(
+        SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'),
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'tokens': {
+                'BACKEND': 'redis_cache.RedisCache',
+                'LOCATION': redis_location,
+                'OPTIONS': {'DB': 15},
+                'TIMEOUT': 3600,
+            },
+        },
+        DJFORGE_REDIS_MULTITOKENS={
+            'REDIS_DB_NAME': 'tokens',
+            'TOKEN_HASHING_SCHEME': scheme,
+        },
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200, help='calls of each operation')
+    parser.add_argument('--redis', default='localhost:6379', help='location of the Redis server, DB 15 is flushed')
+    parser.add_argument('--scheme', default='hmac_sha256', help='TOKEN_HASHING_SCHEME, pbkdf2 hides the Redis costs')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--check', help='fail if Redis round trips or commands grew compared to this file')
+    args = parser.parse_args()
+
+    configure(args.redis, args.scheme)
+
+    counter = RedisCounter()
+    counter.install()
+    results = run(args.iterations, counter)
+
+    sys.stdout.write('%-32s %9s %9s %9s %11s %12s %9s\n' % (
+        'operation/tokens', 'p50 ms', 'p95 ms', 'p99 ms', 'ops/s', 'round trips', 'commands',
+    ))
+    for name in sorted(results, key=lambda n: (n.split('/')[0], int(n.split('/')[1]))):
+        r = results[name]
+        sys.stdout.write('%-32s %9.3f %9.3f %9.3f %11.1f %12.1f %9.1f\n' % (
+            name, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['ops_per_s'], r['round_trips'], r['commands'],
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.check:
+        regressions = check(results, args.check)
+        for regression in regressions:
+            sys.stderr.write(regression + '\n')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
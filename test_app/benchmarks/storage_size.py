@@ -0,0 +1,105 @@
+"""
+Measures the Redis memory taken per token by each storage format, as reported by
+MEMORY USAGE (Redis >= 4.0), for both USER_TOKENS_INDEX modes.
+
+    python test_app/benchmarks/storage_size.py [--users 20] [--tokens-per-user 10] [--redis localhost:6379]
+
+DB 14 of the Redis server is flushed.
+"""
+import argparse
+import os
+import sys
+
+import django
+from django.conf import settings
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+DB = 14
+
+
+def generate_hashed_tokens(count):
+    from djforge_redis_multitokens.crypto import generate_new_hashed_token
+    return [generate_new_hashed_token() for _ in range(count)]
+
+
+def memory_usage(client):
+    return sum(client.memory_usage(key) for key in client.scan_iter(count=1000))
+
+
+def measure(storage, index, users, hashed_tokens):
+    from djforge_redis_multitokens import tokens_auth
+    from djforge_redis_multitokens.settings import djforge_redis_multitokens_settings as drt_settings
+
+    storage.client.flushdb()
+    tokens = iter(hashed_tokens)
+
+    with patch.object(tokens_auth, 'TOKENS_STORAGE', storage), \
+            patch.object(tokens_auth, 'generate_new_hashed_token', lambda: next(tokens)), \
+            patch.dict(drt_settings.overrides, {'USER_TOKENS_INDEX': index}):
+        for user in users:
+            for _ in range(len(hashed_tokens) // len(users)):
+                tokens_auth.MultiToken.create_token(user)
+
+    return memory_usage(storage.client) / float(len(hashed_tokens))
+
+
+def configure(redis_location):
+    settings.configure(
+        SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'),
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'tokens': {
+                'BACKEND': 'redis_cache.RedisCache',
+                'LOCATION': redis_location,
+                'OPTIONS': {'DB': DB},
+                'TIMEOUT': 3600,
+            },
+        },
+        DJFORGE_REDIS_MULTITOKENS={'REDIS_DB_NAME': 'tokens'},
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tokens-per-user', type=int, default=10)
+    parser.add_argument('--redis', default='localhost:6379', help='location of the Redis server')
+    args = parser.parse_args()
+
+    configure(args.redis)
+
+    from django.contrib.auth import get_user_model
+    from djforge_redis_multitokens.storage import CompactRedisStorage, DjangoCacheStorage, RedisStorage
+
+    users = [get_user_model().objects.create_user('user-%d' % i) for i in range(args.users)]
+    # pbkdf2 is slow, the same hashes are stored in every format
+    hashed_tokens = generate_hashed_tokens(args.users * args.tokens_per_user)
+
+    url = 'redis://%s/%d' % (args.redis, DB)
+    storages = [
+        ('DjangoCacheStorage', DjangoCacheStorage('tokens')),
+        ('RedisStorage', RedisStorage(url, key_prefix='tokens')),
+        ('CompactRedisStorage', CompactRedisStorage(url, key_prefix='tokens')),
+    ]
+
+    sys.stdout.write('%-22s %-6s %16s\n' % ('storage', 'index', 'bytes per token'))
+    for name, storage in storages:
+        for index in ('list', 'set'):
+            sys.stdout.write('%-22s %-6s %16.1f\n' % (name, index, measure(storage, index, users, hashed_tokens)))
+
+    storages[0][1].client.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+"""
+Settings for running the tests of the async API, which needs redis-py >= 4.2.
+django-redis-cache requires redis-py < 4, so the tokens are stored through django-redis.
+"""
+from .settings import *  # noqa: F401,F403
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'TIMEOUT': None,
+    }
+}
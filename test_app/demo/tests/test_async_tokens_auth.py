@@ -0,0 +1,240 @@
+import unittest
+import weakref
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, TestCase
+from rest_framework import exceptions
+
+from .utils import (
+    create_test_user,
+    MockedLibrarySettings,
+    override_tokens_timeout,
+    SetupTearDownForMultiTokenTests,
+)
+from djforge_redis_multitokens.local_cache import LocalTTLCache
+from djforge_redis_multitokens.storage import RedisStorage, ShardedRedisStorage
+from djforge_redis_multitokens.tokens_auth import FAILED_AUTH_THROTTLE, MultiToken, TOKENS_CACHE
+from djforge_redis_multitokens.utils import parse_full_token
+
+try:
+    from asgiref.sync import async_to_sync
+    from redis import asyncio as aioredis
+    from djforge_redis_multitokens.async_tokens_auth import (
+        AsyncCachedTokenAuthentication,
+        AsyncMultiToken,
+        get_async_redis_client,
+    )
+except ImportError:
+    AsyncMultiToken = None
+
+
+User = get_user_model()
+
+
+@unittest.skipIf(AsyncMultiToken is None, 'redis.asyncio is not available')
+class TestAsyncMultiToken(SetupTearDownForMultiTokenTests, TestCase):
+
+    def test_token_created_asynchronously_is_authenticated(self):
+        token, first_device = async_to_sync(AsyncMultiToken.acreate_token)(self.user)
+
+        self.assertFalse(first_device)
+        self.assertEqual(len(TOKENS_CACHE.get(self.user.pk)), 2)
+        self.assertEqual(MultiToken.get_user_from_token(token.key).pk, self.user.pk)
+        self.assertEqual(async_to_sync(AsyncMultiToken.aget_user_from_token)(token.key).pk, self.user.pk)
+
+    def test_first_token_created_asynchronously_is_flagged_as_first_device(self):
+        second_user = create_test_user('tester2')
+        token, first_device = async_to_sync(AsyncMultiToken.acreate_token)(second_user)
+        self.assertTrue(first_device)
+
+    def test_correct_user_is_found_for_correct_token(self):
+        user = async_to_sync(AsyncMultiToken.aget_user_from_token)(self.token.key)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_exception_is_raised_for_wrong_token(self):
+        self.assertRaises(User.DoesNotExist, async_to_sync(AsyncMultiToken.aget_user_from_token), self.token.key[:-1])
+
+    def test_unknown_hash_is_rejected_before_hashing(self):
+        with patch('djforge_redis_multitokens.async_tokens_auth.verify_token') as mocked_verify:
+            self.assertRaises(
+                User.DoesNotExist, async_to_sync(AsyncMultiToken.aget_user_from_token), self.token.key[:-1],
+            )
+        self.assertEqual(mocked_verify.call_count, 0)
+
+    def test_token_is_expired(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        async_to_sync(AsyncMultiToken.aexpire_token)(self.token)
+
+        self.assertEqual(TOKENS_CACHE.get(self.user.pk), [parse_full_token(second_token.key)[1]])
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+    def test_all_tokens_are_expired(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        async_to_sync(AsyncMultiToken.aexpire_all_tokens)(self.user)
+
+        self.assertIsNone(TOKENS_CACHE.get(self.user.pk))
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(second_token.key)[1]))
+
+    @override_tokens_timeout(1000)
+    def test_tokens_ttl_is_reset(self):
+        async_to_sync(AsyncMultiToken.areset_tokens_ttl)(self.user.pk)
+
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+        self.assertEqual(TOKENS_CACHE.ttl(parse_full_token(self.token.key)[1]), 1000)
+
+    @patch('djforge_redis_multitokens.async_tokens_auth.drt_settings', new=MockedLibrarySettings(USER_TOKENS_INDEX='set'))
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(USER_TOKENS_INDEX='set'))
+    def test_tokens_are_managed_in_sorted_set_index(self):
+        token, first_device = async_to_sync(AsyncMultiToken.acreate_token)(self.user)
+        self.assertFalse(first_device)
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [
+            parse_full_token(self.token.key)[1], parse_full_token(token.key)[1],
+        ])
+
+        async_to_sync(AsyncMultiToken.aexpire_token)(self.token)
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [parse_full_token(token.key)[1]])
+
+    @patch('djforge_redis_multitokens.async_tokens_auth.drt_settings', new=MockedLibrarySettings(MAX_TOKENS_PER_USER=1))
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(MAX_TOKENS_PER_USER=1))
+    def test_oldest_token_is_evicted_when_the_cap_is_exceeded(self):
+        token, _ = async_to_sync(AsyncMultiToken.acreate_token)(self.user)
+
+        self.assertEqual(TOKENS_CACHE.get(self.user.pk), [parse_full_token(token.key)[1]])
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+    def test_v1_token_is_created_authenticated_and_expired(self):
+        token, _ = async_to_sync(AsyncMultiToken.acreate_token)(self.user)
+
+        self.assertTrue(token.key.startswith('mt1.'))
+        self.assertEqual(async_to_sync(AsyncMultiToken.aget_user_from_token)(token.key).pk, self.user.pk)
+
+        async_to_sync(AsyncMultiToken.aexpire_token)(token)
+        self.assertRaises(User.DoesNotExist, async_to_sync(AsyncMultiToken.aget_user_from_token), token.key)
+        self.assertEqual(TOKENS_CACHE.get(self.user.pk), [parse_full_token(self.token.key)[1]])
+
+    @override_tokens_timeout(1000)
+    def test_scripts_are_registered_once(self):
+        async_to_sync(AsyncMultiToken.areset_tokens_ttl)(self.user.pk)
+
+        with patch.object(aioredis.Redis, 'register_script', autospec=True) as mocked_register_script:
+            for i in range(3):
+                async_to_sync(AsyncMultiToken.areset_tokens_ttl)(self.user.pk)
+        mocked_register_script.assert_not_called()
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+
+    def test_device_created_asynchronously_is_listed(self):
+        token, _ = async_to_sync(AsyncMultiToken.acreate_token)(self.user, device={'label': 'phone'})
+
+        devices = MultiToken.list_tokens(self.user)
+        self.assertEqual([device['label'] for device in devices], ['phone'])
+        self.assertEqual(devices[0]['last_seen'], devices[0]['created_at'])
+
+    @patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+    @patch('djforge_redis_multitokens.async_tokens_auth.drt_settings', new=MockedLibrarySettings(
+        ASYNC_REDIS_URL='redis://localhost:6379/3',
+    ))
+    def test_sharded_storage_is_rejected(self):
+        storage = ShardedRedisStorage(['redis://localhost:6379/3', 'redis://localhost:6379/4'])
+
+        with patch('djforge_redis_multitokens.async_tokens_auth.TOKENS_STORAGE', new=storage):
+            self.assertRaises(ImproperlyConfigured, async_to_sync(AsyncMultiToken.aget_user_from_token), self.token.key)
+            self.assertRaises(ImproperlyConfigured, async_to_sync(AsyncMultiToken.acreate_token), self.user)
+
+    @patch('djforge_redis_multitokens.async_tokens_auth.RECENTLY_WRITTEN_TOKENS', new_callable=lambda: LocalTTLCache(10, 60))
+    def test_created_and_expired_tokens_are_read_from_the_primary(self, recently_written_tokens):
+        token, _ = async_to_sync(AsyncMultiToken.acreate_token)(self.user)
+        async_to_sync(AsyncMultiToken.aexpire_token)(self.token)
+
+        self.assertTrue(recently_written_tokens.get(parse_full_token(token.key)[1]))
+        self.assertTrue(recently_written_tokens.get(parse_full_token(self.token.key)[1]))
+
+
+@unittest.skipIf(AsyncMultiToken is None, 'redis.asyncio is not available')
+class TestAsyncRedisClient(TestCase):
+
+    def setUp(self):
+        patcher = patch('djforge_redis_multitokens.async_tokens_auth._async_clients', new=weakref.WeakKeyDictionary())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_client(self, storage):
+        async def get_client():
+            return get_async_redis_client()
+
+        with patch('djforge_redis_multitokens.async_tokens_auth.TOKENS_STORAGE', new=storage):
+            return async_to_sync(get_client)()
+
+    def test_client_keeps_the_connection_options_of_the_storage(self):
+        storage = RedisStorage('redis://localhost:6379/3?health_check_interval=5&client_name=tokens')
+        connection_kwargs = self.get_client(storage).connection_pool.connection_kwargs
+
+        self.assertEqual(connection_kwargs['db'], 3)
+        self.assertEqual(connection_kwargs['health_check_interval'], 5)
+        self.assertEqual(connection_kwargs['client_name'], 'tokens')
+
+    def test_client_uses_tls_like_the_storage(self):
+        storage = RedisStorage('rediss://localhost:6379/3?ssl_cert_reqs=none')
+        pool = self.get_client(storage).connection_pool
+
+        self.assertIs(pool.connection_class, aioredis.SSLConnection)
+        self.assertEqual(pool.connection_kwargs['ssl_cert_reqs'], 'none')
+
+    def test_storage_without_client_is_rejected(self):
+        storage = Mock(client=None, cluster=False)
+        self.assertRaises(ImproperlyConfigured, self.get_client, storage)
+
+    def test_redis_cluster_is_rejected(self):
+        storage = Mock(cluster=True)
+        self.assertRaises(ImproperlyConfigured, self.get_client, storage)
+
+
+@unittest.skipIf(AsyncMultiToken is None, 'redis.asyncio is not available')
+class TestAsyncCachedTokenAuthentication(SetupTearDownForMultiTokenTests, TestCase):
+
+    def authenticate(self, header):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+        return async_to_sync(AsyncCachedTokenAuthentication().aauthenticate)(request)
+
+    def test_auth_with_token_succeeds(self):
+        user, token = self.authenticate('Token ' + self.token.key)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(token.key, self.token.key)
+
+    def test_auth_without_token_header_is_skipped(self):
+        self.assertIsNone(self.authenticate('Bearer ' + self.token.key))
+
+    def test_auth_with_wrong_token_fails(self):
+        self.assertRaises(exceptions.AuthenticationFailed, self.authenticate, 'Token ' + self.token.key + 'blah')
+
+    def test_auth_of_inactive_user_fails(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertRaises(exceptions.AuthenticationFailed, self.authenticate, 'Token ' + self.token.key)
+
+    @patch('djforge_redis_multitokens.async_tokens_auth.RECENTLY_SEEN_TOKENS', new=LocalTTLCache(10, 60))
+    @patch('djforge_redis_multitokens.async_tokens_auth.drt_settings', new=MockedLibrarySettings(
+        DEVICE_LAST_SEEN_INTERVAL=60,
+    ))
+    def test_last_seen_is_updated_on_authentication(self):
+        token, _ = MultiToken.create_token(self.user, device={'label': 'phone', 'created_at': 1000})
+        self.authenticate('Token ' + token.key)
+
+        self.assertGreater(MultiToken.list_tokens(self.user)[0]['last_seen'], 1000)
+
+    @patch('djforge_redis_multitokens.throttling.drt_settings', new=MockedLibrarySettings(FAILED_AUTH_LIMIT_PER_IP=3))
+    def test_failed_auth_is_throttled(self):
+        FAILED_AUTH_THROTTLE.clear()
+        self.addCleanup(FAILED_AUTH_THROTTLE.clear)
+
+        for i in range(3):
+            self.assertRaises(exceptions.AuthenticationFailed, self.authenticate, 'Token ' + self.token.key + str(i))
+
+        self.assertRaises(exceptions.Throttled, self.authenticate, 'Token ' + self.token.key)
@@ -1,6 +1,21 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
 from django.test import TestCase
 
-from djforge_redis_multitokens.crypto import generate_new_hashed_token, verify_token
+from .utils import MockedLibrarySettings
+from djforge_redis_multitokens.crypto import (
+    generate_new_hashed_token,
+    hash_token,
+    make_user_tag,
+    verify_token,
+    HMAC_SHA256,
+    HMAC_SHA256_PREFIX,
+    PBKDF2_SHA256,
+    USER_TAG_LENGTH,
+)
 from djforge_redis_multitokens.utils import TOKEN_HASH_SEPARATOR
 
 
@@ -31,3 +46,53 @@ class TestVerifyTokenFunction(TestCase):
         token, hash, full_token = generate_new_hashed_token()
         hash = hash[:-1]
         self.assertFalse(verify_token(token, hash))
+
+
+class TestHashingSchemes(TestCase):
+
+    def test_pbkdf2_sha256_scheme_is_used_by_default(self):
+        token, hash, full_token = generate_new_hashed_token()
+        self.assertTrue(hash.startswith('$pbkdf2-sha256$'))
+
+    @patch('djforge_redis_multitokens.crypto.drt_settings', new=MockedLibrarySettings(TOKEN_HASHING_SCHEME=HMAC_SHA256))
+    def test_new_tokens_use_hmac_sha256_scheme_when_it_is_selected(self):
+        token, hash, full_token = generate_new_hashed_token()
+        self.assertTrue(hash.startswith(HMAC_SHA256_PREFIX))
+        self.assertTrue(verify_token(token, hash))
+
+    def test_hash_token_accepts_explicit_scheme(self):
+        self.assertTrue(hash_token('token', HMAC_SHA256).startswith(HMAC_SHA256_PREFIX))
+        self.assertTrue(hash_token('token', PBKDF2_SHA256).startswith('$pbkdf2-sha256$'))
+
+    def test_unknown_scheme_raises_error(self):
+        self.assertRaises(ValueError, hash_token, 'token', 'md5')
+
+    def test_hmac_sha256_verification_fails_with_incorrect_token(self):
+        hash = hash_token('token', HMAC_SHA256)
+        self.assertFalse(verify_token('token2', hash))
+        self.assertFalse(verify_token('token', hash[:-1]))
+
+    def test_hmac_sha256_verification_fails_when_secret_changes(self):
+        hash = hash_token('token', HMAC_SHA256)
+        with patch('djforge_redis_multitokens.crypto.drt_settings', new=MockedLibrarySettings(TOKEN_HASHING_SECRET='other')):
+            self.assertFalse(verify_token('token', hash))
+
+    @patch('djforge_redis_multitokens.crypto.drt_settings', new=MockedLibrarySettings(TOKEN_HASHING_SCHEME=HMAC_SHA256))
+    def test_pbkdf2_sha256_tokens_are_verified_after_scheme_changes(self):
+        hash = hash_token('token', PBKDF2_SHA256)
+        self.assertTrue(verify_token('token', hash))
+
+
+class TestMakeUserTagFunction(TestCase):
+
+    def test_tag_is_short_and_stable(self):
+        self.assertEqual(len(make_user_tag(1)), USER_TAG_LENGTH)
+        self.assertEqual(make_user_tag(1), make_user_tag('1'))
+
+    def test_tags_of_different_users_differ(self):
+        self.assertNotEqual(make_user_tag(1), make_user_tag(2))
+
+    def test_tag_depends_on_the_secret(self):
+        tag = make_user_tag(1)
+        with patch('djforge_redis_multitokens.crypto.drt_settings', new=MockedLibrarySettings(TOKEN_HASHING_SECRET='other')):
+            self.assertNotEqual(make_user_tag(1), tag)
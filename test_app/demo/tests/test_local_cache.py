@@ -0,0 +1,58 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.test import TestCase
+
+from djforge_redis_multitokens.local_cache import LocalTTLCache
+
+
+class TestLocalTTLCache(TestCase):
+
+    def test_stored_value_is_returned(self):
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_missing_key_returns_default(self):
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.get('key', 'default'), 'default')
+
+    def test_cache_with_zero_size_stores_nothing(self):
+        cache = LocalTTLCache(max_size=0, ttl=60)
+        cache.set('key', 'value')
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entry_is_evicted_when_cache_is_full(self):
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.get('first')
+        cache.set('third', 3)
+
+        self.assertEqual(cache.get('first'), 1)
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('third'), 3)
+
+    @patch('djforge_redis_multitokens.local_cache._now')
+    def test_entries_expire_after_ttl(self, mocked_now):
+        mocked_now.return_value = 1000
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        cache.set('key', 'value')
+
+        mocked_now.return_value = 1059
+        self.assertEqual(cache.get('key'), 'value')
+
+        mocked_now.return_value = 1060
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+
+    def test_deleted_key_is_not_returned(self):
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        cache.set('key', 'value')
+        cache.delete('key')
+        cache.delete('missing_key')
+        self.assertIsNone(cache.get('key'))
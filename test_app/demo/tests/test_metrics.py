@@ -0,0 +1,140 @@
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+import unittest
+
+import redis
+from django.test import TestCase
+from rest_framework import exceptions
+
+from .test_storage import REDIS_CLUSTER_URL
+from .utils import MockedLibrarySettings, SetupTearDownForMultiTokenTests
+from djforge_redis_multitokens.metrics import get_metrics_callback, RedisStats
+from djforge_redis_multitokens.storage import RedisStorage
+from djforge_redis_multitokens.tokens_auth import CachedTokenAuthentication, TOKENS_CACHE
+from djforge_redis_multitokens.utils import parse_full_token
+
+
+RECORDED_METRICS = []
+
+
+def record_metric(name, value, tags):
+    RECORDED_METRICS.append((name, value, tags))
+
+
+class TestMetricsCallback(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestMetricsCallback, self).setUp()
+        patcher = patch(
+            'djforge_redis_multitokens.metrics.drt_settings',
+            new=MockedLibrarySettings(METRICS_CALLBACK='tests.test_metrics.record_metric'),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        del RECORDED_METRICS[:]
+
+    def get_metrics(self, name):
+        return [(value, tags) for metric_name, value, tags in RECORDED_METRICS if metric_name == name]
+
+    def test_callback_is_disabled_by_default(self):
+        with patch('djforge_redis_multitokens.metrics.drt_settings', new=MockedLibrarySettings()):
+            self.assertIsNone(get_metrics_callback())
+
+    def test_callback_is_imported_from_dotted_path(self):
+        get_metrics_callback()('name', 1, {})
+        self.assertEqual(RECORDED_METRICS, [('name', 1, {})])
+
+    def test_callback_errors_are_logged(self):
+        settings = MockedLibrarySettings(METRICS_CALLBACK=Mock(side_effect=ValueError))
+        with patch('djforge_redis_multitokens.metrics.drt_settings', new=settings):
+            with patch('djforge_redis_multitokens.metrics.logger') as mocked_logger:
+                user, token = CachedTokenAuthentication().authenticate_credentials(self.token.key)
+
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertTrue(mocked_logger.exception.called)
+
+    def test_successful_authentication_is_measured(self):
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+
+        self.assertEqual(self.get_metrics('authenticate.time')[0][1], {'outcome': 'success'})
+        self.assertEqual(self.get_metrics('verify_token.time')[0][1], {'scheme': 'pbkdf2_sha256', 'valid': True})
+        self.assertEqual(len(self.get_metrics('user_lookup.time')), 1)
+        # GET of the token's hash, GET of the user's index, EVALSHA of the TTL refresh
+        self.assertEqual(self.get_metrics('redis.commands'), [(3, {})])
+        self.assertGreater(self.get_metrics('redis.time')[0][0], 0)
+
+    def test_failed_authentication_is_measured(self):
+        self.assertRaises(
+            exceptions.AuthenticationFailed,
+            CachedTokenAuthentication().authenticate_credentials,
+            self.token.key + 'blah',
+        )
+
+        self.assertEqual(self.get_metrics('authenticate.time')[0][1], {'outcome': 'invalid_token'})
+        # the unknown hash is rejected by the GET, before any hashing
+        self.assertEqual(self.get_metrics('verify_token.time'), [])
+        self.assertEqual(self.get_metrics('redis.commands'), [(1, {})])
+
+    def test_token_with_wrong_secret_is_measured(self):
+        token, hash = parse_full_token(self.token.key)
+        self.assertRaises(
+            exceptions.AuthenticationFailed,
+            CachedTokenAuthentication().authenticate_credentials,
+            self.token.key.replace(token, token[::-1], 1),
+        )
+
+        self.assertEqual(self.get_metrics('verify_token.time')[0][1], {'scheme': 'pbkdf2_sha256', 'valid': False})
+
+    def test_inactive_user_is_measured(self):
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertRaises(
+            exceptions.AuthenticationFailed,
+            CachedTokenAuthentication().authenticate_credentials,
+            self.token.key,
+        )
+        self.assertEqual(self.get_metrics('authenticate.time')[0][1], {'outcome': 'inactive_user'})
+
+    def test_nested_redis_stats_are_added_to_the_outer_ones(self):
+        get_metrics_callback()
+
+        with RedisStats() as outer:
+            TOKENS_CACHE.get('a')
+            with RedisStats() as inner:
+                TOKENS_CACHE.get('b')
+
+        self.assertEqual(inner.commands, 1)
+        self.assertEqual(outer.commands, 2)
+
+    def test_only_clients_of_the_tokens_storage_are_measured(self):
+        get_metrics_callback()
+        other_client = redis.StrictRedis.from_url('redis://localhost:6379/2')
+
+        with RedisStats() as stats:
+            other_client.get('a')
+            other_client.pipeline().get('a').get('b').execute()
+        self.assertEqual(stats.commands, 0)
+
+    def test_client_registered_after_metrics_are_enabled_is_measured(self):
+        get_metrics_callback()
+        storage = RedisStorage('redis://localhost:6379/2')
+
+        with RedisStats() as stats:
+            storage.get('a')
+            storage.client.pipeline().get('a').get('b').execute()
+        self.assertEqual(stats.commands, 3)
+
+    @unittest.skipUnless(REDIS_CLUSTER_URL, 'REDIS_CLUSTER_URL is not set')
+    @patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+    def test_cluster_client_is_measured(self):
+        get_metrics_callback()
+        storage = RedisStorage(REDIS_CLUSTER_URL, hash_tags=True, cluster=True)
+
+        with RedisStats() as stats:
+            storage.get('a')
+            storage.client.pipeline().get('a').execute()
+        self.assertEqual(stats.commands, 2)
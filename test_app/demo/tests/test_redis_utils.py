@@ -0,0 +1,27 @@
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+
+from djforge_redis_multitokens.redis_utils import get_redis_client, make_redis_key, run_script
+from djforge_redis_multitokens.tokens_auth import TOKENS_CACHE
+
+
+class TestGetRedisClientFunction(TestCase):
+
+    def test_client_is_returned_for_redis_cache(self):
+        client = get_redis_client(TOKENS_CACHE)
+        self.assertTrue(client.ping())
+
+    def test_none_is_returned_for_cache_without_redis_client(self):
+        self.assertIsNone(get_redis_client(LocMemCache('locmem', {})))
+
+
+class TestRunScriptFunction(TestCase):
+
+    def tearDown(self):
+        TOKENS_CACHE.clear()
+
+    def test_script_runs_on_keys_made_by_the_cache(self):
+        TOKENS_CACHE.set('key', 10)
+        client = get_redis_client(TOKENS_CACHE)
+        result = run_script(client, "return redis.call('GET', KEYS[1])", [make_redis_key(TOKENS_CACHE, 'key')])
+        self.assertEqual(int(result), 10)
@@ -0,0 +1,70 @@
+import threading
+
+from django.test import TestCase
+
+from djforge_redis_multitokens.refresher import TTLRefresher
+
+
+class TestTTLRefresher(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.refresher = TTLRefresher(self.batches.append, interval=60, batch_size=2, max_pending=3)
+        self.addCleanup(self.refresher.stop)
+
+    def test_users_are_deduplicated(self):
+        self.refresher.add(1)
+        self.refresher.add(1)
+        self.refresher.stop()
+
+        self.assertEqual(self.batches, [[1]])
+        self.assertEqual(self.refresher.flushed, 1)
+
+    def test_users_are_flushed_in_batches(self):
+        self.refresher.batch_size = 10
+        for user_pk in (1, 2, 3):
+            self.refresher.add(user_pk)
+        self.refresher.batch_size = 2
+        self.refresher.flush()
+
+        self.assertEqual(self.batches, [[1, 2], [3]])
+        self.assertEqual(self.refresher.flushed, 3)
+
+    def test_users_are_dropped_when_buffer_is_full(self):
+        self.refresher.batch_size = 10
+        for user_pk in (1, 2, 3, 4):
+            self.refresher.add(user_pk)
+        self.refresher.flush()
+
+        self.assertEqual(self.batches, [[1, 2, 3]])
+        self.assertEqual(self.refresher.dropped, 1)
+
+    def test_failed_batches_are_counted(self):
+        def refresh(user_pks):
+            raise ValueError
+
+        refresher = TTLRefresher(refresh, interval=60, batch_size=2, max_pending=3)
+        refresher.add(1)
+        refresher.stop()
+
+        self.assertEqual(refresher.failed, 1)
+        self.assertEqual(refresher.flushed, 0)
+
+    def test_full_batch_is_flushed_by_background_thread(self):
+        flushed = threading.Event()
+        refresher = TTLRefresher(lambda user_pks: flushed.set(), interval=60, batch_size=2, max_pending=3)
+        self.addCleanup(refresher.stop)
+
+        refresher.add(1)
+        refresher.add(2)
+
+        self.assertTrue(flushed.wait(5))
+
+    def test_buffer_is_flushed_by_background_thread_after_interval(self):
+        flushed = threading.Event()
+        refresher = TTLRefresher(lambda user_pks: flushed.set(), interval=0.01, batch_size=2, max_pending=3)
+        self.addCleanup(refresher.stop)
+
+        refresher.add(1)
+
+        self.assertTrue(flushed.wait(5))
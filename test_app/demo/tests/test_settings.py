@@ -1,6 +1,13 @@
-from django.test import TestCase
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.conf import settings
+from django.test import override_settings, TestCase
 
 from djforge_redis_multitokens.settings import djforge_redis_multitokens_settings as drf_sett
+from djforge_redis_multitokens.tokens_auth import MultiToken
 
 
 class TestSettings(TestCase):
@@ -9,3 +16,45 @@ class TestSettings(TestCase):
         self.assertIsNotNone(drf_sett.REDIS_DB_NAME)
         self.assertIsNotNone(drf_sett.RESET_TOKEN_TTL_ON_USER_LOG_IN)
         self.assertIsNotNone(drf_sett.OVERWRITE_NONE_TTL)
+
+    def test_defaults_are_used_for_missing_settings(self):
+        self.assertEqual(drf_sett.REJECTED_TOKENS_CACHE_TTL, 10)
+
+    def test_settings_are_read_only(self):
+        with self.assertRaises(AttributeError):
+            drf_sett.MAX_TOKENS_PER_USER = 1
+
+    def test_settings_are_reloaded_when_changed(self):
+        with override_settings(DJFORGE_REDIS_MULTITOKENS={'REDIS_DB_NAME': 'other', 'MAX_TOKENS_PER_USER': 3}):
+            self.assertEqual(drf_sett.REDIS_DB_NAME, 'other')
+            self.assertEqual(drf_sett.MAX_TOKENS_PER_USER, 3)
+
+        self.assertIsNone(drf_sett.MAX_TOKENS_PER_USER)
+        self.assertNotEqual(drf_sett.REDIS_DB_NAME, 'other')
+
+
+class TestUserProvidedTTL(TestCase):
+
+    def test_ttl_is_resolved_once(self):
+        timeout = MultiToken._get_user_provided_ttl()
+
+        with patch('djforge_redis_multitokens.tokens_auth.settings') as mocked_settings:
+            self.assertEqual(MultiToken._get_user_provided_ttl(), timeout)
+        mocked_settings.CACHES.__getitem__.assert_not_called()
+
+    def test_ttl_is_resolved_again_when_caches_change(self):
+        caches = dict((name, dict(cache, TIMEOUT=1234)) for name, cache in settings.CACHES.items())
+        MultiToken._get_user_provided_ttl()
+
+        with override_settings(CACHES=caches):
+            self.assertEqual(MultiToken._get_user_provided_ttl(), 1234)
+        self.assertNotEqual(MultiToken._get_user_provided_ttl(), 1234)
+
+    def test_ttl_is_resolved_again_when_library_settings_change(self):
+        MultiToken._get_user_provided_ttl()
+
+        with override_settings(DJFORGE_REDIS_MULTITOKENS=dict(
+            settings.DJFORGE_REDIS_MULTITOKENS, STORAGE={'URL': 'redis://localhost:6379/2', 'TIMEOUT': 4321},
+        )):
+            self.assertEqual(MultiToken._get_user_provided_ttl(), 4321)
+        self.assertNotEqual(MultiToken._get_user_provided_ttl(), 4321)
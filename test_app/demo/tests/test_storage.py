@@ -0,0 +1,730 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import os
+import subprocess
+import sys
+import unittest
+
+import redis
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase
+
+from .utils import create_test_user, MockedLibrarySettings, resolve_ttl_again, SetupTearDownForMultiTokenTests
+from djforge_redis_multitokens.crypto import make_user_tag
+from djforge_redis_multitokens.local_cache import LocalTTLCache
+from djforge_redis_multitokens.management.commands import prune_tokens
+from djforge_redis_multitokens.storage import (
+    CompactRedisStorage,
+    DjangoCacheStorage,
+    get_hash_tag,
+    get_storage,
+    RedisStorage,
+    ReplicaSet,
+    ShardedCompactRedisStorage,
+    ShardedRedisStorage,
+)
+from djforge_redis_multitokens.throttling import FailedAuthThrottle, IP_COUNTER_PREFIX
+from djforge_redis_multitokens.tokens_auth import MultiToken, RECENTLY_WRITTEN_TOKENS, TOKENS_CACHE
+from djforge_redis_multitokens.utils import parse_full_token, parse_token
+
+
+REDIS_URL = 'redis://localhost:6379/2'
+SHARD_URLS = ['redis://localhost:6379/3', 'redis://localhost:6379/4', 'redis://localhost:6379/5']
+# databases that don't replicate anything, standing for replicas that lag behind
+REPLICA_URLS = ['redis://localhost:6379/7', 'redis://localhost:6379/8']
+# a Redis Cluster to run the cluster tests against, like redis://localhost:7000/0
+REDIS_CLUSTER_URL = os.environ.get('REDIS_CLUSTER_URL')
+DEMO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestRedisStorage(TestCase):
+
+    def setUp(self):
+        self.storage = RedisStorage(REDIS_URL, key_prefix='tokens')
+        self.storage.clear()
+        self.addCleanup(self.storage.clear)
+
+    def test_keys_are_prefixed(self):
+        self.storage.set(1, ['hash'], None)
+
+        self.assertEqual(self.storage.make_key(1), 'tokens:1')
+        self.assertTrue(self.storage.client.exists('tokens:1'))
+        self.assertEqual(self.storage.get(1), ['hash'])
+
+    def test_missing_keys_are_left_out_of_get_many(self):
+        self.storage.set('a', '1', None)
+        self.assertEqual(self.storage.get_many(['a', 'b']), {'a': '1'})
+
+    def test_ttl(self):
+        self.storage.set('a', '1', 100)
+        self.storage.set('b', '1', None)
+
+        self.assertEqual(self.storage.ttl('a'), 100)
+        self.assertIsNone(self.storage.ttl('b'))
+        self.assertEqual(self.storage.ttl('c'), 0)
+
+        self.storage.persist('a')
+        self.storage.expire('b', 50)
+        self.assertIsNone(self.storage.ttl('a'))
+        self.assertEqual(self.storage.ttl('b'), 50)
+
+    def test_clear_only_removes_prefixed_keys(self):
+        self.storage.set('a', '1', None)
+        self.storage.client.set('other', '1')
+        self.addCleanup(self.storage.client.delete, 'other')
+
+        self.storage.clear()
+
+        self.assertIsNone(self.storage.get('a'))
+        self.assertTrue(self.storage.client.exists('other'))
+
+    def test_cluster_with_legacy_token_format_is_rejected(self):
+        with patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings()):
+            self.assertRaises(ImproperlyConfigured, RedisStorage, REDIS_URL, hash_tags=True, cluster=True)
+
+
+class TestCompactRedisStorage(TestCase):
+
+    def setUp(self):
+        self.storage = CompactRedisStorage(REDIS_URL, key_prefix='tokens')
+        self.addCleanup(self.storage.clear)
+
+    def test_token_key_is_a_short_binary_digest(self):
+        token_key = self.storage.token_key('$pbkdf2-sha256$29000$salt$checksum')
+
+        self.assertEqual(len(token_key), 16)
+        self.assertEqual(self.storage.make_key(token_key), b'tokens:' + token_key)
+
+    def test_user_pk_is_stored_without_pickle(self):
+        self.storage.set(b'key', '42', None)
+
+        self.assertEqual(self.storage.client.get(b'tokens:key'), b'42')
+        self.assertEqual(self.storage.get(b'key'), '42')
+
+    def test_other_values_are_pickled(self):
+        self.storage.set(1, [b'key1', b'key2'], None)
+        self.assertEqual(self.storage.get(1), [b'key1', b'key2'])
+
+
+class TestHashTags(TestCase):
+
+    def test_user_keys_are_tagged_with_the_user_tag(self):
+        storage = RedisStorage(REDIS_URL, key_prefix='tokens', hash_tags=True)
+        self.assertEqual(storage.make_key(42), 'tokens:{%s}:42' % make_user_tag(42))
+
+    def test_v1_token_keys_are_tagged_with_the_tag_in_their_id(self):
+        self.assertEqual(get_hash_tag('$mt1$' + make_user_tag(42) + 'random'), make_user_tag(42))
+        self.assertEqual(get_hash_tag(b'$mt1$' + make_user_tag(42).encode() + b'random'), make_user_tag(42))
+
+    def test_legacy_token_keys_are_not_tagged(self):
+        storage = RedisStorage(REDIS_URL, key_prefix='tokens', hash_tags=True)
+
+        self.assertEqual(storage.make_key('$pbkdf2-sha256$hash'), 'tokens:$pbkdf2-sha256$hash')
+        self.assertIsNone(get_hash_tag(CompactRedisStorage(REDIS_URL).token_key('$pbkdf2-sha256$hash')))
+
+    def test_compact_storage_keeps_the_tag_of_v1_tokens(self):
+        storage = CompactRedisStorage(REDIS_URL, key_prefix='tokens', hash_tags=True)
+        token_key = storage.token_key('$mt1$' + make_user_tag(42) + 'random')
+
+        self.assertEqual(storage.make_key(token_key), ('tokens:{%s}:$mt1$%srandom' % ((make_user_tag(42),) * 2)).encode())
+
+    def test_devices_keys_are_tagged_with_the_user_tag(self):
+        self.assertEqual(get_hash_tag('devices:42'), make_user_tag(42))
+
+    def test_keys_are_not_tagged_by_default(self):
+        self.assertEqual(RedisStorage(REDIS_URL, key_prefix='tokens').make_key(42), 'tokens:42')
+
+
+class TestGetStorage(TestCase):
+
+    def test_django_cache_storage_is_the_default(self):
+        with patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings()):
+            self.assertIsInstance(get_storage(), DjangoCacheStorage)
+
+    def test_django_cache_is_bound_on_first_use(self):
+        with patch('djforge_redis_multitokens.storage.caches') as mocked_caches:
+            storage = DjangoCacheStorage('tokens')
+            mocked_caches.__getitem__.assert_not_called()
+
+            storage.get('key')
+            storage.get('key')
+        mocked_caches.__getitem__.assert_called_once_with('tokens')
+
+    def test_storage_is_built_on_first_use(self):
+        # a new process, like a management command that doesn't authenticate requests
+        code = (
+            'import sys, django; django.setup(); '
+            'print("djforge_redis_multitokens.tokens_auth" in sys.modules); '
+            'from django.utils.functional import empty; '
+            'from djforge_redis_multitokens.tokens_auth import TOKENS_STORAGE; '
+            'print(TOKENS_STORAGE._wrapped is empty)'
+        )
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'demo.settings')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=DEMO_DIR)
+
+        self.assertEqual(output.split(), [b'False', b'True'])
+
+    def test_redis_storage_is_built_from_settings(self):
+        storage_settings = {'URL': REDIS_URL, 'KEY_PREFIX': 'tokens', 'OPTIONS': {'max_connections': 5}}
+        with patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(STORAGE=storage_settings)):
+            storage = get_storage()
+
+        self.assertIsInstance(storage, RedisStorage)
+        self.assertEqual(storage.key_prefix, 'tokens')
+        self.assertEqual(storage.client.connection_pool.max_connections, 5)
+        self.assertFalse(storage.hash_tags)
+
+    def test_hash_tags_are_enabled_from_settings(self):
+        storage_settings = {'URL': REDIS_URL, 'HASH_TAGS': True}
+        with patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(STORAGE=storage_settings)):
+            self.assertTrue(get_storage().hash_tags)
+
+
+class TestMultiTokenWithRedisStorage(TestCase):
+    storage_class = RedisStorage
+    user_tokens_index = 'list'
+
+    def setUp(self):
+        self.storage = self.storage_class(REDIS_URL, key_prefix='tokens')
+        library_settings = MockedLibrarySettings(
+            STORAGE={'URL': REDIS_URL, 'TIMEOUT': 1000},
+            USER_TOKENS_INDEX=self.user_tokens_index,
+        )
+        for target, new in (('TOKENS_STORAGE', self.storage), ('drt_settings', library_settings)):
+            patcher = patch('djforge_redis_multitokens.tokens_auth.' + target, new=new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        resolve_ttl_again(self)
+
+        self.storage.clear()
+        self.addCleanup(self.storage.clear)
+
+        self.user = create_test_user()
+        self.token, self.first_device = MultiToken.create_token(self.user)
+        self.token_key = self.storage.token_key(parse_full_token(self.token.key)[1])
+
+    def test_token_is_stored_with_timeout_from_storage_settings(self):
+        self.assertTrue(self.first_device)
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [self.token_key])
+        self.assertEqual(self.storage.ttl(self.token_key), 1000)
+
+    def test_user_is_found_for_token(self):
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+
+    def test_tokens_ttl_is_reset_in_one_script_call(self):
+        self.storage.expire(self.token_key, 10)
+
+        execute_command = redis.StrictRedis.execute_command
+        with patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command) as mocked:
+            MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(mocked.call_count, 2)
+        self.assertEqual(self.storage.ttl(self.token_key), 1000)
+
+    def test_all_tokens_are_expired(self):
+        MultiToken.create_token(self.user)
+        MultiToken.expire_all_tokens(self.user)
+
+        self.assertEqual(self.storage.client.keys('tokens:*'), [])
+
+    def test_token_is_expired(self):
+        MultiToken.expire_token(self.token)
+
+        self.assertIsNone(self.storage.get(self.token_key))
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [])
+
+
+class TestMultiTokenWithRedisStorageAndSortedSet(TestMultiTokenWithRedisStorage):
+    user_tokens_index = 'set'
+
+
+class TestMultiTokenWithCompactRedisStorage(TestMultiTokenWithRedisStorage):
+    storage_class = CompactRedisStorage
+
+    def test_token_key_maps_to_raw_user_pk(self):
+        self.assertEqual(self.storage.client.get(self.storage.make_key(self.token_key)), str(self.user.pk).encode())
+
+
+class TestMultiTokenWithCompactRedisStorageAndSortedSet(TestMultiTokenWithCompactRedisStorage):
+    user_tokens_index = 'set'
+
+
+class TestMultiTokenWithHashTags(TestCase):
+    storage_class = RedisStorage
+    user_tokens_index = 'set'
+
+    def setUp(self):
+        self.storage = self.make_storage()
+        self.library_settings = MockedLibrarySettings(
+            STORAGE={'URL': REDIS_URL, 'TIMEOUT': 1000},
+            USER_TOKENS_INDEX=self.user_tokens_index,
+            TOKEN_FORMAT='mt1',
+        )
+        for target, new in (('TOKENS_STORAGE', self.storage), ('drt_settings', self.library_settings)):
+            patcher = patch('djforge_redis_multitokens.tokens_auth.' + target, new=new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        resolve_ttl_again(self)
+
+        self.storage.clear()
+        self.addCleanup(self.storage.clear)
+
+        self.user = create_test_user()
+        self.token, _ = MultiToken.create_token(self.user)
+        self.token_key = self.storage.token_key(parse_token(self.token.key)[1])
+
+    def make_storage(self):
+        return self.storage_class(REDIS_URL, key_prefix='tokens', hash_tags=True)
+
+    def test_user_index_and_tokens_share_the_hash_tag(self):
+        tag = '{%s}' % make_user_tag(self.user.pk)
+
+        self.assertIn(tag, self.storage.make_key(self.user.pk))
+        self.assertIn(tag, str(self.storage.make_key(self.token_key)))
+
+    def test_user_is_found_for_token(self):
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+
+    def test_tokens_ttl_is_reset(self):
+        self.storage.expire(self.token_key, 10)
+        MultiToken.reset_tokens_ttl_many([self.user.pk])
+        self.assertEqual(self.storage.ttl(self.token_key), 1000)
+
+    def test_tokens_over_the_cap_are_evicted(self):
+        self.library_settings.MAX_TOKENS_PER_USER = 1
+        MultiToken.create_token(self.user)
+
+        self.assertRaises(get_user_model().DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+
+    def test_all_tokens_are_expired(self):
+        MultiToken.create_token(self.user)
+        MultiToken.expire_all_tokens(self.user)
+
+        self.assertEqual(list(self.storage.client.scan_iter(match='tokens:*')), [])
+
+    def test_dangling_hashes_are_pruned(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        self.storage.delete(self.token_key)
+
+        with patch.object(prune_tokens, 'TOKENS_STORAGE', new=self.storage):
+            call_command('prune_tokens', stdout=StringIO())
+
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [
+            self.storage.token_key(parse_token(second_token.key)[1]),
+        ])
+
+    @patch('djforge_redis_multitokens.throttling.drt_settings', new=MockedLibrarySettings(FAILED_AUTH_LIMIT_PER_IP=3))
+    def test_dangling_hashes_are_pruned_with_failed_auth_counters(self):
+        FailedAuthThrottle(self.storage).record_failure([(IP_COUNTER_PREFIX + '10.0.0.1', 3)])
+        self.storage.delete(self.token_key)
+
+        with patch.object(prune_tokens, 'TOKENS_STORAGE', new=self.storage):
+            call_command('prune_tokens', stdout=StringIO())
+
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [])
+
+    def test_devices_are_listed(self):
+        second_token, _ = MultiToken.create_token(self.user, device={'label': 'phone'})
+        MultiToken.create_token(self.user, device={'label': 'laptop'})
+        MultiToken.expire_token(second_token)
+
+        self.assertEqual([device['label'] for device in MultiToken.list_tokens(self.user)], ['laptop'])
+
+    @patch('djforge_redis_multitokens.tokens_auth.RECENTLY_SEEN_TOKENS', new=LocalTTLCache(10, 60))
+    def test_last_seen_is_listed_and_dropped_with_its_device(self):
+        token, _ = MultiToken.create_token(self.user, device={'label': 'phone', 'created_at': 1000})
+        MultiToken._touch_device(self.user.pk, token.key)
+        self.assertGreater(MultiToken.list_tokens(self.user)[0]['last_seen'], 1000)
+
+        self.storage.delete(self.storage.token_key(parse_token(token.key)[1]))
+        self.assertEqual(MultiToken.list_tokens(self.user), [])
+        client = self.storage.get_client(self.user.pk)
+        self.assertEqual(client.hlen(self.storage.make_key('devices:%s' % self.user.pk)), 0)
+
+
+class TestMultiTokenWithHashTagsAndCompactStorage(TestMultiTokenWithHashTags):
+    storage_class = CompactRedisStorage
+
+
+@unittest.skipUnless(REDIS_CLUSTER_URL, 'REDIS_CLUSTER_URL is not set')
+class TestMultiTokenOnRedisCluster(TestMultiTokenWithHashTags):
+
+    def setUp(self):
+        patcher = patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(TestMultiTokenOnRedisCluster, self).setUp()
+
+    def make_storage(self):
+        return self.storage_class(REDIS_CLUSTER_URL, key_prefix='tokens', hash_tags=True, cluster=True)
+
+
+class TestShardedRedisStorage(TestCase):
+
+    def setUp(self):
+        patcher = patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.storage = ShardedRedisStorage(SHARD_URLS, key_prefix='tokens')
+        self.addCleanup(self.storage.clear)
+
+    def test_users_are_spread_over_the_shards(self):
+        shards = set(id(self.storage.get_shard(user_pk)) for user_pk in range(100))
+        self.assertEqual(len(shards), 3)
+
+    def test_v1_tokens_are_on_the_shard_of_their_user(self):
+        for user_pk in range(20):
+            token_key = '$mt1$' + make_user_tag(user_pk) + 'random'
+            self.assertIs(self.storage.get_shard(token_key), self.storage.get_shard(user_pk))
+
+    def test_redis_keys_are_mapped_back_to_their_shard(self):
+        for user_pk in range(20):
+            redis_key = self.storage.make_key(user_pk).encode()
+            self.assertIs(self.storage.get_shard_of_redis_key(redis_key), self.storage.get_shard(user_pk))
+
+    def test_adding_a_shard_moves_a_fraction_of_the_users(self):
+        larger_storage = ShardedRedisStorage(SHARD_URLS + ['redis://localhost:6379/6'], key_prefix='tokens')
+
+        def get_shard_name(storage, user_pk):
+            shard = storage.get_shard(user_pk)
+            return next(name for name in storage.shards if storage.shards[name] is shard)
+
+        moved = [
+            user_pk for user_pk in range(1000)
+            if get_shard_name(larger_storage, user_pk) != get_shard_name(self.storage, user_pk)
+        ]
+        # about a quarter of the users go to the new shard, none move between the old ones
+        self.assertLess(len(moved), 400)
+        self.assertEqual(set(get_shard_name(larger_storage, user_pk) for user_pk in moved), {'redis://localhost:6379/6'})
+
+    def test_get_many_reads_from_all_shards(self):
+        for user_pk in range(10):
+            self.storage.set(user_pk, [str(user_pk)], None)
+
+        self.assertEqual(self.storage.get_many(range(11)), dict((i, [str(i)]) for i in range(10)))
+
+    def test_replicas_are_rejected(self):
+        self.assertRaises(ImproperlyConfigured, ShardedRedisStorage, SHARD_URLS, replica_urls=REPLICA_URLS)
+
+    def test_legacy_token_format_is_rejected(self):
+        with patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings()):
+            self.assertRaises(ImproperlyConfigured, ShardedRedisStorage, SHARD_URLS)
+
+
+class TestMultiTokenWithShardedStorage(TestMultiTokenWithHashTags):
+    storage_class = ShardedRedisStorage
+
+    def setUp(self):
+        patcher = patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(TestMultiTokenWithShardedStorage, self).setUp()
+
+    def make_storage(self):
+        return self.storage_class(SHARD_URLS, key_prefix='tokens')
+
+    def test_user_index_and_tokens_are_on_one_shard(self):
+        shard = self.storage.get_shard(self.user.pk)
+        self.assertIsNotNone(shard.get(self.token_key))
+
+    def test_all_tokens_are_expired(self):
+        MultiToken.create_token(self.user)
+        MultiToken.expire_all_tokens(self.user)
+
+        for client in self.storage.get_all_clients():
+            self.assertEqual(list(client.scan_iter(match='tokens:*')), [])
+
+    def test_tokens_of_users_on_different_shards_are_expired(self):
+        users = [self.user] + [create_test_user('tester%d' % i) for i in range(2, 10)]
+        tokens = [MultiToken.create_token(user)[0] for user in users]
+
+        MultiToken.expire_all_tokens_for_users([user.pk for user in users])
+
+        for token in tokens:
+            self.assertRaises(get_user_model().DoesNotExist, MultiToken.get_user_from_token, token.key)
+
+    def test_tokens_of_users_on_different_shards_are_refreshed(self):
+        users = [self.user] + [create_test_user('tester%d' % i) for i in range(2, 10)]
+        token_keys = [
+            self.storage.token_key(parse_token(MultiToken.create_token(user)[0].key)[1]) for user in users
+        ]
+        for token_key in token_keys:
+            self.storage.expire(token_key, 10)
+
+        MultiToken.reset_tokens_ttl_many([user.pk for user in users])
+
+        self.assertEqual([self.storage.ttl(token_key) for token_key in token_keys], [1000] * len(users))
+
+
+class TestMultiTokenWithShardedCompactStorage(TestMultiTokenWithShardedStorage):
+    storage_class = ShardedCompactRedisStorage
+
+
+class TestRebalanceTokensCommand(TestCase):
+    user_tokens_index = 'set'
+
+    def setUp(self):
+        patcher = patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.old_storage = ShardedRedisStorage(SHARD_URLS[:1], key_prefix='tokens')
+        self.storage = ShardedRedisStorage(SHARD_URLS, key_prefix='tokens')
+        self.addCleanup(self.storage.clear)
+
+        self.library_settings = MockedLibrarySettings(
+            STORAGE={'URL': SHARD_URLS, 'TIMEOUT': 1000},
+            USER_TOKENS_INDEX=self.user_tokens_index,
+            TOKEN_FORMAT='mt1',
+        )
+        self.patch_storage(self.old_storage)
+        resolve_ttl_again(self)
+        self.users = [create_test_user('tester%d' % i) for i in range(10)]
+        self.tokens = [MultiToken.create_token(user)[0] for user in self.users]
+        self.patch_storage(self.storage)
+
+    def patch_storage(self, storage):
+        for target, new in (
+            ('djforge_redis_multitokens.tokens_auth.TOKENS_STORAGE', storage),
+            ('djforge_redis_multitokens.tokens_auth.drt_settings', self.library_settings),
+            ('djforge_redis_multitokens.management.commands.rebalance_tokens.TOKENS_STORAGE', storage),
+        ):
+            patcher = patch(target, new=new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_keys_are_moved_to_their_new_shard(self):
+        out = StringIO()
+        call_command('rebalance_tokens', stdout=out)
+
+        self.assertIn('Moved', out.getvalue())
+        for user, token in zip(self.users, self.tokens):
+            self.assertEqual(MultiToken.get_user_from_token(token.key).pk, user.pk)
+            self.assertEqual(len(MultiToken._get_user_hashes(user.pk)), 1)
+            self.assertEqual(self.storage.ttl(user.pk), 1000)
+
+    def test_dry_run_does_not_move_keys(self):
+        out = StringIO()
+        call_command('rebalance_tokens', '--dry-run', stdout=out)
+
+        self.assertIn('keys would be moved', out.getvalue())
+        self.assertNotIn(' 0 keys', out.getvalue())
+        # the index and the token of each user
+        self.assertEqual(len(self.old_storage.shards[SHARD_URLS[0]].client.keys('tokens:*')), 20)
+
+    def test_index_written_after_adding_a_shard_is_merged(self):
+        new_tokens = [MultiToken.create_token(user)[0] for user in self.users]
+        call_command('rebalance_tokens', stdout=StringIO())
+
+        for user, token, new_token in zip(self.users, self.tokens, new_tokens):
+            self.assertEqual(MultiToken._get_user_hashes(user.pk), [
+                self.storage.token_key(parse_token(token.key)[1]),
+                self.storage.token_key(parse_token(new_token.key)[1]),
+            ])
+
+
+    def test_devices_written_after_adding_a_shard_are_merged(self):
+        # a user whose keys move to a new shard
+        user = next(user for user in self.users if self.storage.get_shard(user.pk) is not self.storage.shards[SHARD_URLS[0]])
+
+        self.patch_storage(self.old_storage)
+        MultiToken.create_token(user, device={'label': 'phone'})
+        self.patch_storage(self.storage)
+        MultiToken.create_token(user, device={'label': 'laptop'})
+
+        call_command('rebalance_tokens', stdout=StringIO())
+
+        devices = MultiToken.list_tokens(user)
+        self.assertEqual(sorted(device['label'] for device in devices), ['laptop', 'phone'])
+
+    @patch('djforge_redis_multitokens.throttling.drt_settings', new=MockedLibrarySettings(FAILED_AUTH_LIMIT_PER_IP=3))
+    def test_failed_auth_counters_written_after_adding_a_shard_are_kept(self):
+        # a counter that moves to a new shard
+        counter = next(
+            IP_COUNTER_PREFIX + '10.0.0.%d' % i for i in range(100)
+            if self.storage.get_shard(IP_COUNTER_PREFIX + '10.0.0.%d' % i) is not self.storage.shards[SHARD_URLS[0]]
+        )
+        FailedAuthThrottle(self.old_storage).record_failure([(counter, 3)])
+        FailedAuthThrottle(self.storage).record_failure([(counter, 3)])
+
+        call_command('rebalance_tokens', stdout=StringIO())
+
+        redis_key = self.storage.make_key(counter)
+        self.assertEqual(self.storage.get_client(counter).get(redis_key), b'1')
+
+    def test_keys_of_removed_shards_are_moved(self):
+        call_command('rebalance_tokens', stdout=StringIO())
+        smaller_storage = ShardedRedisStorage(SHARD_URLS[:2], key_prefix='tokens')
+        self.patch_storage(smaller_storage)
+
+        call_command('rebalance_tokens', '--source-url', SHARD_URLS[2], stdout=StringIO())
+
+        for user, token in zip(self.users, self.tokens):
+            self.assertEqual(MultiToken.get_user_from_token(token.key).pk, user.pk)
+
+
+class TestRebalanceTokensCommandWithList(TestRebalanceTokensCommand):
+    user_tokens_index = 'list'
+
+
+class TestReplicaSet(TestCase):
+
+    def setUp(self):
+        self.replicas = ReplicaSet(REPLICA_URLS)
+        for i, client in enumerate(self.replicas.clients):
+            client.set('key', str(i))
+            self.addCleanup(client.delete, 'key')
+
+    def test_replicas_are_read_in_turn(self):
+        self.assertEqual([self.replicas.get('key') for _ in range(4)], [b'0', b'1', b'0', b'1'])
+
+    def test_fastest_replica_is_read(self):
+        self.replicas = ReplicaSet(REPLICA_URLS, 'least_latency')
+        self.replicas.latencies = [1.0, 0.001]
+
+        values = [self.replicas.get('key') for _ in range(ReplicaSet.PROBE_EVERY)]
+        # the first read probes the first replica
+        self.assertEqual(values, [b'0'] + [b'1'] * (ReplicaSet.PROBE_EVERY - 1))
+        self.assertLess(self.replicas.latencies[0], 1.0)
+
+    def test_failing_replica_is_reported_as_missing(self):
+        replicas = ReplicaSet(['redis://localhost:1/0'])
+
+        self.assertIsNone(replicas.get('key'))
+        self.assertEqual(replicas.latencies, [ReplicaSet.FAILED_LATENCY])
+
+    def test_unknown_selection_is_rejected(self):
+        self.assertRaises(ImproperlyConfigured, ReplicaSet, REPLICA_URLS, 'random')
+
+
+class TestMultiTokenWithReplicas(TestCase):
+
+    def setUp(self):
+        self.storage = RedisStorage(REDIS_URL, key_prefix='tokens', replica_urls=REPLICA_URLS[:1])
+        self.replica = self.storage.replicas.clients[0]
+        for target, new in (
+            ('TOKENS_STORAGE', self.storage),
+            ('drt_settings', MockedLibrarySettings(STORAGE={'URL': REDIS_URL, 'TIMEOUT': 1000})),
+        ):
+            patcher = patch('djforge_redis_multitokens.tokens_auth.' + target, new=new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        resolve_ttl_again(self)
+
+        self.storage.clear()
+        self.addCleanup(self.storage.clear)
+        self.addCleanup(self.replica.flushdb)
+        self.addCleanup(RECENTLY_WRITTEN_TOKENS.clear)
+
+        self.user = create_test_user()
+        self.token, _ = MultiToken.create_token(self.user)
+        self.redis_key = self.storage.make_key(parse_full_token(self.token.key)[1])
+
+    def test_token_missing_from_the_replica_is_read_from_the_primary(self):
+        RECENTLY_WRITTEN_TOKENS.clear()
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+
+    def test_token_is_read_from_the_replica(self):
+        RECENTLY_WRITTEN_TOKENS.clear()
+        self.replica.set(self.redis_key, self.storage.client.get(self.redis_key))
+        self.storage.client.delete(self.redis_key)
+
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+
+    def test_expired_token_is_read_from_the_primary(self):
+        self.replica.set(self.redis_key, self.storage.client.get(self.redis_key))
+        MultiToken.expire_token(self.token)
+
+        self.assertRaises(get_user_model().DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+
+    def test_replicas_are_built_from_settings(self):
+        storage_settings = {'URL': REDIS_URL, 'REPLICA_URLS': REPLICA_URLS, 'REPLICA_SELECTION': 'least_latency'}
+        with patch('djforge_redis_multitokens.storage.drt_settings', new=MockedLibrarySettings(STORAGE=storage_settings)):
+            storage = get_storage()
+
+        self.assertEqual(len(storage.replicas.clients), 2)
+        self.assertEqual(storage.replicas.selection, 'least_latency')
+
+
+class TestMigrateTokensFormatCommand(SetupTearDownForMultiTokenTests, TestCase):
+    user_tokens_index = 'list'
+
+    def setUp(self):
+        super(TestMigrateTokensFormatCommand, self).setUp()
+        self.second_token, _ = MultiToken.create_token(self.user)
+
+        self.storage = CompactRedisStorage(REDIS_URL, key_prefix='tokens')
+        library_settings = MockedLibrarySettings(
+            STORAGE={'URL': REDIS_URL, 'TIMEOUT': 1000},
+            USER_TOKENS_INDEX=self.user_tokens_index,
+        )
+        for target, new in (
+            ('djforge_redis_multitokens.tokens_auth.TOKENS_STORAGE', self.storage),
+            ('djforge_redis_multitokens.tokens_auth.drt_settings', library_settings),
+            ('djforge_redis_multitokens.management.commands.migrate_tokens_format.TOKENS_STORAGE', self.storage),
+            ('djforge_redis_multitokens.management.commands.migrate_tokens_format.drt_settings', library_settings),
+        ):
+            patcher = patch(target, new=new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        resolve_ttl_again(self)
+
+        self.storage.clear()
+        self.addCleanup(self.storage.clear)
+
+    def test_tokens_are_copied_to_compact_storage(self):
+        out = StringIO()
+        call_command('migrate_tokens_format', stdout=out)
+
+        self.assertIn('Migrated 2 tokens of 1 users', out.getvalue())
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+        self.assertEqual(MultiToken.get_user_from_token(self.second_token.key).pk, self.user.pk)
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [
+            self.storage.token_key(parse_full_token(self.token.key)[1]),
+            self.storage.token_key(parse_full_token(self.second_token.key)[1]),
+        ])
+
+    def test_source_keys_are_deleted(self):
+        call_command('migrate_tokens_format', stdout=StringIO())
+
+        self.assertIsNone(TOKENS_CACHE.get(self.user.pk))
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+    def test_source_keys_are_kept(self):
+        call_command('migrate_tokens_format', '--keep-source', stdout=StringIO())
+        self.assertIsNotNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+    def test_source_keys_are_kept_when_writing_fails(self):
+        with patch.object(redis.client.Pipeline, 'execute', side_effect=redis.ConnectionError):
+            self.assertRaises(redis.ConnectionError, call_command, 'migrate_tokens_format', stdout=StringIO())
+
+        self.assertEqual(len(TOKENS_CACHE.get(self.user.pk)), 2)
+        self.assertIsNotNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+    def test_source_sharing_the_index_key_is_migrated(self):
+        source = RedisStorage(REDIS_URL, key_prefix='tokens')
+        hash = parse_full_token(self.token.key)[1]
+        source.set(hash, str(self.user.pk), 1000)
+        source.set(self.user.pk, [hash], 1000)
+
+        call_command('migrate_tokens_format', '--source-url', REDIS_URL, '--source-prefix', 'tokens', stdout=StringIO())
+
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [self.storage.token_key(hash)])
+        self.assertIsNone(source.client.get(source.make_key(hash)))
+
+
+class TestMigrateTokensFormatCommandWithSortedSet(TestMigrateTokensFormatCommand):
+    user_tokens_index = 'set'
@@ -0,0 +1,98 @@
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.test import TestCase
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from .utils import MockedLibrarySettings, SetupTearDownForMultiTokenTests
+from djforge_redis_multitokens.throttling import IP_COUNTER_PREFIX, TOKEN_COUNTER_PREFIX
+from djforge_redis_multitokens.tokens_auth import FAILED_AUTH_THROTTLE, TOKENS_STORAGE
+
+
+class TestFailedAuthThrottle(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestFailedAuthThrottle, self).setUp()
+        FAILED_AUTH_THROTTLE.clear()
+        self.addCleanup(FAILED_AUTH_THROTTLE.clear)
+
+        self.settings = MockedLibrarySettings(FAILED_AUTH_LIMIT_PER_IP=3, FAILED_AUTH_LIMIT_PER_TOKEN=None)
+        patcher = patch('djforge_redis_multitokens.throttling.drt_settings', new=self.settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, token_key, ip='10.0.0.1'):
+        client = APIClient(enforce_csrf_checks=True)
+        return client.post(
+            '/token/', {'example': 'example'}, HTTP_AUTHORIZATION='Token ' + token_key, REMOTE_ADDR=ip,
+        )
+
+    def test_client_is_throttled_after_limit_of_failures(self):
+        for i in range(3):
+            self.assertEqual(self.post(self.token.key + str(i)).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.post(self.token.key)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+    def test_other_clients_are_not_throttled(self):
+        for i in range(3):
+            self.post(self.token.key + str(i))
+
+        self.assertEqual(self.post(self.token.key, ip='10.0.0.2').status_code, status.HTTP_200_OK)
+
+    def test_successful_auth_is_not_counted(self):
+        for i in range(5):
+            self.assertEqual(self.post(self.token.key).status_code, status.HTTP_200_OK)
+
+    def test_failures_are_shared_between_processes(self):
+        for i in range(3):
+            self.post(self.token.key + str(i))
+        # another process hasn't seen the failures
+        FAILED_AUTH_THROTTLE.clear()
+
+        self.assertEqual(self.post(self.token.key).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_blocked_client_is_rejected_without_redis(self):
+        for i in range(3):
+            self.post(self.token.key + str(i))
+
+        with patch.object(FAILED_AUTH_THROTTLE, '_get_counts') as mocked_get_counts:
+            self.assertEqual(self.post(self.token.key).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        mocked_get_counts.assert_not_called()
+
+    def test_counter_expires_after_window(self):
+        self.settings.FAILED_AUTH_WINDOW = 30
+        self.post(self.token.key + 'blah')
+
+        redis_key = TOKENS_STORAGE.make_key(IP_COUNTER_PREFIX + '10.0.0.1')
+        self.assertEqual(TOKENS_STORAGE.get_client(redis_key).ttl(redis_key), 30)
+
+    def test_token_is_throttled_across_clients(self):
+        self.settings.FAILED_AUTH_LIMIT_PER_IP = None
+        self.settings.FAILED_AUTH_LIMIT_PER_TOKEN = 2
+        wrong_key = ('a' if self.token.key[0] != 'a' else 'b') + self.token.key[1:]
+
+        self.post(wrong_key, ip='10.0.0.1')
+        self.post(wrong_key, ip='10.0.0.2')
+
+        # the hash is the same, whatever the secret sent with it
+        self.assertEqual(self.post(self.token.key, ip='10.0.0.3').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        counters = FAILED_AUTH_THROTTLE.get_counters('10.0.0.3', self.token.key)
+        self.assertTrue(counters[0][0].startswith(TOKEN_COUNTER_PREFIX))
+
+    def test_malformed_token_is_only_counted_per_client(self):
+        self.settings.FAILED_AUTH_LIMIT_PER_TOKEN = 2
+        counters = FAILED_AUTH_THROTTLE.get_counters('10.0.0.1', 'malformed')
+        self.assertEqual(counters, [(IP_COUNTER_PREFIX + '10.0.0.1', 3)])
+
+    def test_throttling_is_disabled_by_default(self):
+        self.settings.FAILED_AUTH_LIMIT_PER_IP = None
+        self.assertFalse(FAILED_AUTH_THROTTLE.enabled)
+
+        for i in range(5):
+            self.post(self.token.key + str(i))
+        self.assertEqual(self.post(self.token.key).status_code, status.HTTP_200_OK)
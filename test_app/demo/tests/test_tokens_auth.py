@@ -2,8 +2,17 @@ try:
     from unittest.mock import patch
 except ImportError:
     from mock import patch
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
+import redis
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db.models.signals import post_delete, post_save
 from django.test import TestCase
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -11,10 +20,21 @@ from rest_framework.test import APIClient
 from .utils import (
     create_test_user,
     MockedLibrarySettings,
-    MockedSettings,
+    override_tokens_timeout,
     SetupTearDownForMultiTokenTests,
 )
-from djforge_redis_multitokens.tokens_auth import MultiToken, TOKENS_CACHE
+from djforge_redis_multitokens.crypto import make_user_tag
+from djforge_redis_multitokens.local_cache import LocalTTLCache
+from djforge_redis_multitokens.redis_utils import get_redis_client, make_redis_key, run_script
+from djforge_redis_multitokens.scripts import TOUCH_DEVICE
+from djforge_redis_multitokens.signals import USER_CACHE_INVALIDATION_UID
+from djforge_redis_multitokens.tokens_auth import (
+    INVALID_TOKEN,
+    LazyUser,
+    MultiToken,
+    TOKENS_CACHE,
+    UNKNOWN_USER,
+)
 from djforge_redis_multitokens.utils import parse_full_token
 
 
@@ -73,6 +93,289 @@ class TestGetUserFromTokenMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, wrong_token)
 
 
+class TestVerifiedTokensCache(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestVerifiedTokensCache, self).setUp()
+        patcher = patch('djforge_redis_multitokens.tokens_auth.VERIFIED_TOKENS_CACHE', new=LocalTTLCache(10, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_is_verified_only_once(self):
+        with patch('djforge_redis_multitokens.tokens_auth.verify_token', return_value=True) as mocked_verify:
+            MultiToken.get_user_from_token(self.token.key)
+            user = MultiToken.get_user_from_token(self.token.key)
+
+        self.assertEqual(mocked_verify.call_count, 1)
+        self.assertEqual(user.pk, self.user.pk)
+
+    @patch('djforge_redis_multitokens.tokens_auth.REJECTED_TOKENS_CACHE', new=LocalTTLCache(0, 10))
+    def test_failed_verification_is_not_cached(self):
+        wrong_token = 'wrong' + self.token.key
+        with patch('djforge_redis_multitokens.tokens_auth.verify_token', return_value=False) as mocked_verify:
+            self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, wrong_token)
+            self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, wrong_token)
+
+        self.assertEqual(mocked_verify.call_count, 2)
+
+    def test_cached_hash_does_not_accept_a_different_token(self):
+        MultiToken.get_user_from_token(self.token.key)
+        token, hash = parse_full_token(self.token.key)
+        forged_key = self.token.key.replace(token, token[::-1], 1)
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, forged_key)
+
+    def test_expired_token_is_removed_from_cache(self):
+        MultiToken.get_user_from_token(self.token.key)
+        MultiToken.expire_token(self.token)
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+
+    def test_all_tokens_are_removed_from_cache_when_all_tokens_expire(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        MultiToken.get_user_from_token(self.token.key)
+        MultiToken.get_user_from_token(second_token.key)
+        MultiToken.expire_all_tokens(self.user)
+
+        with patch('djforge_redis_multitokens.tokens_auth.verify_token', return_value=False):
+            self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+            self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, second_token.key)
+
+
+class TestRejectedTokensCache(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestRejectedTokensCache, self).setUp()
+        patcher = patch('djforge_redis_multitokens.tokens_auth.REJECTED_TOKENS_CACHE', new=LocalTTLCache(10, 10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        execute_command = redis.StrictRedis.execute_command
+        patcher = patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command)
+        self.execute_command = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unknown_hash_is_rejected_before_hashing(self):
+        token, hash = parse_full_token(self.token.key)
+        with patch('djforge_redis_multitokens.tokens_auth.verify_token') as mocked_verify:
+            self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, token + ':hash:' + hash[:-1])
+
+        self.assertEqual(mocked_verify.call_count, 0)
+
+    def test_malformed_token_is_rejected_without_redis(self):
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, 'malformed')
+        self.assertEqual(self.execute_command.call_count, 0)
+
+    def test_rejected_token_is_not_looked_up_again(self):
+        token, hash = parse_full_token(self.token.key)
+        wrong_token = self.token.key.replace(token, token[::-1], 1)
+
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, wrong_token)
+        self.execute_command.reset_mock()
+        with patch('djforge_redis_multitokens.tokens_auth.verify_token') as mocked_verify:
+            self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, wrong_token)
+
+        self.assertEqual(self.execute_command.call_count, 0)
+        self.assertEqual(mocked_verify.call_count, 0)
+
+    def test_valid_token_is_not_rejected(self):
+        MultiToken.get_user_from_token(self.token.key)
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+
+
+class TestGetUsersFromTokensMethod(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestGetUsersFromTokensMethod, self).setUp()
+        self.second_user = create_test_user('tester2')
+        self.second_token, _ = MultiToken.create_token(self.second_user)
+
+        execute_command = redis.StrictRedis.execute_command
+        patcher = patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command)
+        self.execute_command = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_users_are_found_for_valid_tokens(self):
+        users, failures = MultiToken.get_users_from_tokens([self.token.key, self.second_token.key])
+
+        self.assertEqual(users[self.token.key].pk, self.user.pk)
+        self.assertEqual(users[self.second_token.key].pk, self.second_user.pk)
+        self.assertEqual(failures, {})
+
+    def test_failures_are_reported_separately(self):
+        token, hash = parse_full_token(self.token.key)
+        wrong_token = self.token.key.replace(token, token[::-1], 1)
+        unknown_token = self.token.key[:-1]
+
+        users, failures = MultiToken.get_users_from_tokens([self.token.key, wrong_token, unknown_token, 'malformed'])
+
+        self.assertEqual(list(users), [self.token.key])
+        self.assertEqual(failures, {wrong_token: INVALID_TOKEN, unknown_token: INVALID_TOKEN, 'malformed': INVALID_TOKEN})
+
+    def test_tokens_of_deleted_users_are_reported(self):
+        self.second_user.delete()
+        users, failures = MultiToken.get_users_from_tokens([self.token.key, self.second_token.key])
+
+        self.assertEqual(list(users), [self.token.key])
+        self.assertEqual(failures, {self.second_token.key: UNKNOWN_USER})
+
+    def test_tokens_are_looked_up_with_one_command_and_users_with_one_query(self):
+        self.execute_command.reset_mock()
+        with self.assertNumQueries(1):
+            users, failures = MultiToken.get_users_from_tokens(
+                [self.token.key, self.second_token.key, self.token.key[:-1]],
+            )
+
+        self.assertEqual(len(users), 2)
+        self.assertEqual(self.execute_command.call_count, 1)
+
+    def test_duplicate_tokens_are_verified_once(self):
+        with patch('djforge_redis_multitokens.tokens_auth.verify_token', return_value=True) as mocked_verify:
+            users, failures = MultiToken.get_users_from_tokens([self.token.key, self.token.key])
+
+        self.assertEqual(list(users), [self.token.key])
+        self.assertEqual(mocked_verify.call_count, 1)
+
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(BATCH_VERIFY_WORKERS=1))
+    def test_tokens_are_verified_without_pool(self):
+        users, failures = MultiToken.get_users_from_tokens([self.token.key, self.second_token.key[1:]])
+
+        self.assertEqual(list(users), [self.token.key])
+        self.assertEqual(list(failures), [self.second_token.key[1:]])
+
+    @patch('djforge_redis_multitokens.tokens_auth.ThreadPoolExecutor', new=None)
+    def test_tokens_are_verified_without_concurrent_futures(self):
+        users, failures = MultiToken.get_users_from_tokens([self.token.key, self.second_token.key])
+        self.assertEqual(set(users), {self.token.key, self.second_token.key})
+
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TOKEN_FORMAT='mt1'))
+    def test_v1_tokens_are_supported(self):
+        v1_token, _ = MultiToken.create_token(self.user)
+        users, failures = MultiToken.get_users_from_tokens([v1_token.key, self.second_token.key])
+
+        self.assertEqual(users[v1_token.key].pk, self.user.pk)
+        self.assertEqual(users[self.second_token.key].pk, self.second_user.pk)
+
+    @patch('djforge_redis_multitokens.tokens_auth.LOCAL_USERS_CACHE', new=LocalTTLCache(10, 60))
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(USER_CACHE='local'))
+    def test_cached_users_are_not_queried(self):
+        MultiToken.get_users_from_tokens([self.token.key, self.second_token.key])
+        with self.assertNumQueries(0):
+            users, failures = MultiToken.get_users_from_tokens([self.token.key, self.second_token.key])
+
+        self.assertEqual(users[self.second_token.key].username, self.second_user.username)
+
+
+class TestDevices(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestDevices, self).setUp()
+        self.device_token, _ = MultiToken.create_token(
+            self.user, device={'label': 'phone', 'user_agent': 'Mozilla/5.0', 'created_at': 1000},
+        )
+
+    def test_devices_are_listed_in_creation_order(self):
+        MultiToken.create_token(self.user, device={'label': 'laptop'})
+
+        devices = MultiToken.list_tokens(self.user)
+        self.assertEqual([device['label'] for device in devices], ['phone', 'laptop'])
+        self.assertEqual(devices[0], {
+            'label': 'phone', 'user_agent': 'Mozilla/5.0', 'created_at': 1000, 'last_seen': 1000,
+            'token_id': devices[0]['token_id'],
+        })
+
+    def test_device_is_expired_by_token_id(self):
+        MultiToken.create_token(self.user, device={'label': 'laptop'})
+        token_id = MultiToken.list_tokens(self.user)[0]['token_id']
+
+        self.assertTrue(MultiToken.expire_token_by_id(self.user, token_id))
+
+        self.assertEqual([device['label'] for device in MultiToken.list_tokens(self.user)], ['laptop'])
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.device_token.key)
+        self.assertFalse(MultiToken.expire_token_by_id(self.user, token_id))
+
+    def test_token_id_does_not_reveal_the_hash(self):
+        token_id = MultiToken.list_tokens(self.user)[0]['token_id']
+        self.assertNotIn(token_id, parse_full_token(self.device_token.key)[1])
+
+    def test_token_id_of_another_user_is_not_expired(self):
+        second_user = create_test_user('tester2')
+        token_id = MultiToken.list_tokens(self.user)[0]['token_id']
+
+        self.assertFalse(MultiToken.expire_token_by_id(second_user, token_id))
+        self.assertEqual(MultiToken.get_user_from_token(self.device_token.key).pk, self.user.pk)
+
+    def test_tokens_without_device_are_not_listed(self):
+        self.assertEqual(len(MultiToken.list_tokens(self.user)), 1)
+
+    def test_devices_are_listed_in_one_round_trip(self):
+        MultiToken.list_tokens(self.user)
+
+        execute_command = redis.StrictRedis.execute_command
+        with patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command) as mocked:
+            MultiToken.list_tokens(self.user)
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_expired_token_is_not_listed(self):
+        MultiToken.expire_token(self.device_token)
+        self.assertEqual(MultiToken.list_tokens(self.user), [])
+
+    def test_token_expired_by_redis_is_not_listed(self):
+        TOKENS_CACHE.delete(parse_full_token(self.device_token.key)[1])
+        self.assertEqual(MultiToken.list_tokens(self.user), [])
+
+    def test_devices_are_removed_with_all_tokens(self):
+        MultiToken.expire_all_tokens(self.user)
+
+        client = get_redis_client(TOKENS_CACHE)
+        self.assertFalse(client.exists(make_redis_key(TOKENS_CACHE, 'devices:%s' % self.user.pk)))
+
+    @override_tokens_timeout(1000)
+    def test_devices_ttl_is_reset_with_tokens(self):
+        MultiToken.reset_tokens_ttl(self.user.pk)
+        self.assertEqual(TOKENS_CACHE.ttl('devices:%s' % self.user.pk), 1000)
+
+    @patch('djforge_redis_multitokens.tokens_auth.RECENTLY_SEEN_TOKENS', new=LocalTTLCache(10, 60))
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(DEVICE_LAST_SEEN_INTERVAL=60))
+    def test_last_seen_is_updated_on_authentication(self):
+        client = APIClient(enforce_csrf_checks=True)
+        client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION='Token ' + self.device_token.key)
+
+        self.assertGreater(MultiToken.list_tokens(self.user)[0]['last_seen'], 1000)
+
+    @patch('djforge_redis_multitokens.tokens_auth.RECENTLY_SEEN_TOKENS', new=LocalTTLCache(10, 60))
+    def test_last_seen_updates_are_coalesced(self):
+        with patch('djforge_redis_multitokens.tokens_auth.run_script', wraps=run_script) as mocked_run_script:
+            for i in range(3):
+                MultiToken._touch_device(self.user.pk, self.device_token.key)
+
+        touches = [call for call in mocked_run_script.call_args_list if call[0][1] == TOUCH_DEVICE]
+        self.assertEqual(len(touches), 1)
+
+    @patch('djforge_redis_multitokens.tokens_auth.RECENTLY_SEEN_TOKENS', new=LocalTTLCache(10, 60))
+    def test_metadata_is_unchanged_when_last_seen_is_updated(self):
+        metadata = {'tags': [], 'n': 12345678901234567, 'url': 'https://example.com/a/b', 'created_at': 2000}
+        token, _ = MultiToken.create_token(self.user, device=metadata)
+        MultiToken._touch_device(self.user.pk, token.key)
+
+        device = MultiToken.list_tokens(self.user)[1]
+        self.assertGreater(device.pop('last_seen'), 2000)
+        device.pop('token_id')
+        self.assertEqual(device, metadata)
+
+    @patch('djforge_redis_multitokens.tokens_auth.RECENTLY_SEEN_TOKENS', new=LocalTTLCache(10, 60))
+    def test_last_seen_is_removed_with_its_token(self):
+        MultiToken._touch_device(self.user.pk, self.device_token.key)
+        MultiToken.expire_token(self.device_token)
+
+        client = get_redis_client(TOKENS_CACHE)
+        self.assertEqual(client.hlen(make_redis_key(TOKENS_CACHE, 'devices:%s' % self.user.pk)), 0)
+
+    def test_last_seen_is_not_updated_by_default(self):
+        client = APIClient(enforce_csrf_checks=True)
+        client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION='Token ' + self.device_token.key)
+
+        self.assertEqual(MultiToken.list_tokens(self.user)[0]['last_seen'], 1000)
+
+
 class TestExpireTokenMethod(SetupTearDownForMultiTokenTests, TestCase):
 
     def test_token_is_removed_from_redis_when_user_has_only_one_token(self):
@@ -130,14 +433,78 @@ class TestExpireAllTokenMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertIsNotNone(TOKENS_CACHE.get(parse_full_token(second_token.key)[1]))
 
 
+    def test_user_without_tokens_does_not_raise_error(self):
+        TOKENS_CACHE.clear()
+        self.assertIsNone(MultiToken.expire_all_tokens(self.user))
+
+    def test_all_tokens_are_removed_in_constant_number_of_round_trips(self):
+        for _ in range(9):
+            MultiToken.create_token(self.user)
+        hashes = TOKENS_CACHE.get(self.user.pk)
+
+        execute_command = redis.StrictRedis.execute_command
+        with patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command) as mocked:
+            MultiToken.expire_all_tokens(self.user)
+
+        self.assertEqual(mocked.call_count, 2)
+        self.assertEqual(mocked.call_args[0][1], 'UNLINK')
+        self.assertIsNone(TOKENS_CACHE.get(self.user.pk))
+        for hash in hashes:
+            self.assertIsNone(TOKENS_CACHE.get(hash))
+
+    @patch('djforge_redis_multitokens.storage.get_redis_client', return_value=None)
+    def test_tokens_are_removed_when_cache_has_no_redis_client(self, mocked_get_client):
+        MultiToken.expire_all_tokens(self.user)
+
+        self.assertIsNone(TOKENS_CACHE.get(self.user.pk))
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+
+class TestExpireAllTokensForUsersMethod(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestExpireAllTokensForUsersMethod, self).setUp()
+        self.second_user = create_test_user('tester2')
+        self.second_token, _ = MultiToken.create_token(self.second_user)
+        self.third_user = create_test_user('tester3')
+        self.third_token, _ = MultiToken.create_token(self.third_user)
+
+    def assertTokensExpired(self, *tokens):
+        for token in tokens:
+            self.assertIsNone(TOKENS_CACHE.get(token.user.pk))
+            self.assertIsNone(TOKENS_CACHE.get(parse_full_token(token.key)[1]))
+
+    def test_tokens_of_users_in_queryset_are_removed(self):
+        MultiToken.expire_all_tokens_for_users(User.objects.all(), chunk_size=2)
+        self.assertTokensExpired(self.token, self.second_token, self.third_token)
+
+    def test_tokens_of_listed_user_pks_are_removed(self):
+        MultiToken.expire_all_tokens_for_users([self.user.pk, self.second_user.pk], chunk_size=1)
+
+        self.assertTokensExpired(self.token, self.second_token)
+        self.assertIsNotNone(TOKENS_CACHE.get(self.third_user.pk))
+        self.assertIsNotNone(TOKENS_CACHE.get(parse_full_token(self.third_token.key)[1]))
+
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(USER_TOKENS_INDEX='set'))
+    def test_tokens_are_removed_from_sorted_set_and_list_indexes(self):
+        fourth_user = create_test_user('tester4')
+        fourth_token, _ = MultiToken.create_token(fourth_user)
+
+        MultiToken.expire_all_tokens_for_users(User.objects.all())
+
+        self.assertTokensExpired(self.token, self.second_token, self.third_token)
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(fourth_token.key)[1]))
+        self.assertFalse(get_redis_client(TOKENS_CACHE).exists(make_redis_key(TOKENS_CACHE, fourth_user.pk)))
+
+
 class TestSetValueInCacheMethod(SetupTearDownForMultiTokenTests, TestCase):
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=None))
+    @override_tokens_timeout(None)
     def test_default_timeout_for_cache_db_is_used_when_timeout_is_not_provided_provided(self):
         MultiToken._set_key_value('key', 'value')
         self.assertIsNone(TOKENS_CACHE.ttl('key'))
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=1000))
+    @override_tokens_timeout(1000)
     def test_token_ttl_is_correct_when_user_provides_cache_db_timeout_parameter(self):
         MultiToken._set_key_value('key', 'value')
         self.assertIsNotNone(TOKENS_CACHE.ttl('key'))
@@ -146,7 +513,7 @@ class TestSetValueInCacheMethod(SetupTearDownForMultiTokenTests, TestCase):
 
 class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=1000))
+    @override_tokens_timeout(1000)
     def test_users_immortal_tokens_get_limited_ttl_when_OVERWRITE_NONE_TTL_setting_is_True(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
@@ -156,7 +523,7 @@ class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertIsNotNone(TOKENS_CACHE.ttl(self.user.pk))
         self.assertIsNotNone(TOKENS_CACHE.ttl(hash))
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=None))
+    @override_tokens_timeout(None)
     @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(overwrite_ttl=False))
     def test_users_immortal_tokens_stay_immortal_when_OVERWRITE_NONE_TTL_setting_is_False(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
@@ -165,7 +532,7 @@ class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
         self.assertIsNone(TOKENS_CACHE.ttl(hash))
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=1000))
+    @override_tokens_timeout(1000)
     def test_other_users_tokens_are_not_affected(self):
         second_user = create_test_user('tester2')
         second_token, _ = MultiToken.create_token(second_user)
@@ -178,7 +545,7 @@ class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
         hash = TOKENS_CACHE.get(second_user.pk)[0]
         self.assertNotEqual(hash, 1000)
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=1000))
+    @override_tokens_timeout(1000)
     @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings())
     def test_correct_ttl_is_set_for_renewed_tokens(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
@@ -187,7 +554,7 @@ class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertAlmostEquals(TOKENS_CACHE.ttl(self.user.pk), 1000)
         self.assertAlmostEquals(TOKENS_CACHE.ttl(hash), 1000)
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings())
+    @override_tokens_timeout()
     def test_immortal_tokens_stay_immortal_when_user_doesnt_provide_timeout(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
@@ -197,7 +564,7 @@ class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
         self.assertIsNone(TOKENS_CACHE.ttl(hash))
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings', new=MockedSettings(timeout=None))
+    @override_tokens_timeout(None)
     def test_immortal_tokens_stay_immortal_when_user_provided_timeout_is_None(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
@@ -207,33 +574,560 @@ class TestResetTokensTTLMethod(SetupTearDownForMultiTokenTests, TestCase):
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
         self.assertIsNone(TOKENS_CACHE.ttl(hash))
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings')
-    def test_token_with_ttl_becomes_immortal_when_user_changes_timeout_to_None(self, mocked_settings):
+    def test_token_with_ttl_becomes_immortal_when_user_changes_timeout_to_None(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
         TOKENS_CACHE.expire(self.user.pk, 1000)
         TOKENS_CACHE.expire(TOKENS_CACHE.ttl(hash), 1000)
 
-        settings = MockedSettings(timeout=None)
-        mocked_settings.CACHES.__getitem__.return_value = settings.CACHES['default']
-        MultiToken.reset_tokens_ttl(self.user.pk)
+        with override_tokens_timeout(None):
+            MultiToken.reset_tokens_ttl(self.user.pk)
 
         self.assertIsNone(TOKENS_CACHE.ttl(self.user.pk))
         self.assertIsNone(TOKENS_CACHE.ttl(hash))
 
-    @patch('djforge_redis_multitokens.tokens_auth.settings')
-    def test_token_with_ttl_gets_new_ttl_when_user_changes_timeout_to_2000(self, mocked_settings):
+    def test_token_with_ttl_gets_new_ttl_when_user_changes_timeout_to_2000(self):
         hash = TOKENS_CACHE.get(self.user.pk)[0]
         TOKENS_CACHE.expire(self.user.pk, 1000)
         TOKENS_CACHE.expire(TOKENS_CACHE.ttl(hash), 1000)
 
-        settings = MockedSettings(timeout=2000)
-        mocked_settings.CACHES.__getitem__.return_value = settings.CACHES['default']
-        MultiToken.reset_tokens_ttl(self.user.pk)
+        with override_tokens_timeout(2000):
+            MultiToken.reset_tokens_ttl(self.user.pk)
 
         self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 2000)
         self.assertEqual(TOKENS_CACHE.ttl(hash), 2000)
 
 
+    @override_tokens_timeout(1000)
+    def test_ttl_of_all_tokens_is_reset_in_constant_number_of_round_trips(self):
+        for _ in range(9):
+            MultiToken.create_token(self.user)
+
+        execute_command = redis.StrictRedis.execute_command
+        with patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command) as mocked:
+            MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(mocked.call_count, 2)
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+        for hash in TOKENS_CACHE.get(self.user.pk):
+            self.assertEqual(TOKENS_CACHE.ttl(hash), 1000)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.storage.get_redis_client', return_value=None)
+    def test_ttl_is_reset_key_by_key_when_cache_has_no_redis_client(self, mocked_get_client):
+        hash = TOKENS_CACHE.get(self.user.pk)[0]
+        MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+        self.assertEqual(TOKENS_CACHE.ttl(hash), 1000)
+
+    def test_user_without_tokens_does_not_raise_error(self):
+        TOKENS_CACHE.clear()
+        self.assertIsNone(MultiToken.reset_tokens_ttl(self.user.pk))
+
+    @override_tokens_timeout(1000)
+    def test_tokens_of_many_users_are_reset_in_constant_number_of_round_trips(self):
+        second_user = create_test_user('tester2')
+        second_token, _ = MultiToken.create_token(second_user)
+        MultiToken.create_token(second_user)
+
+        execute_command = redis.StrictRedis.execute_command
+        with patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command) as mocked:
+            MultiToken.reset_tokens_ttl_many([self.user.pk, second_user.pk])
+
+        self.assertEqual(mocked.call_count, 1)
+        for user in (self.user, second_user):
+            self.assertEqual(TOKENS_CACHE.ttl(user.pk), 1000)
+            for hash in TOKENS_CACHE.get(user.pk):
+                self.assertEqual(TOKENS_CACHE.ttl(hash), 1000)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TTL_REFRESH_THRESHOLD=0.5))
+    def test_tokens_are_not_refreshed_above_threshold(self):
+        hash = TOKENS_CACHE.get(self.user.pk)[0]
+        TOKENS_CACHE.expire(self.user.pk, 900)
+        TOKENS_CACHE.expire(hash, 900)
+
+        MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertLessEqual(TOKENS_CACHE.ttl(self.user.pk), 900)
+        self.assertLessEqual(TOKENS_CACHE.ttl(hash), 900)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TTL_REFRESH_THRESHOLD=0.5))
+    def test_tokens_are_refreshed_below_threshold(self):
+        hash = TOKENS_CACHE.get(self.user.pk)[0]
+        TOKENS_CACHE.expire(self.user.pk, 400)
+        TOKENS_CACHE.expire(hash, 400)
+
+        MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+        self.assertEqual(TOKENS_CACHE.ttl(hash), 1000)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TTL_REFRESH_THRESHOLD=0.5))
+    def test_older_token_is_refreshed_when_index_is_newer(self):
+        # a login from another device set the index back to the full TIMEOUT
+        hash = TOKENS_CACHE.get(self.user.pk)[0]
+        TOKENS_CACHE.expire(self.user.pk, 1000)
+        TOKENS_CACHE.expire(hash, 100)
+
+        MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(TOKENS_CACHE.ttl(hash), 1000)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TTL_REFRESH_THRESHOLD=0.5))
+    @patch('djforge_redis_multitokens.storage.get_redis_client', return_value=None)
+    def test_older_token_is_refreshed_when_cache_has_no_redis_client(self, mocked_get_client):
+        hash = TOKENS_CACHE.get(self.user.pk)[0]
+        TOKENS_CACHE.expire(self.user.pk, 1000)
+        TOKENS_CACHE.expire(hash, 100)
+
+        MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(TOKENS_CACHE.ttl(hash), 1000)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TTL_REFRESH_THRESHOLD=0.5))
+    @patch('djforge_redis_multitokens.storage.get_redis_client', return_value=None)
+    def test_threshold_is_ignored_when_cache_has_no_redis_client(self, mocked_get_client):
+        # checking it would cost a TTL call per key
+        TOKENS_CACHE.expire(self.user.pk, 900)
+        MultiToken.reset_tokens_ttl(self.user.pk)
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+
+    @override_tokens_timeout(1000)
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(TTL_REFRESH_INTERVAL=60))
+    @patch('djforge_redis_multitokens.tokens_auth.RECENTLY_REFRESHED_USERS', new=LocalTTLCache(10, 60))
+    def test_tokens_are_refreshed_at_most_once_per_interval(self):
+        MultiToken.reset_tokens_ttl(self.user.pk)
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+        TOKENS_CACHE.expire(self.user.pk, 400)
+
+        execute_command = redis.StrictRedis.execute_command
+        with patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute_command) as mocked:
+            MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(mocked.call_count, 0)
+        self.assertLessEqual(TOKENS_CACHE.ttl(self.user.pk), 400)
+
+
+class TestSetTokenIndex(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        patcher = patch(
+            'djforge_redis_multitokens.tokens_auth.drt_settings',
+            new=MockedLibrarySettings(USER_TOKENS_INDEX='set'),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = get_redis_client(TOKENS_CACHE)
+        super(TestSetTokenIndex, self).setUp()
+
+    def get_index(self, user_pk):
+        key = make_redis_key(TOKENS_CACHE, user_pk)
+        return [h.decode() for h in self.client.zrange(key, 0, -1)]
+
+    def test_user_tokens_are_stored_in_sorted_set(self):
+        second_token, first_device = MultiToken.create_token(self.user)
+
+        self.assertTrue(self.first_device)
+        self.assertFalse(first_device)
+        self.assertEqual(self.client.type(make_redis_key(TOKENS_CACHE, self.user.pk)), b'zset')
+        self.assertEqual(
+            self.get_index(self.user.pk),
+            [parse_full_token(self.token.key)[1], parse_full_token(second_token.key)[1]],
+        )
+
+    def test_token_is_authenticated(self):
+        user = MultiToken.get_user_from_token(self.token.key)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_expired_token_is_removed_from_sorted_set(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        MultiToken.expire_token(self.token)
+
+        self.assertEqual(self.get_index(self.user.pk), [parse_full_token(second_token.key)[1]])
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+
+    def test_all_tokens_are_removed(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        MultiToken.expire_all_tokens(self.user)
+
+        self.assertEqual(self.get_index(self.user.pk), [])
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(second_token.key)[1]))
+
+    @override_tokens_timeout(1000)
+    def test_tokens_ttl_is_reset(self):
+        MultiToken.reset_tokens_ttl(self.user.pk)
+
+        self.assertEqual(TOKENS_CACHE.ttl(self.user.pk), 1000)
+        self.assertEqual(TOKENS_CACHE.ttl(parse_full_token(self.token.key)[1]), 1000)
+
+    def test_list_index_is_migrated_to_sorted_set(self):
+        TOKENS_CACHE.clear()
+        TOKENS_CACHE.set(self.user.pk, ['hash1', 'hash2'])
+
+        self.assertTrue(MultiToken.migrate_user_index(self.user.pk))
+        self.assertEqual(self.get_index(self.user.pk), ['hash1', 'hash2'])
+        self.assertFalse(MultiToken.migrate_user_index(self.user.pk))
+
+    def test_list_index_is_migrated_when_a_new_token_is_created(self):
+        TOKENS_CACHE.clear()
+        TOKENS_CACHE.set(self.user.pk, ['hash1'])
+
+        token, first_device = MultiToken.create_token(self.user)
+
+        self.assertFalse(first_device)
+        self.assertEqual(self.get_index(self.user.pk), ['hash1', parse_full_token(token.key)[1]])
+
+    def test_migration_command_migrates_all_users(self):
+        second_user = create_test_user('tester2')
+        TOKENS_CACHE.clear()
+        TOKENS_CACHE.set(self.user.pk, ['hash1'])
+        TOKENS_CACHE.set(second_user.pk, ['hash2'])
+
+        out = StringIO()
+        call_command('migrate_tokens_index', stdout=out)
+
+        self.assertIn('2 users', out.getvalue())
+        self.assertEqual(self.get_index(self.user.pk), ['hash1'])
+        self.assertEqual(self.get_index(second_user.pk), ['hash2'])
+
+
+class TestV1TokenFormat(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestV1TokenFormat, self).setUp()
+        self.legacy_token = self.token
+        patcher = patch(
+            'djforge_redis_multitokens.tokens_auth.drt_settings',
+            new=MockedLibrarySettings(TOKEN_FORMAT='mt1'),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.token, _ = MultiToken.create_token(self.user)
+
+    def test_token_is_short_and_versioned(self):
+        self.assertTrue(self.token.key.startswith('mt1.'))
+        self.assertEqual(len(self.token.key), 61)
+
+    def test_token_id_starts_with_the_user_tag(self):
+        self.assertTrue(self.token.key.startswith('mt1.' + make_user_tag(self.user.pk)))
+
+    def test_token_is_authenticated(self):
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+
+    def test_legacy_token_is_still_authenticated(self):
+        self.assertEqual(MultiToken.get_user_from_token(self.legacy_token.key).pk, self.user.pk)
+
+    def test_token_with_wrong_secret_is_rejected(self):
+        wrong_secret = self.token.key[:-1] + ('x' if self.token.key[-1] != 'x' else 'y')
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, wrong_secret)
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, 'mt1.unknown.secret')
+
+    def test_token_is_expired(self):
+        MultiToken.expire_token(self.token)
+
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+        self.assertEqual(TOKENS_CACHE.get(self.user.pk), [parse_full_token(self.legacy_token.key)[1]])
+
+    def test_all_tokens_are_expired(self):
+        MultiToken.expire_all_tokens(self.user)
+
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.legacy_token.key)
+
+
+class TestMaxTokensPerUser(SetupTearDownForMultiTokenTests, TestCase):
+    user_tokens_index = 'list'
+
+    def setUp(self):
+        patcher = patch(
+            'djforge_redis_multitokens.tokens_auth.drt_settings',
+            new=MockedLibrarySettings(USER_TOKENS_INDEX=self.user_tokens_index, MAX_TOKENS_PER_USER=2),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(TestMaxTokensPerUser, self).setUp()
+
+    def test_tokens_under_the_cap_are_kept(self):
+        second_token, _ = MultiToken.create_token(self.user)
+
+        self.assertEqual(MultiToken.get_user_from_token(self.token.key).pk, self.user.pk)
+        self.assertEqual(MultiToken.get_user_from_token(second_token.key).pk, self.user.pk)
+
+    def test_oldest_token_is_evicted_when_the_cap_is_exceeded(self):
+        second_token, _ = MultiToken.create_token(self.user)
+        third_token, _ = MultiToken.create_token(self.user)
+
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+        self.assertIsNone(TOKENS_CACHE.get(parse_full_token(self.token.key)[1]))
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [
+            parse_full_token(second_token.key)[1],
+            parse_full_token(third_token.key)[1],
+        ])
+
+    @patch('djforge_redis_multitokens.tokens_auth.VERIFIED_TOKENS_CACHE', new=LocalTTLCache(10, 60))
+    def test_evicted_token_is_dropped_from_verified_tokens_cache(self):
+        MultiToken.get_user_from_token(self.token.key)
+        MultiToken.create_token(self.user)
+        MultiToken.create_token(self.user)
+
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+
+    def test_other_users_are_not_affected(self):
+        second_user = create_test_user('tester2')
+        token, _ = MultiToken.create_token(second_user)
+        MultiToken.create_token(self.user)
+        MultiToken.create_token(self.user)
+
+        self.assertEqual(MultiToken.get_user_from_token(token.key).pk, second_user.pk)
+
+
+class TestMaxTokensPerUserWithSortedSet(TestMaxTokensPerUser):
+    user_tokens_index = 'set'
+
+
+class TestPruneDanglingHashes(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        super(TestPruneDanglingHashes, self).setUp()
+        self.second_token, _ = MultiToken.create_token(self.user)
+        self.hash = parse_full_token(self.token.key)[1]
+        self.second_hash = parse_full_token(self.second_token.key)[1]
+
+        # the first token expires on its own and leaves its hash behind in the index
+        TOKENS_CACHE.delete(self.hash)
+
+    def get_hashes_left_by_ttl_reset(self):
+        # lists are only pruned by prune_user_index, rewriting them on the request path
+        # could drop a token created at the same time
+        return [self.hash, self.second_hash]
+
+    def test_dangling_hash_is_handled_when_ttl_is_reset(self):
+        MultiToken.reset_tokens_ttl(self.user.pk)
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), self.get_hashes_left_by_ttl_reset())
+
+    def test_dangling_hash_is_handled_when_ttl_of_many_users_is_reset(self):
+        MultiToken.reset_tokens_ttl_many([self.user.pk])
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), self.get_hashes_left_by_ttl_reset())
+
+    def test_index_is_not_rewritten_when_ttl_is_reset(self):
+        # a token created between the read and the write of the list would be lost
+        with patch.object(MultiToken, '_set_key_value') as mocked_set_key_value:
+            MultiToken.reset_tokens_ttl(self.user.pk)
+            MultiToken.reset_tokens_ttl_many([self.user.pk])
+
+        mocked_set_key_value.assert_not_called()
+
+    def test_user_index_is_pruned(self):
+        self.assertEqual(MultiToken.prune_user_index(self.user.pk), [self.hash])
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [self.second_hash])
+        self.assertEqual(MultiToken.prune_user_index(self.user.pk), [])
+
+    def test_prune_command_removes_dangling_hashes_of_all_users(self):
+        second_user = create_test_user('tester2')
+        token, _ = MultiToken.create_token(second_user)
+        TOKENS_CACHE.delete(parse_full_token(token.key)[1])
+
+        out = StringIO()
+        call_command('prune_tokens', stdout=out)
+
+        self.assertIn('Scanned 2 user indexes, removed 2 dangling hashes', out.getvalue())
+        self.assertEqual(MultiToken._get_user_hashes(self.user.pk), [self.second_hash])
+        self.assertEqual(MultiToken._get_user_hashes(second_user.pk), [])
+
+
+class TestPruneDanglingHashesFromSortedSet(TestPruneDanglingHashes):
+
+    def setUp(self):
+        patcher = patch(
+            'djforge_redis_multitokens.tokens_auth.drt_settings',
+            new=MockedLibrarySettings(USER_TOKENS_INDEX='set'),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(TestPruneDanglingHashesFromSortedSet, self).setUp()
+
+    def get_hashes_left_by_ttl_reset(self):
+        return [self.second_hash]
+
+
+class TestRemoveFromTokenList(SetupTearDownForMultiTokenTests, TestCase):
+
+    def test_token_created_while_list_is_rewritten_is_kept(self):
+        created_tokens = []
+        user = self.user
+
+        class HashesCreatingToken(list):
+            # searched between the read and the write of the list, like a concurrent request
+            def __contains__(self, hash):
+                if not created_tokens:
+                    created_tokens.append(MultiToken.create_token(user)[0])
+                return super(HashesCreatingToken, self).__contains__(hash)
+
+        second_token, _ = MultiToken.create_token(self.user)
+        MultiToken._remove_from_token_list(self.user.pk, HashesCreatingToken([parse_full_token(self.token.key)[1]]))
+
+        self.assertEqual(TOKENS_CACHE.get(self.user.pk), [
+            parse_full_token(second_token.key)[1], parse_full_token(created_tokens[0].key)[1],
+        ])
+
+
+class TestRedisUserCache(SetupTearDownForMultiTokenTests, TestCase):
+    user_cache = 'redis'
+
+    def setUp(self):
+        library_settings = MockedLibrarySettings(USER_CACHE=self.user_cache)
+        for target, new in (
+            ('tokens_auth.drt_settings', library_settings),
+            ('signals.drt_settings', library_settings),
+            ('tokens_auth.LOCAL_USERS_CACHE', LocalTTLCache(10, 60)),
+        ):
+            patcher = patch('djforge_redis_multitokens.' + target, new=new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        super(TestRedisUserCache, self).setUp()
+
+    def test_cached_user_is_returned_without_database_query(self):
+        MultiToken.get_user_from_token(self.token.key)
+
+        with self.assertNumQueries(0):
+            user = MultiToken.get_user_from_token(self.token.key)
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(user.username, self.user.username)
+            self.assertTrue(user.is_active)
+
+    def test_password_is_not_cached(self):
+        MultiToken.get_user_from_token(self.token.key)
+        user = MultiToken.get_user_from_token(self.token.key)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(user.password, self.user.password)
+
+    def test_only_configured_fields_are_cached(self):
+        with patch('djforge_redis_multitokens.tokens_auth.drt_settings',
+                   new=MockedLibrarySettings(USER_CACHE=self.user_cache, USER_CACHE_FIELDS=('username',))):
+            MultiToken.get_user_from_token(self.token.key)
+            user = MultiToken.get_user_from_token(self.token.key)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(user.username, self.user.username)
+            self.assertTrue(user.is_active)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, self.user.email)
+
+    def test_saving_user_invalidates_cache(self):
+        MultiToken.get_user_from_token(self.token.key)
+        self.user.is_active = False
+        self.user.save()
+
+        user = MultiToken.get_user_from_token(self.token.key)
+        self.assertFalse(user.is_active)
+
+    def test_deleting_user_invalidates_cache(self):
+        MultiToken.get_user_from_token(self.token.key)
+        self.user.delete()
+
+        self.assertRaises(User.DoesNotExist, MultiToken.get_user_from_token, self.token.key)
+
+    def test_cache_is_invalidated_once_the_app_is_ready(self):
+        # a process that never imported tokens_auth before the app registry was ready
+        for signal in (post_save, post_delete):
+            signal.disconnect(sender=settings.AUTH_USER_MODEL, dispatch_uid=USER_CACHE_INVALIDATION_UID)
+        apps.get_app_config('djforge_redis_multitokens').ready()
+
+        MultiToken.get_user_from_token(self.token.key)
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertFalse(MultiToken.get_user_from_token(self.token.key).is_active)
+
+    def test_saving_cached_user_does_not_overwrite_password(self):
+        MultiToken.get_user_from_token(self.token.key)
+        user = MultiToken.get_user_from_token(self.token.key)
+        user.first_name = 'first'
+        user.save()
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'first')
+        self.assertTrue(self.user.password)
+
+    def test_inactive_cached_user_is_not_authenticated(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        MultiToken.invalidate_cached_user(self.user.pk)
+
+        client = APIClient(enforce_csrf_checks=True)
+        auth = 'Token ' + self.token.key
+        response = client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TestLocalUserCache(TestRedisUserCache):
+    user_cache = 'local'
+
+
+class TestLazyUser(SetupTearDownForMultiTokenTests, TestCase):
+
+    def setUp(self):
+        patcher = patch(
+            'djforge_redis_multitokens.tokens_auth.drt_settings',
+            new=MockedLibrarySettings(USER_CACHE='redis', LAZY_USER=True),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(TestLazyUser, self).setUp()
+
+    def test_user_is_loaded_when_it_is_not_cached(self):
+        user = MultiToken.get_lazy_user_from_token(self.token.key)
+        self.assertNotIsInstance(user, LazyUser)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_lazy_user_exposes_pk_and_is_active_without_database_query(self):
+        MultiToken.get_user_from_token(self.token.key)
+
+        with self.assertNumQueries(0):
+            user = MultiToken.get_lazy_user_from_token(self.token.key)
+            self.assertIsInstance(user, LazyUser)
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(user.id, self.user.pk)
+            self.assertTrue(user.is_active)
+            self.assertTrue(user.is_authenticated)
+            self.assertTrue(user)
+
+    def test_lazy_user_is_loaded_on_first_access_to_other_attributes(self):
+        MultiToken.get_user_from_token(self.token.key)
+        user = MultiToken.get_lazy_user_from_token(self.token.key)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(user.username, self.user.username)
+            self.assertEqual(user.email, self.user.email)
+            self.assertEqual(user, self.user)
+
+    def test_lazy_user_is_authenticated_without_database_query(self):
+        MultiToken.get_user_from_token(self.token.key)
+        client = APIClient(enforce_csrf_checks=True)
+        auth = 'Token ' + self.token.key
+
+        with self.assertNumQueries(0):
+            response = client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_inactive_lazy_user_is_not_authenticated(self):
+        self.user.is_active = False
+        self.user.save()
+        MultiToken.get_user_from_token(self.token.key)
+
+        client = APIClient(enforce_csrf_checks=True)
+        auth = 'Token ' + self.token.key
+        response = client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
 class TestCachedTokenAuthentication(SetupTearDownForMultiTokenTests, TestCase):
     header_prefix = 'Token '
 
@@ -255,6 +1149,17 @@ class TestCachedTokenAuthentication(SetupTearDownForMultiTokenTests, TestCase):
         response = client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION=auth)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    @patch('djforge_redis_multitokens.tokens_auth.drt_settings', new=MockedLibrarySettings(BACKGROUND_TTL_REFRESH=True))
+    @patch('djforge_redis_multitokens.tokens_auth.TTL_REFRESHER')
+    @patch('djforge_redis_multitokens.tokens_auth.MultiToken.reset_tokens_ttl')
+    def test_successful_auth_queues_token_renewal_in_background_mode(self, mock_reset_ttl_method, mock_refresher):
+        client = APIClient(enforce_csrf_checks=True)
+        auth = self.header_prefix + self.token.key
+        client.post('/token/', {'example': 'example'}, HTTP_AUTHORIZATION=auth)
+
+        mock_refresher.add.assert_called_once_with(self.user.pk)
+        mock_reset_ttl_method.assert_not_called()
+
     @patch('djforge_redis_multitokens.tokens_auth.MultiToken.reset_tokens_ttl')
     def test_successful_auth_renews_token(self, mock_reset_ttl_method):
         client = APIClient(enforce_csrf_checks=True)
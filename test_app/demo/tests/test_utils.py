@@ -2,8 +2,11 @@ from django.test import TestCase
 
 from djforge_redis_multitokens.utils import (
     make_full_token,
+    make_v1_token,
     parse_full_token,
+    parse_token,
     TOKEN_HASH_SEPARATOR,
+    V1_KEY_PREFIX,
     WRONG_HASH,
     WRONG_TOKEN,
 )
@@ -39,3 +42,16 @@ class TestParseFullTokenFunction(TestCase):
         self.assertEqual(len(parse_full_token(bad_full_token)), 2)
         self.assertIn(WRONG_TOKEN, parse_full_token(bad_full_token))
         self.assertIn(WRONG_HASH, parse_full_token(bad_full_token))
+
+
+class TestParseTokenFunction(TestCase):
+
+    def test_legacy_token_is_stored_under_its_hash(self):
+        self.assertEqual(parse_token(make_full_token('token', 'hash')), ('token', 'hash', 'hash'))
+
+    def test_v1_token_is_stored_under_its_id(self):
+        self.assertEqual(parse_token(make_v1_token('id', 'secret')), ('secret', V1_KEY_PREFIX + 'id', None))
+
+    def test_bad_v1_token_returns_generic_bad_result(self):
+        for bad_token in ('mt1.id', 'mt1..secret', 'mt1.id.secret.more'):
+            self.assertEqual(parse_token(bad_token), (WRONG_TOKEN, WRONG_HASH, WRONG_HASH))
@@ -1,9 +1,11 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.http import HttpResponse
+from django.test import override_settings
 from rest_framework import permissions
 from rest_framework.views import APIView
 
-from djforge_redis_multitokens.tokens_auth import MultiToken, TOKENS_CACHE
+from djforge_redis_multitokens.tokens_auth import _reset_user_provided_ttl, MultiToken, TOKENS_CACHE
 from djforge_redis_multitokens.settings import djforge_redis_multitokens_settings as drf_settings
 
 
@@ -26,29 +28,41 @@ class SetupTearDownForMultiTokenTests:
         TOKENS_CACHE.clear()
 
 
-class MockedSettings:
+def override_tokens_timeout(timeout=False):
+    """
+    ``override_settings`` for the ``TIMEOUT`` of the tokens cache, left out when ``timeout``
+    is ``False``. It sends ``setting_changed``, so ``MultiToken`` resolves the TTL again.
+    """
+    cache = dict(settings.CACHES[drf_settings.REDIS_DB_NAME])
+    cache.pop('TIMEOUT', None)
+    if timeout is not False:
+        cache['TIMEOUT'] = timeout
 
-    def __init__(self, timeout=False):
-        if timeout is False:
-            self.CACHES = {
-                drf_settings.REDIS_DB_NAME: {
-                }
-            }
-        else:
-            self.CACHES = {
-                drf_settings.REDIS_DB_NAME: {
-                    'TIMEOUT': timeout
-                }
-            }
+    return override_settings(CACHES=dict(settings.CACHES, **{drf_settings.REDIS_DB_NAME: cache}))
+
+
+def resolve_ttl_again(test_case):
+    """
+    Have ``MultiToken`` resolve the TTL from patched settings, which don't send
+    ``setting_changed``, and from the real ones after ``test_case``.
+    """
+    _reset_user_provided_ttl('DJFORGE_REDIS_MULTITOKENS')
+    test_case.addCleanup(_reset_user_provided_ttl, 'DJFORGE_REDIS_MULTITOKENS')
 
 
 class MockedLibrarySettings:
 
-    def __init__(self, overwrite_ttl=True):
+    def __init__(self, overwrite_ttl=True, **overrides):
         self.REDIS_DB_NAME = drf_settings.REDIS_DB_NAME
         self.RESET_TOKEN_TTL_ON_USER_LOG_IN = True
         self.OVERWRITE_NONE_TTL = overwrite_ttl
 
+        for name, value in overrides.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, item):
+        return getattr(drf_settings, item)
+
 
 class MockView(APIView):
     permission_classes = (permissions.IsAuthenticated,)